@@ -0,0 +1,215 @@
+import argparse
+import os
+import time
+from functools import partial
+
+import numpy as np
+
+from cohort_arrays import read_cohort_arrays
+from cox import CoxModel, fit_models, lincom, lrtest, model_variables
+
+
+# PYTHON VERSION OF an_cox.do
+# Fits the Cox models of an_cox.do to output/main.parquet (cr_main.py) with
+# the numpy engine in cox.py, all at once on a pool of processes, and writes
+# the hazard ratios for S-Fail vs. S-Pos in the layout of table2.txt.
+#
+# The tvc(i.sgtf) model is fitted and reported but, as in an_cox.do, is not
+# part of table 2. Not reproduced here: estat phtest and the Kaplan-Meier,
+# cumulative hazard and smoothed hazard plots.
+STUDY_WEEKS = (49, 52)
+
+AGE_SPLINE = "age1 age2 age3"
+DEMOGRAPHIC = "ib2.vax i.male ib1.imd ib1.eth2 ib1.hh_total_cat i.home_bin ib1.rural_urban5 ib49.start_week"
+ADJUSTMENT = [
+    "ib2.vax",
+    "i.male",
+    "ib1.imd",
+    "ib1.eth2",
+    "ib1.smoke_nomiss2",
+    "ib1.obese4cat",
+    "ib1.hh_total_cat",
+    "ib1.rural_urban5",
+    "ib0.comorb_cat",
+    "ib49.start_week",
+    AGE_SPLINE,
+    "i.home_bin",
+]
+
+
+def fully_adjusted(interaction=None, without=()):
+    # i.sgtf (or i.sgtf##interaction) with the full adjustment set
+    terms = [term for term in ADJUSTMENT if term != interaction and term not in without]
+    sgtf = f"i.sgtf##{interaction}" if interaction else "i.sgtf"
+    return " ".join([sgtf] + terms)
+
+
+def stcox(name, formula, condition=None, strata="utla_group", exit="ae_surv_d", failure="cox_ae", ties="breslow", tvc=None):
+    # stset <exit>, origin(study_start) fail(<failure>) id(patient_id)
+    return CoxModel(name, formula, condition, exit, failure, "study_start", strata=strata, ties=ties, tvc=tvc)
+
+
+def an_cox_models(ties="breslow"):
+    stcox_ = partial(stcox, ties=ties)
+    without_eth = "eth2 != 6"
+    models = [
+        stcox_("unadjusted", "i.sgtf", strata=None),
+        stcox_("region_stratified", "i.sgtf"),
+        # tvc() is fitted with Breslow ties whatever --ties is
+        stcox("tvc", "i.sgtf", tvc="i.sgtf"),
+        stcox_("vax_adj", "i.sgtf ib2.vax"),
+        stcox_("demographic_adj", f"i.sgtf {DEMOGRAPHIC} {AGE_SPLINE}", without_eth),
+        stcox_("demographic_adj_agegroup", f"i.sgtf {DEMOGRAPHIC} ib1.agegroup6", without_eth),
+        stcox_("fully_adj", fully_adjusted(), without_eth),
+        # Subgroups
+        stcox_("week_x", fully_adjusted("ib49.start_week"), without_eth),
+        stcox_("vax_x", fully_adjusted("ib2.vax"), without_eth),
+        stcox_("comorb_x", fully_adjusted("ib0.comorb_cat"), without_eth),
+        stcox_("eth2_x", fully_adjusted("ib1.eth2"), without_eth),
+        stcox_("agegroup", fully_adjusted(without=[AGE_SPLINE]) + " ib0.agegroup6", without_eth),
+        stcox_("agegroup_x", fully_adjusted("ib0.agegroup6", without=[AGE_SPLINE]), without_eth),
+        # Sensitivity analyses
+        stcox_("excluding_care_home", fully_adjusted(without=["i.home_bin"]), without_eth),
+        stcox_("excluding_ethnicity", fully_adjusted(without=["ib1.eth2", "i.home_bin"])),
+        stcox_("min_14_days", fully_adjusted(), f"ae_14_pop == 1 & {without_eth}"),
+        stcox_("fu_plus_1", fully_adjusted(), without_eth, exit="ae_surv_d1"),
+        stcox_("admission", fully_adjusted(), without_eth, failure="cox_admit"),
+    ]
+    # Specific comorbidities, adjusted for vaccination and age, then fully
+    for flag in ("renal_flag", "dm", "chronic_cardiac_disease"):
+        models += [
+            stcox_(f"{flag}_v", f"i.sgtf ib2.vax {AGE_SPLINE}", f"{flag} == 1"),
+            stcox_(
+                f"{flag}_f",
+                fully_adjusted(without=["ib0.comorb_cat"]),
+                f"{without_eth} & {flag} == 1",
+            ),
+        ]
+    return models
+
+
+# COHORT
+def load_cohort(path, columns):
+    # The numeric columns as floats (NaN for missing, dates as days) and
+    # utla_group as integer codes, restricted as an_cox.do is (which drops
+    # missing utla_group)
+    columns = list(dict.fromkeys(columns + ["has_sgtf", "cox_pop", "start_week", "utla_group"]))
+    cohort = read_cohort_arrays(path, columns)
+    week = cohort.floats("start_week")
+    keep = (
+        ~cohort.missing("utla_group")
+        & (cohort.floats("has_sgtf") != 0)
+        & (cohort.floats("cox_pop") == 1)
+        & (week >= STUDY_WEEKS[0])
+        & (week <= STUDY_WEEKS[1])
+    )
+    cohort = cohort.take(keep)
+    return {name: cohort.floats(name) for name in columns}
+
+
+# TABLE 2
+def estimate_line(label, estimate):
+    # "." for a model that could not be estimated
+    if np.isnan(estimate.estimate):
+        return f"{label}\t.\t."
+    return f"{label}\t{estimate.estimate:4.2f} ({estimate.lb:4.2f}-{estimate.ub:4.2f})\t{p_value(estimate.p)}"
+
+
+def p_value(p):
+    return "." if np.isnan(p) else f"{p:6.4f}"
+
+
+def table2(results):
+    def row(label, model, *interaction):
+        return estimate_line(label, lincom(results[model], ["1.sgtf"] + [f"1.sgtf#{term}" for term in interaction]))
+
+    def subgroup(label, restricted, full, rows):
+        p = lrtest(results[restricted], results[full])
+        return ["", f"{label}\t\t{p_value(p)}"] + [row(row_label, full, *terms) for row_label, *terms in rows]
+
+    lines = ["Table 2: Hazard ratios for S-Fail vs. S-Pos", "", "Estimate\tHR (95% CI)\tP-value"]
+    lines += ["", row("Region stratified", "region_stratified")]
+    lines += [row("Vax adj.", "vax_adj")]
+    lines += [row("Demographically adj.", "demographic_adj")]
+    lines += [row("Fully adj.", "fully_adj")]
+
+    lines += ["", "Subgroup analyses"]
+    lines += subgroup(
+        "Epi. week",
+        "fully_adj",
+        "week_x",
+        [
+            ("05Dec-11Dec",),
+            ("12Dec-18Dec", "50.start_week"),
+            ("19Dec-25Dec", "51.start_week"),
+            ("26Dec-01Jan", "52.start_week"),
+        ],
+    )
+    lines += subgroup(
+        "Vaccination",
+        "fully_adj",
+        "vax_x",
+        [("Unvax", "0.vax"), ("1 dose", "1.vax"), ("2 doses",), ("Booster", "3.vax")],
+    )
+    lines += subgroup(
+        "Comorbidities",
+        "fully_adj",
+        "comorb_x",
+        [("None",), ("1", "1.comorb_cat"), ("2+", "2.comorb_cat")],
+    )
+    for flag, label in (("renal_flag", "Renal"), ("dm", "DM"), ("chronic_cardiac_disease", "CVD")):
+        lines += [row(f"{label} v.adj", f"{flag}_v"), row(f"{label} f.adj", f"{flag}_f")]
+    lines += subgroup("Ethnicity", "fully_adj", "eth2_x", [("White",), ("Not white", "5.eth2")])
+    lines += subgroup(
+        "Age group",
+        "agegroup",
+        "agegroup_x",
+        [("0-39",)] + [(label, f"{level}.agegroup6") for level, label in enumerate(["40-54", "55-64", "65-74", "75-84", "85+"], 1)],
+    )
+
+    lines += ["", "Sensitivity analyses"]
+    lines += [row("Excluding care home", "excluding_care_home")]
+    lines += [row("Excluding ethnicity", "excluding_ethnicity")]
+    lines += [row("Min 14-days FU", "min_14_days")]
+    lines += [row("FU plus 1", "fu_plus_1")]
+    lines += [row("Fully adj. Admission", "admission")]
+    return "\n".join(lines) + "\n\n\n"
+
+
+def model_report(result):
+    if result.error is not None:
+        return f"{result.name}: {result.n} obs, {result.events} failures, not estimable ({result.error})"
+    lines = [
+        f"{result.name}: {result.n} obs, {result.events} failures, "
+        f"log likelihood {result.loglik:.4f}, {result.iterations} iterations"
+        + ("" if result.converged else " (not converged)")
+    ]
+    se = np.sqrt(np.diag(result.variance))
+    for name, coef, error in zip(result.names, result.coef, se):
+        lines.append(f"  {name:<32} HR {np.exp(coef):8.4f}  se(b) {error:.4f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/main.parquet")
+    parser.add_argument("--output", default="output/table2_py.txt")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--ties", choices=["breslow", "efron"], default="breslow")
+    options = parser.parse_args()
+
+    models = an_cox_models(options.ties)
+    columns = list(dict.fromkeys(name for model in models for name in model_variables(model)))
+    start = time.perf_counter()
+    results = fit_models(models, partial(load_cohort, options.input, columns), options.workers)
+    print(f"Fitted {len(models)} models in {time.perf_counter() - start:.1f}s\n")
+    for model in models:
+        print(model_report(results[model.name]) + "\n")
+
+    with open(options.output, "w") as f:
+        f.write(table2(results))
+    print(f"Wrote {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from an_cox import fully_adjusted, load_cohort, stcox
+from cox import fit_model, model_variables
+from imputation import imputed_column, mi_estimate, mi_info, pooled_table
+
+
+# PYTHON VERSION OF an_cox_imputed.do
+# mi estimate: stcox of the fully adjusted model on each imputation of
+# output/main_imputed.parquet (cr_imputed.py), fitted in parallel and pooled
+# with Rubin's rules. The pooled estimates (the contents of
+# an_imputed_eth2.ster: b, V, the within and between imputation variances and
+# the degrees of freedom) are saved as output/an_imputed_eth2.json.
+MODEL = stcox("imputed_eth2", fully_adjusted())
+
+
+def estimates_json(pooled, results):
+    return {
+        "cmd": "stcox",
+        "model": MODEL.formula,
+        "strata": MODEL.strata,
+        "m": pooled.m,
+        "N": results[0].n,
+        "failures": results[0].events,
+        "names": pooled.names,
+        "b": pooled.coef.tolist(),
+        "V": pooled.variance.tolist(),
+        "W": pooled.within.tolist(),
+        "B": pooled.between.tolist(),
+        "df_mi": [None if np.isinf(df) else df for df in pooled.df.tolist()],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/main_imputed.parquet")
+    parser.add_argument("--output", default="output/an_imputed_eth2.json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    info = mi_info(pq.read_schema(options.input))
+    extra = [imputed_column(variable, k) for variable in info["imputed"] for k in range(1, info["m"] + 1)]
+    columns = load_cohort(options.input, model_variables(MODEL) + extra)
+
+    # The rows each variable was imputed for and the m values imputed there
+    imputed = {}
+    for variable in info["imputed"]:
+        rows = np.flatnonzero(np.isnan(columns[variable]))
+        values = [columns.pop(imputed_column(variable, k))[rows] for k in range(1, info["m"] + 1)]
+        imputed[variable] = (rows, np.array(values))
+
+    start = time.perf_counter()
+    pooled, results = mi_estimate(partial(fit_model, model=MODEL), columns, imputed, options.workers)
+    print(f"Fitted {pooled.m} imputations in {time.perf_counter() - start:.1f}s")
+    print(f"{results[0].n} obs, {results[0].events} failures\n")
+    for name, hr, lb, ub, p in pooled_table(pooled):
+        print(f"  {name:<32} HR {hr:6.3f} ({lb:6.3f}-{ub:6.3f})  p {p:.4f}")
+
+    with open(options.output, "w") as f:
+        json.dump(estimates_json(pooled, results), f, indent=2)
+    print(f"\nWrote {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+import argparse
+import csv
+import os
+import time
+import zipfile
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from an_cox import STUDY_WEEKS
+from cohort_arrays import cohort_chunks
+from cr_main import stata_percentile
+
+
+# PYTHON VERSION OF an_table1.do
+# Table 1 (counts and column percentages of each covariate level, and the
+# mean, SD, median and IQR of the continuous ones, overall and by SGTF) and
+# the bins of its histograms and kernel densities, from one pass over
+# output/main.parquet (cr_main.py) in chunks of CohortArrays.
+#
+# Everything is worked out from counts of each distinct value of a variable
+# within each group (sgtf, or start_week for ae_kden), which is all a
+# tabulation, a percentile, a histogram or a kernel density needs. The
+# counts of a batch are a few hundred numbers whatever its size, and the
+# counts of two batches (or two files) add, so several inputs (shards of a
+# cohort) are counted on a pool of processes and merged.
+#
+# Differences from an_table1.do:
+#   - the figures are written as their bins and density points, in
+#     output/table1_figures_py.csv, rather than drawn
+#   - table1_py.xlsx holds the cells of table1_py.txt as text, as insheet
+#     then export excel leaves them
+BATCH_SIZE = 500_000
+
+Tabulation = namedtuple("Tabulation", "variable by condition", defaults=("sgtf", None))
+Series = namedtuple("Series", "label tabulation group")
+Figure = namedtuple("Figure", "name kind series")
+
+# (variable, levels to tabulate, or None to summarize), in table order
+TABLE1 = [
+    ("cox_pop", [1]),
+    ("any_ae", [0, 1]),
+    ("cox_ae", [0, 1]),
+    ("cox_admit", [0, 1]),
+    ("died", [0, 1]),
+    ("ae_time", None),
+    ("cox_ae_time", None),
+    ("start_week", [49, 50, 51, 52]),
+    ("male", [0, 1]),
+    ("age", None),
+    ("agegroup6", [0, 1, 2, 3, 4, 5]),
+    ("vax", [0, 1, 2, 3]),
+    ("eth5", [1, 2, 3, 4, 5, 6]),
+    ("obese4cat", [1, 2, 3, 4]),
+    ("smoke_nomiss", [1, 2, 3]),
+    ("comorb_cat", [0, 1, 2]),
+    ("imd", [1, 2, 3, 4, 5]),
+    ("hh_total_cat", [1, 2, 3, 4, 5]),
+    ("home_bin", [0, 1]),
+    ("region", [0, 1, 2, 3, 4, 5, 6, 7, 8]),
+    ("rural_urban5", [1, 2, 3, 4, 5, 6]),
+]
+
+# Missing household size and rural/urban are tabulated as levels of their own
+MISSING_LEVELS = {"hh_total_cat": 5, "rural_urban5": 6}
+
+# The labels cr_main.do gives these variables and their levels
+VARIABLE_LABELS = {
+    "cox_pop": "1=Population for Cox analysis",
+    "any_ae": "AE covid any time",
+    "cox_ae": "AE outcome for Cox",
+    "cox_admit": "AE admission outcome for Cox",
+    "died": "Died",
+    "ae_time": "AE time from start",
+    "cox_ae_time": "Cox follow-up time",
+    "start_week": "Epidemiological week of study",
+    "male": "Male",
+    "age": "Age (years)",
+    "agegroup6": "Six age groups",
+    "vax": "Vaccination status",
+    "eth5": "Ethnicity in 5 categories",
+    "obese4cat": "Evidence of obesity (missing set to none)",
+    "smoke_nomiss": "Smoking status (missing set to never)",
+    "comorb_cat": "Categorical number of comorbidites",
+    "imd": "Index of Multiple Deprivation (IMD)",
+    "hh_total_cat": "Categorical household size",
+    "home_bin": "Binary care home status",
+    "region": "NHS England region",
+    "rural_urban5": "Rural Urban in five categories",
+}
+VALUE_LABELS = {
+    "cox_pop": {1: "N"},
+    "start_week": {49: "05Dec-11Dec", 50: "12Dec-18Dec", 51: "19Dec-25Dec", 52: "26Dec-01Jan"},
+    "male": {0: "F", 1: "M"},
+    "agegroup6": {0: "0-39", 1: "40-54", 2: "55-64", 3: "65-74", 4: "75-84", 5: "85+"},
+    "vax": {0: "Unvax", 1: "First dose", 2: "Second dose", 3: "Booster"},
+    "eth5": {1: "White", 2: "South Asian", 3: "Black", 4: "Mixed", 5: "Other", 6: "Missing"},
+    "obese4cat": {
+        1: "No record of obesity",
+        2: "Obese I (30-34.9)",
+        3: "Obese II (35-39.9)",
+        4: "Obese III (40+)",
+    },
+    "smoke_nomiss": {1: "Never", 2: "Former", 3: "Current"},
+    "comorb_cat": {0: "No comorbidity", 1: "1 comorbidity", 2: "2+ comorbidities"},
+    "imd": {1: "1 least deprived", 2: "2", 3: "3", 4: "4", 5: "5 most deprived"},
+    "hh_total_cat": {1: "1-2", 2: "3-5", 3: "6-10", 4: "11+", 5: "Missing"},
+    "home_bin": {0: "Private home", 1: "Care home"},
+    "region": {
+        0: "East",
+        1: "East Midlands",
+        2: "London",
+        3: "North East",
+        4: "North West",
+        5: "South East",
+        6: "South West",
+        7: "West Midlands",
+        8: "Yorkshire and the Humber",
+    },
+    "rural_urban5": {
+        1: "Urban major conurbation",
+        2: "Urban minor conurbation",
+        3: "Urban city and town",
+        4: "Rural town and fringe",
+        5: "Rural village and dispersed",
+        6: "Missing",
+    },
+}
+GROUPS = [(0, "S-Pos"), (1, "S-Fail")]
+
+# The figures, each series a tabulation and the group drawn (None for all)
+AE_DATE = Tabulation("ae_covid_date")
+FIGURES = [
+    Figure(
+        "time_ae_hist",
+        "histogram",
+        [Series("S-Pos", Tabulation("cox_ae_time"), 0), Series("S-Fail", Tabulation("cox_ae_time"), 1)],
+    ),
+    Figure(
+        "date_ae_hist",
+        "histogram",
+        [Series("sgtf==0", AE_DATE, 0), Series("any_ae==1 & sgtf==0", Tabulation("ae_covid_date", condition="any_ae"), 0)],
+    ),
+    Figure(
+        "date_ae_hist1",
+        "histogram",
+        [Series("sgtf==1", AE_DATE, 1), Series("any_ae==1 & sgtf==1", Tabulation("ae_covid_date", condition="any_ae"), 1)],
+    ),
+    Figure("ae_hist", "histogram", [Series("all", AE_DATE, None)]),
+    Figure(
+        "ae_kden",
+        "kdensity",
+        [Series(f"start_week=={week}", Tabulation("ae_covid_date", "start_week"), week) for week in range(49, 53)],
+    ),
+]
+TABULATIONS = list(
+    dict.fromkeys([Tabulation(variable) for variable, _ in TABLE1] + [series.tabulation for figure in FIGURES for series in figure.series])
+)
+
+
+# COUNTING
+def integer_codes(values):
+    # (distinct values, index of each value among them): the whole range for
+    # integers in a short one, as a bincount then needs no sort
+    low, high = values.min(), values.max()
+    if high - low < 100_000 and np.array_equal(values, np.round(values)):
+        return np.arange(low, high + 1), (values - low).astype(np.int64)
+    return np.unique(values, return_inverse=True)
+
+
+def value_counts(values, groups):
+    # {(group, value): records}, leaving out missing values and groups
+    present = ~(np.isnan(values) | np.isnan(groups))
+    if not present.any():
+        return {}
+    group_values, group_codes = integer_codes(groups[present])
+    distinct, codes = integer_codes(values[present])
+    counts = np.bincount(group_codes * len(distinct) + codes, minlength=len(group_values) * len(distinct))
+    g, v = np.nonzero(counts.reshape(len(group_values), len(distinct)))
+    return {
+        (float(group), float(value)): int(count)
+        for group, value, count in zip(group_values[g], distinct[v], counts[g * len(distinct) + v])
+    }
+
+
+class Table1Counts:
+    """Counts of each value of each tabulation by group, mergeable across batches and shards."""
+
+    def __init__(self, tabulations=TABULATIONS):
+        self.tabulations = tabulations
+        self.rows = 0
+        self.records = Counter()
+        self.counts = {tabulation: Counter() for tabulation in tabulations}
+
+    def add(self, columns):
+        self.rows += len(columns["sgtf"])
+        self.records.update(value_counts(columns["sgtf"], np.zeros(len(columns["sgtf"]))))
+        for tabulation in self.tabulations:
+            values = columns[tabulation.variable]
+            groups = columns[tabulation.by]
+            if tabulation.condition:
+                keep = columns[tabulation.condition] == 1
+                values, groups = values[keep], groups[keep]
+            self.counts[tabulation].update(value_counts(values, groups))
+        return self
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.records.update(other.records)
+        for tabulation in self.tabulations:
+            self.counts[tabulation].update(other.counts[tabulation])
+        return self
+
+    def total(self, group=None):
+        # Records in the group (an sgtf value), or all of them
+        if group is None:
+            return self.rows
+        return sum(n for (_, sgtf), n in self.records.items() if sgtf == group)
+
+    def values(self, tabulation, group=None):
+        # Counter of the tabulation's values in the group (or all groups)
+        counts = Counter()
+        for (g, value), n in self.counts[tabulation].items():
+            if group is None or g == group:
+                counts[value] += n
+        return counts
+
+
+# READING
+def chunk_columns(chunk):
+    # The columns of a chunk (CohortArrays) as floats (NaN for missing, dates
+    # as days), with an_table1.do's restrictions
+    week = chunk.floats("start_week")
+    keep = (
+        ~chunk.missing("utla_group")
+        & (chunk.floats("has_sgtf") != 0)
+        & (chunk.floats("cox_pop") == 1)
+        & (week >= STUDY_WEEKS[0])
+        & (week <= STUDY_WEEKS[1])
+    )
+    chunk = chunk.take(keep)
+    columns = {column.name: chunk.floats(column.name) for column in chunk.schema if column.name != "utla_group"}
+    for name, level in MISSING_LEVELS.items():
+        columns[name] = np.where(np.isnan(columns[name]), level, columns[name])
+    return columns
+
+
+def count_file(path, batch_size=BATCH_SIZE):
+    names = [variable for variable, _ in TABLE1]
+    names += [name for tabulation in TABULATIONS for name in tabulation if name]
+    names += ["sgtf", "has_sgtf", "cox_pop", "start_week", "utla_group"]
+    counts = Table1Counts()
+    for chunk in cohort_chunks(path, set(names), batch_size):
+        counts.add(chunk_columns(chunk))
+    return counts
+
+
+def count_files(paths, batch_size=BATCH_SIZE, workers=1):
+    if workers == 1 or len(paths) == 1:
+        parts = [count_file(path, batch_size) for path in paths]
+    else:
+        with ProcessPoolExecutor(min(workers, len(paths))) as pool:
+            parts = list(pool.map(partial(count_file, batch_size=batch_size), paths))
+    counts = Table1Counts()
+    for part in parts:
+        counts.merge(part)
+    return counts
+
+
+# SUMMARIES
+Summary = namedtuple("Summary", "n mean sd p25 p50 p75 low high")
+
+
+def weighted(counts):
+    # The distinct values in order and their counts, so that sums come out
+    # the same however the counts were merged
+    values = np.array(sorted(counts), dtype=float)
+    return values, np.array([counts[value] for value in values], dtype=float)
+
+
+def summarize(counts):
+    # summarize, detail from a Counter of values
+    n = sum(counts.values())
+    if n == 0:
+        return Summary(0, *[np.nan] * 7)
+    values, weights = weighted(counts)
+    mean = weights @ values / n
+    sd = np.sqrt(weights @ (values - mean) ** 2 / (n - 1)) if n > 1 else np.nan
+    p25, p50, p75 = (stata_percentile(counts, p) for p in (25, 50, 75))
+    return Summary(n, mean, sd, p25, p50, p75, values.min(), values.max())
+
+
+def histogram(counts):
+    # histogram's default bins: min(sqrt(N), 10 log10(N)) of them from the
+    # smallest value to the largest, as (start, end, frequency, density)
+    summary = summarize(counts)
+    if summary.n == 0:
+        return []
+    bins = max(int(min(np.sqrt(summary.n), 10 * np.log10(summary.n))), 1)
+    width = (summary.high - summary.low) / bins or 1
+    values, weights = weighted(counts)
+    index = np.minimum(((values - summary.low) / width).astype(np.int64), bins - 1)
+    frequency = np.bincount(index, weights, bins)
+    starts = summary.low + width * np.arange(bins)
+    return [
+        (start, start + width, int(f), f / (summary.n * width))
+        for start, f in zip(starts, frequency)
+    ]
+
+
+def kdensity(counts, points=50):
+    # kdensity's defaults: the Epanechnikov kernel with the "optimal" width
+    # 0.9 min(SD, IQR / 1.349) / N^(1/5), at equally spaced points over the
+    # range of the values, as (point, density)
+    summary = summarize(counts)
+    if summary.n < 2:
+        return []
+    spread = min(summary.sd, (summary.p75 - summary.p25) / 1.349) or summary.sd
+    width = 0.9 * spread / summary.n ** 0.2
+    values, weights = weighted(counts)
+    grid = np.linspace(summary.low, summary.high, min(points, summary.n))
+    z = (grid[:, None] - values[None, :]) / width
+    kernel = np.where(z * z < 5, 0.75 * (1 - z * z / 5) / np.sqrt(5), 0)
+    return list(zip(grid, kernel @ weights / (summary.n * width)))
+
+
+# TABLE 1
+def number(value, format):
+    return "." if np.isnan(value) else f"{value:{format}}"
+
+
+def count_cell(count, denominator):
+    # %9.0gc (count) " (" %3.1f (percent) ")"
+    percent = 100 * count / denominator if denominator else np.nan
+    return f"{count:>9,} ({number(percent, '3.1f')})"
+
+
+def table1(counts):
+    columns = [None] + [group for group, _ in GROUPS]
+    lines = ["Table 1: Demographic and Clinical Characteristics"]
+    lines += ["\t" + "\t".join(["Total"] + [label for _, label in GROUPS])]
+    for variable, levels in TABLE1:
+        lines.append(VARIABLE_LABELS[variable])
+        tabulation = Tabulation(variable)
+        if levels is None:
+            summaries = [summarize(counts.values(tabulation, group)) for group in columns]
+            cells = [f"{number(s.mean, '3.1f')} ({number(s.sd, '3.1f')})" for s in summaries]
+            lines.append("\t".join(["Mean (SD)"] + cells) + "\t")
+            cells = [f"{number(s.p50, '3.1f')} ({number(s.p25, '3.1f')}-{number(s.p75, '3.1f')})" for s in summaries]
+            lines.append("\t".join(["Median (IQR)"] + cells) + "\t")
+        else:
+            tallies = [counts.values(tabulation, group) for group in columns]
+            for level in levels:
+                label = VALUE_LABELS.get(variable, {}).get(level, str(level))
+                cells = [count_cell(tally[level], counts.total(group)) for tally, group in zip(tallies, columns)]
+                lines.append("\t".join([f" {label}"] + cells) + "\t")
+        lines.append("")
+    return "\n".join(lines) + "\n\n\n"
+
+
+def figure_rows(counts):
+    rows = []
+    for figure in FIGURES:
+        for series in figure.series:
+            values = counts.values(series.tabulation, series.group)
+            if figure.kind == "histogram":
+                rows += [[figure.name, series.label, start, end, frequency, density] for start, end, frequency, density in histogram(values)]
+            else:
+                rows += [[figure.name, series.label, point, point, "", density] for point, density in kdensity(values)]
+    return rows
+
+
+def write_xlsx(path, rows):
+    # A workbook of one sheet holding rows of text, written directly as
+    # SpreadsheetML
+    def cell(column, row, text):
+        reference = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"[column] + str(row)
+        return f'<c r="{reference}" t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+    sheet_rows = "".join(
+        f'<row r="{i}">' + "".join(cell(j, i, text) for j, text in enumerate(row) if text) + "</row>"
+        for i, row in enumerate(rows, 1)
+    )
+    main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    package = "http://schemas.openxmlformats.org/package/2006/relationships"
+    parts = {
+        "[Content_Types].xml": (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            "</Types>"
+        ),
+        "_rels/.rels": (
+            f'<Relationships xmlns="{package}"><Relationship Id="rId1" '
+            f'Type="{relationships}/officeDocument" Target="xl/workbook.xml"/></Relationships>'
+        ),
+        "xl/workbook.xml": (
+            f'<workbook xmlns="{main}" xmlns:r="{relationships}"><sheets>'
+            '<sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ),
+        "xl/_rels/workbook.xml.rels": (
+            f'<Relationships xmlns="{package}"><Relationship Id="rId1" '
+            f'Type="{relationships}/worksheet" Target="worksheets/sheet1.xml"/></Relationships>'
+        ),
+        "xl/worksheets/sheet1.xml": f'<worksheet xmlns="{main}"><sheetData>{sheet_rows}</sheetData></worksheet>',
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, xml in parts.items():
+            archive.writestr(name, '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' + xml)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", nargs="+", default=["output/main.parquet"], help="the cohort, or shards of it")
+    parser.add_argument("--output", default="output/table1_py.txt")
+    parser.add_argument("--xlsx", default="output/table1_py.xlsx")
+    parser.add_argument("--figures", default="output/table1_figures_py.csv")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = count_files(options.input, options.batch_size, options.workers)
+    print(f"Counted {counts.total()} records in {time.perf_counter() - start:.1f}s")
+
+    text = table1(counts)
+    with open(options.output, "w") as f:
+        f.write(text)
+    write_xlsx(options.xlsx, [line.split("\t") for line in text.split("\n")])
+    with open(options.figures, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["figure", "series", "start", "end", "frequency", "density"])
+        writer.writerows(figure_rows(counts))
+    print(f"Wrote {options.output}, {options.xlsx} and {options.figures}")
+
+
+if __name__ == "__main__":
+    main()
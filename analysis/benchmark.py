@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+
+
+# BENCHMARKS
+# Times the Python stages of the pipeline on synthetic cohorts and compares
+# them with a stored baseline:
+#   study_definition   importing analysis/study_definition.py
+#   codelists_cold     loading every codelist in codelists.py with an empty
+#                      compiled codelist cache
+#   codelists_warm     the same with the cache already built
+#   dict_msoa          building dict_msoa and using it as the msoa ratios
+#   convert            output/input.csv -> input.parquet (cr_columnar.py)
+#   msoa_join          attaching UTLAs to a column of MSOA codes
+#   cohort_prep        output/input.csv -> main.parquet (cr_main.py)
+#   date_expressions   every relative date of the study over an anchor column
+#                      (date_expressions.py)
+#   iso_days           reading a column of YYYY-MM-DD strings as day numbers
+#   stset              survival columns, stset and a split at 7, 14 and 28
+#                      days over synthetic dates (stset.py)
+#   codelist_matching  matching a dictionary encoded stream of CTV3 codes, one
+#                      per patient, against every codelist of the study
+#                      (codelist_matcher.py)
+#   categorised_as     the study's categorised_as variables (compiled by
+#                      category_expressions.py) over the columns extracted
+#                      from a local database (sqlite_backend.py), repeated to
+#                      the cohort's size
+# The stages from convert on run once per cohort size. The synthetic cohorts come from
+# dummy_data.py with a fixed seed, so every run sees the same input; they are
+# kept in output/benchmarks/inputs and only generated once, as is the local
+# database.
+#
+# Every stage runs in a fresh Python process (best of --repeat runs), which
+# reports the stage's wall time and the process's peak resident memory.
+BENCHMARK_DIR = "output/benchmarks"
+BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+SEED = 2022
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+DATABASE_PATIENTS = 10_000
+# Differences in time smaller than this are noise, whatever the ratio
+MIN_SECONDS = 0.05
+
+STARTUP_STAGES = ["study_definition", "codelists_cold", "codelists_warm", "dict_msoa"]
+COHORT_STAGES = ["convert", "msoa_join", "cohort_prep", "date_expressions", "iso_days", "stset", "codelist_matching", "categorised_as"]
+
+
+def input_path(rows):
+    return os.path.join(BENCHMARK_DIR, "inputs", f"input_{rows}_{SEED}.csv")
+
+
+def ensure_input(rows):
+    path = input_path(rows)
+    if not os.path.exists(path):
+        from dummy_data import write_dummy_cohort
+        from study_definition import study
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.csv"
+        write_dummy_cohort(study, tmp_path, rows, seed=SEED)
+        os.replace(tmp_path, path)
+    return path
+
+
+def ensure_database():
+    path = os.path.join(BENCHMARK_DIR, "inputs", f"local_ehr_{DATABASE_PATIENTS}_{SEED}.sqlite")
+    if not os.path.exists(path):
+        from sqlite_backend import make_database
+        from study_definition import study
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        make_database(path + ".tmp", study, DATABASE_PATIENTS, SEED)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+# STAGES
+# Each does its setup, then returns the seconds taken by the part measured
+def stage_study_definition(rows):
+    start = time.perf_counter()
+    import study_definition  # noqa: F401
+
+    return time.perf_counter() - start
+
+
+def stage_codelists(rows):
+    import cohortextractor  # noqa: F401
+
+    start = time.perf_counter()
+    import codelists
+
+    for name in codelists.__all__:
+        getattr(codelists, name)
+    return time.perf_counter() - start
+
+
+def stage_dict_msoa(rows):
+    from cohortextractor.study_definition import merge
+
+    start = time.perf_counter()
+    from dictionaries import dict_msoa
+
+    # What cohortextractor does with it: merge the expectations, then check
+    # and sample the categories
+    expectations = merge({}, {"category": {"ratios": dict_msoa}})
+    ratios = expectations["category"]["ratios"]
+    set(ratios.keys())
+    list(ratios.values())
+    return time.perf_counter() - start
+
+
+def stage_convert(rows):
+    from cohort_schema import study_schema
+    from cr_columnar import convert
+
+    path = input_path(rows)
+    columns = study_schema()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        convert(path, os.path.join(tmp_dir, "input.parquet"), columns)
+        return time.perf_counter() - start
+
+
+def stage_msoa_join(rows):
+    from msoa_lookup import join_utla, msoa_utla_index
+
+    rng = np.random.default_rng(SEED)
+    msoas = rng.choice(msoa_utla_index().msoas, rows).astype(object)
+    msoas[rng.random(rows) < 0.05] = None
+    start = time.perf_counter()
+    join_utla(msoas)
+    return time.perf_counter() - start
+
+
+def stage_cohort_prep(rows):
+    from cr_main import prepare
+
+    path = input_path(rows)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        prepare(path, os.path.join(tmp_dir, "main.parquet"))
+        return time.perf_counter() - start
+
+
+def synthetic_dates(rows):
+    # Days from 2019 to 2022, a tenth of them missing
+    from date_expressions import EPOCH
+
+    rng = np.random.default_rng(SEED)
+    dates = EPOCH + rng.integers(18_000, 19_000, rows).astype("timedelta64[D]")
+    dates[rng.random(rows) < 0.1] = np.datetime64("NaT")
+    return dates
+
+
+def stage_date_expressions(rows):
+    from date_expressions import Anchor, date_anchor, evaluate_date, parse_date
+    from study_definition import study
+    from study_graph import argument_dates
+
+    # Every relative date in the study, each anchor a column of random dates
+    names = set(study.covariate_definitions)
+    expressions = []
+    for _, args in study.covariate_definitions.values():
+        for value in args.values():
+            for expression in argument_dates(value):
+                relative = not isinstance(parse_date(expression), Anchor)
+                if relative and date_anchor(expression) in names and expression not in expressions:
+                    expressions.append(expression)
+    dates = synthetic_dates(rows)
+    columns = {date_anchor(expression): dates for expression in expressions}
+    start = time.perf_counter()
+    for expression in expressions:
+        evaluate_date(expression, columns)
+    return time.perf_counter() - start
+
+
+def stage_iso_days(rows):
+    from date_expressions import iso_days
+
+    dates = synthetic_dates(rows)
+    text = np.where(np.isnat(dates), "", dates.astype(str)).astype(object)
+    # The first call also initialises pyarrow's compute functions
+    iso_days(text[:1])
+    start = time.perf_counter()
+    iso_days(text)
+    return time.perf_counter() - start
+
+
+def stage_stset(rows):
+    from stset import SETUPS, EpisodeColumns, Episodes, stset, survival_columns
+
+    rng = np.random.default_rng(SEED)
+    study_start = rng.integers(22600, 22650, rows).astype(float)
+    ae_covid_date = np.where(rng.random(rows) < 0.05, study_start + rng.integers(0, 60, rows), np.nan)
+    died_date_ons = np.where(rng.random(rows) < 0.01, study_start + rng.integers(0, 90, rows), np.nan)
+    ae_admit = np.where(np.isnan(ae_covid_date), np.nan, rng.random(rows) < 0.3)
+    columns = {"study_start": study_start, "sgtf": (rng.random(rows) < 0.5).astype(float)}
+    start = time.perf_counter()
+    columns.update(survival_columns(study_start, ae_covid_date, died_date_ons, 22700.0, ae_admit))
+    episodes = Episodes(stset(columns, SETUPS["ae"]), [7, 14, 28])
+    EpisodeColumns(columns, episodes)["sgtf"]
+    return time.perf_counter() - start
+
+
+def stage_codelist_matching(rows):
+    from codelist_matcher import study_matchers
+    from study_definition import study
+
+    # Codes drawn from the lists and from a thousand codes in none of them
+    matcher = study_matchers(study.covariate_definitions)[0]["ctv3"]
+    rng = np.random.default_rng(SEED)
+    unknown = np.char.add(b"Z", rng.integers(0, 10_000, 1000).astype("S4"))
+    vocabulary = np.concatenate([matcher.codes, unknown]).astype(str)
+    codes = pa.DictionaryArray.from_arrays(rng.integers(0, len(vocabulary), rows).astype(np.int32), vocabulary)
+    start = time.perf_counter()
+    matcher.masks(codes)
+    return time.perf_counter() - start
+
+
+def stage_categorised_as(rows):
+    from category_expressions import compiled
+    from extract_scheduler import extract_serial, merge_columns
+    from sqlite_backend import SQLiteBackend
+    from study_definition import study
+    from study_graph import VariableGraph
+
+    backend = SQLiteBackend(ensure_database(), study)
+    columns = merge_columns(extract_serial(VariableGraph.from_study(study), backend))
+    index = np.arange(rows) % backend.rows
+    variables = []
+    for funcname, args in study.covariate_definitions.values():
+        if funcname == "categorised_as":
+            expressions = compiled(args["category_definitions"])
+            used = {}
+            for name in expressions.names:
+                values = columns[name]
+                used[name] = values.take(pa.array(index)) if isinstance(values, pa.Array) else values[index]
+            variables.append((expressions, used))
+    start = time.perf_counter()
+    for expressions, used in variables:
+        expressions.evaluate(used, rows)
+    return time.perf_counter() - start
+
+
+STAGES = {
+    "study_definition": stage_study_definition,
+    "codelists_cold": stage_codelists,
+    "codelists_warm": stage_codelists,
+    "dict_msoa": stage_dict_msoa,
+    "convert": stage_convert,
+    "msoa_join": stage_msoa_join,
+    "cohort_prep": stage_cohort_prep,
+    "date_expressions": stage_date_expressions,
+    "iso_days": stage_iso_days,
+    "stset": stage_stset,
+    "codelist_matching": stage_codelist_matching,
+    "categorised_as": stage_categorised_as,
+}
+
+
+def peak_memory_mb():
+    # VmHWM starts afresh in each process; ru_maxrss on Linux carries over the
+    # peak of the parent that started it
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(stage, rows):
+    # In this process; prints the measurement for run_isolated to read
+    seconds = STAGES[stage](rows)
+    print(json.dumps({"seconds": seconds, "peak_mb": peak_memory_mb()}))
+
+
+def run_isolated(stage, rows, repeat, cache_dir):
+    env = dict(os.environ)
+    env["CODELIST_CACHE_DIR"] = os.path.join(cache_dir, "warm")
+    runs = []
+    for _ in range(repeat):
+        if stage == "codelists_cold":
+            env["CODELIST_CACHE_DIR"] = tempfile.mkdtemp(dir=cache_dir)
+        output = subprocess.run(
+            [sys.executable, __file__, "--stage", stage, "--rows", str(rows)],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "seconds": min(run["seconds"] for run in runs),
+        "peak_mb": max(run["peak_mb"] for run in runs),
+    }
+
+
+def run_benchmarks(sizes, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Build the warm codelist cache once
+        run_isolated("codelists_warm", 0, 1, cache_dir)
+        for stage in STARTUP_STAGES:
+            results[stage] = run_isolated(stage, 0, repeat, cache_dir)
+            report_line(stage, results[stage])
+        for size in sizes:
+            rows = SIZES[size]
+            ensure_input(rows)
+            for stage in COHORT_STAGES:
+                key = f"{stage}@{size}"
+                results[key] = run_isolated(stage, rows, repeat, cache_dir)
+                report_line(key, results[key])
+    return results
+
+
+# COMPARISON
+def report_line(key, result):
+    print(f"{key:<22} {result['seconds']:9.3f}s {result['peak_mb']:9.1f} MB", flush=True)
+
+
+def compare(results, baseline, tolerance):
+    # Regressions: slower or bigger than the baseline by more than tolerance
+    regressions = []
+    print(f"\n{'stage':<22} {'seconds':>9} {'baseline':>9} {'ratio':>6} {'peak MB':>9} {'baseline':>9}")
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"{key:<22} {result['seconds']:9.3f} {'-':>9} {'-':>6} {result['peak_mb']:9.1f} {'-':>9}")
+            continue
+        before = baseline[key]
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance and result["seconds"] - before["seconds"] > MIN_SECONDS:
+            flag = "  SLOWER"
+            regressions.append(key)
+        if result["peak_mb"] > before["peak_mb"] * (1 + tolerance):
+            flag += "  MORE MEMORY"
+            regressions.append(key)
+        print(
+            f"{key:<22} {result['seconds']:9.3f} {before['seconds']:9.3f} {ratio:6.2f} "
+            f"{result['peak_mb']:9.1f} {before['peak_mb']:9.1f}{flag}"
+        )
+    return sorted(set(regressions))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10k", help=f"comma separated, from {', '.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--stage", choices=sorted(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, default=0, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.stage:
+        run_stage(options.stage, options.rows)
+        return
+
+    sizes = options.sizes.split(",")
+    for size in sizes:
+        if size not in SIZES:
+            parser.error(f"Unknown size {size}")
+    results = run_benchmarks(sizes, options.repeat)
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    with open(os.path.join(BENCHMARK_DIR, "latest.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    if options.save_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {options.baseline}")
+        return
+    if not os.path.exists(options.baseline):
+        print(f"No baseline at {options.baseline}; run with --save-baseline to store one")
+        return
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, options.tolerance)
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
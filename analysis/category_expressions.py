@@ -0,0 +1,337 @@
+import re
+from collections import namedtuple
+from functools import lru_cache, reduce
+
+import numpy as np
+import pyarrow as pa
+
+
+# CATEGORY EXPRESSIONS
+# The expressions of categorised_as, satisfying and care_home_status_as_of
+# ("most_recent_smoking_code = 'N' AND NOT ever_smoked",
+# "prednisolone_last_year > 0 AND prednisolone_last_year < 5") parsed once
+# into a small syntax tree and compiled into functions of whole columns, so
+# a category is a handful of numpy operations over every patient rather than
+# an expression interpreted per patient.
+#
+# The grammar is the part of cohortextractor's (SQL's) that study
+# definitions use:
+#   expression  := and ("OR" and)*
+#   and         := not ("AND" not)*
+#   not         := "NOT" not | comparison
+#   comparison  := operand (("=" | "!=" | "<>" | "<" | "<=" | ">" | ">=") operand)?
+#   operand     := name | number | 'string' | "(" expression ")"
+# As in SQL's three-valued logic, a comparison with a missing number or date
+# is unknown, and so is its NOT; unknown AND false is false, unknown OR true
+# is true, and an expression that is unknown does not hold. A missing category is '' (as cohortextractor stores it), and a bare name is
+# true where its value is non-zero (non-empty for a category, present for a
+# date). Categories are taken in definition order, the first whose
+# expression holds winning, and patients matching none get the DEFAULT
+# category (missing if there is none), as in cohortextractor's CASE.
+Name = namedtuple("Name", "name")
+Literal = namedtuple("Literal", "value")
+Compare = namedtuple("Compare", "op left right")
+Not = namedtuple("Not", "operand")
+And = namedtuple("And", "operands")
+Or = namedtuple("Or", "operands")
+
+TOKEN = re.compile(
+    r"\s*(?:(?P<number>\d+(?:\.\d*)?)|'(?P<string>[^']*)'|(?P<op><=|>=|!=|<>|=|<|>)"
+    r"|(?P<paren>[()])|(?P<word>[A-Za-z_]\w*))"
+)
+KEYWORDS = {"AND", "OR", "NOT"}
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<>": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+# PARSING
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(f"Unexpected '{expression[position:].strip()[:20]}' in expression '{expression.strip()}'")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "word" and text.upper() in KEYWORDS:
+            kind, text = "keyword", text.upper()
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """A recursive descent parser over the tokens of one expression."""
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind, text=None):
+        token = self.peek()
+        if token[0] != kind or (text is not None and token[1] != text):
+            return None
+        self.position += 1
+        return token[1]
+
+    def error(self, expected):
+        found = self.peek()[1]
+        found = "the end" if found is None else f"'{found}'"
+        return ValueError(f"Expected {expected} but found {found} in expression '{self.expression}'")
+
+    def parse(self):
+        node = self.disjunction()
+        if self.position != len(self.tokens):
+            raise self.error("AND, OR or the end")
+        return node
+
+    def disjunction(self):
+        operands = [self.conjunction()]
+        while self.take("keyword", "OR"):
+            operands.append(self.conjunction())
+        return operands[0] if len(operands) == 1 else Or(tuple(operands))
+
+    def conjunction(self):
+        operands = [self.negation()]
+        while self.take("keyword", "AND"):
+            operands.append(self.negation())
+        return operands[0] if len(operands) == 1 else And(tuple(operands))
+
+    def negation(self):
+        if self.take("keyword", "NOT"):
+            return Not(self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.operand()
+        op = self.take("op")
+        if op is None:
+            return left
+        return Compare(op, left, self.operand())
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == "paren" and text == "(":
+            self.position += 1
+            node = self.disjunction()
+            if not self.take("paren", ")"):
+                raise self.error("')'")
+            return node
+        if kind == "word":
+            self.position += 1
+            return Name(text)
+        if kind == "number":
+            self.position += 1
+            return Literal(float(text) if "." in text else int(text))
+        if kind == "string":
+            self.position += 1
+            return Literal(text)
+        raise self.error("a name, number or string")
+
+
+@lru_cache(maxsize=None)
+def parse_expression(expression):
+    return Parser(expression).parse()
+
+
+def names_in(node):
+    if isinstance(node, Name):
+        return {node.name}
+    if isinstance(node, Literal):
+        return set()
+    if isinstance(node, Compare):
+        return names_in(node.left) | names_in(node.right)
+    if isinstance(node, Not):
+        return names_in(node.operand)
+    return set().union(*(names_in(operand) for operand in node.operands))
+
+
+# COMPILING
+# A compiled node is a function of {name: column} returning arrays over the
+# patients: operands (values, missing), conditions (true, unknown)
+def column_operand(values):
+    # (values, missing) for a column as the backends return them: categories
+    # as dictionary arrays, dates as datetime64 with NaT, the rest numpy
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+        if pa.types.is_dictionary(values.type):
+            dictionary = values.dictionary.to_numpy(zero_copy_only=False).astype(object)
+            indices = values.indices.fill_null(len(dictionary)).to_numpy(zero_copy_only=False)
+            # Missing categories are "", as in cohortextractor's expressions
+            return np.append(dictionary, "")[indices], np.zeros(len(indices), dtype=bool)
+        values = values.to_numpy(zero_copy_only=False)
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[D]").astype(np.int64), np.isnat(values)
+    if values.dtype.kind == "f":
+        return values, np.isnan(values)
+    if values.dtype.kind in "OUS":
+        values = values.astype(object)
+        values[np.equal(values, None)] = ""
+        return values, np.zeros(len(values), dtype=bool)
+    return values.astype(np.int64) if values.dtype.kind == "b" else values, np.zeros(len(values), dtype=bool)
+
+
+def literal_like(value, values):
+    # A literal compared with a column takes the column's type: '1' against
+    # a number is 1, and 1 against a category is '1'
+    if values.dtype.kind == "O":
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"Cannot compare a numeric column with '{value}'")
+    return value
+
+
+def dictionary_comparison(values, compare, literal):
+    # A category compared with a literal, for each distinct category rather
+    # than each patient; None for other columns. Never unknown, as a missing
+    # category is ''
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if not (isinstance(values, pa.Array) and pa.types.is_dictionary(values.type)):
+        return None
+    dictionary = np.append(values.dictionary.to_numpy(zero_copy_only=False).astype(object), "")
+    holds = np.asarray(compare(dictionary, literal_like(literal, dictionary)), dtype=bool)
+    return holds[values.indices.fill_null(len(dictionary) - 1).to_numpy(zero_copy_only=False)]
+
+
+def compile_operand(node):
+    if isinstance(node, Name):
+        return lambda columns: column_operand(columns[node.name])
+    if isinstance(node, Literal):
+        return lambda columns: (node.value, False)
+    condition = compile_condition(node)
+
+    def evaluate(columns):
+        true, unknown = condition(columns)
+        return np.asarray(true, dtype=np.int64), unknown
+
+    return evaluate
+
+
+def compile_comparison(node):
+    compare = COMPARISONS[node.op]
+    left, right = compile_operand(node.left), compile_operand(node.right)
+
+    def evaluate(columns):
+        if isinstance(node.left, Name) and isinstance(node.right, Literal):
+            holds = dictionary_comparison(columns[node.left.name], compare, node.right.value)
+            if holds is not None:
+                return holds, np.False_
+        left_values, left_missing = left(columns)
+        right_values, right_missing = right(columns)
+        if isinstance(node.left, Literal) and isinstance(right_values, np.ndarray):
+            left_values = literal_like(left_values, right_values)
+        if isinstance(node.right, Literal) and isinstance(left_values, np.ndarray):
+            right_values = literal_like(right_values, left_values)
+        unknown = np.asarray(left_missing | right_missing, dtype=bool)
+        return np.asarray(compare(left_values, right_values), dtype=bool) & ~unknown, unknown
+
+    return evaluate
+
+
+def compile_condition(node):
+    if isinstance(node, Compare):
+        return compile_comparison(node)
+    if isinstance(node, Not):
+        operand = compile_condition(node.operand)
+
+        def negation(columns):
+            true, unknown = operand(columns)
+            return ~true & ~unknown, unknown
+
+        return negation
+    if isinstance(node, (And, Or)):
+        operands = [compile_condition(operand) for operand in node.operands]
+        # OR is true if any operand is and false if all are; AND the reverse
+        either, both = (np.logical_or, np.logical_and) if isinstance(node, Or) else (np.logical_and, np.logical_or)
+
+        def combination(columns):
+            results = [operand(columns) for operand in operands]
+            true = reduce(either, [true for true, _ in results])
+            false = reduce(both, [~true & ~unknown for true, unknown in results])
+            return true, ~true & ~false
+
+        return combination
+
+    operand = compile_operand(node)
+
+    def truth(columns):
+        values, missing = operand(columns)
+        if isinstance(values, np.ndarray) and values.dtype.kind == "O":
+            return (values != "") & (values != "0"), np.False_
+        return np.asarray((values != 0) & ~missing, dtype=bool), missing
+
+    return truth
+
+
+@lru_cache(maxsize=None)
+def compile_expression(expression):
+    # A function of {name: column} giving whether the expression holds for
+    # each patient: it is true, rather than false or unknown
+    condition = compile_condition(parse_expression(expression))
+    return lambda columns: condition(columns)[0]
+
+
+class CategoryExpressions:
+    """The {category: expression} of a categorised_as, compiled."""
+
+    def __init__(self, definitions):
+        self.categories = []
+        self.conditions = []
+        self.default = None
+        names = set()
+        for category, expression in definitions.items():
+            if expression.strip() == "DEFAULT":
+                self.default = category
+                continue
+            self.categories.append(category)
+            self.conditions.append(compile_expression(expression))
+            names |= names_in(parse_expression(expression))
+        self.names = tuple(sorted(names))
+
+    def codes(self, columns, rows):
+        # Each patient's category as an index into self.categories, with
+        # len(self.categories) for the default
+        choice = np.full(rows, len(self.categories), dtype=np.int64)
+        undecided = np.ones(rows, dtype=bool)
+        for code, condition in enumerate(self.conditions):
+            holds = np.broadcast_to(condition(columns), rows) & undecided
+            choice[holds] = code
+            undecided &= ~holds
+        return choice
+
+    def evaluate(self, columns, rows):
+        # Each patient's category, None where no expression holds and there
+        # is no DEFAULT
+        return np.array(self.categories + [self.default], dtype=object)[self.codes(columns, rows)]
+
+
+@lru_cache(maxsize=None)
+def category_expressions(definitions):
+    # Memoized on the definitions as a tuple of (category, expression) pairs
+    return CategoryExpressions(dict(definitions))
+
+
+def compiled(definitions):
+    return category_expressions(tuple(definitions.items()))
+
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+from cohortextractor import codelist, codelist_from_csv
+
+
+# COMPILED CODELIST CACHE
+# The first time a codelist is used its CSV is parsed into numpy arrays (one
+# for the codes and one per category column), in the CSV's order and with
+# any repeated codes kept, so they give back exactly what
+# codelist_from_csv does. They are saved as .npy files under a directory
+# named after the sha1 of the CSV's contents, the sha codelists.json records
+# for a download. Later runs load those arrays instead of re-parsing the
+# CSV; a new download, or a local edit, changes the sha and so the
+# directory, and the CSV is parsed again. The directories sit under one for
+# the cache's format, which changes whenever the arrays would, so arrays an
+# earlier version wrote are not read back.
+#
+# The sha of each CSV is kept in index.json beside them, with the CSV's size
+# and mtime, and reused while those are unchanged (as run_project.py does
+# for its file hashes), so a warm run reads no CSV at all. The arrays are
+# memory-mapped rather than read.
+CACHE_DIR = os.environ.get("CODELIST_CACHE_DIR", "codelists/.cache")
+CACHE_FORMAT = "v2"
+
+_index = None
+
+
+def index_path():
+    return os.path.join(CACHE_DIR, CACHE_FORMAT, "index.json")
+
+
+def read_index():
+    global _index
+    if _index is None:
+        try:
+            with open(index_path()) as f:
+                _index = json.load(f)
+        except (OSError, ValueError):
+            _index = {}
+    return _index
+
+
+def write_index(index):
+    # Replaced whole, so jobs sharing the cache never read half an index; an
+    # entry another job adds at the same time may be lost, and is hashed again
+    path = index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+
+@lru_cache(maxsize=None)
+def _file_sha(path, size, mtime_ns):
+    index = read_index()
+    known = index.get(path)
+    if known is not None and known[:2] == [size, mtime_ns]:
+        return known[2]
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    index[path] = [size, mtime_ns, digest.hexdigest()]
+    try:
+        write_index(index)
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+
+def file_sha(path):
+    # Hashed again whenever the file's size or mtime changes
+    stat = os.stat(path)
+    return _file_sha(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_paths(sha, column, category_column=None):
+    name = column if category_column is None else f"{column}.{category_column}"
+    directory = os.path.join(CACHE_DIR, CACHE_FORMAT, sha)
+    return (
+        os.path.join(directory, f"{name}.codes.npy"),
+        os.path.join(directory, f"{name}.categories.npy"),
+    )
+
+
+def encode(strings):
+    return np.char.encode(np.array(strings, dtype=str), "utf-8")
+
+
+def compile_csv(filename, column, category_column=None):
+    # Same parsing rules as cohortextractor's codelist_from_csv
+    codes = codelist_from_csv(filename, system=None, column=column,
+                              category_column=category_column)
+    if category_column:
+        return encode([code for code, _ in codes]), encode([category for _, category in codes])
+    return encode(codes), None
+
+
+def write_cache(sha, column, category_column, code_array, category_array):
+    # Write into a temporary directory and move each file into place, so that
+    # jobs sharing the cache never see a half written array
+    codes_path, categories_path = cache_paths(sha, column, category_column)
+    target_dir = os.path.dirname(codes_path)
+    os.makedirs(target_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=target_dir)
+    try:
+        if category_column:
+            tmp_file = os.path.join(tmp_dir, "categories.npy")
+            np.save(tmp_file, category_array)
+            os.replace(tmp_file, categories_path)
+        # The codes file is written last, as its presence marks a complete entry
+        tmp_file = os.path.join(tmp_dir, "codes.npy")
+        np.save(tmp_file, code_array)
+        os.replace(tmp_file, codes_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_cache(sha, column, category_column=None):
+    codes_path, categories_path = cache_paths(sha, column, category_column)
+    try:
+        code_array = np.load(codes_path, mmap_mode="r")
+        if category_column is None:
+            return code_array, None
+        category_array = np.load(categories_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if len(code_array) != len(category_array):
+        return None
+    return code_array, category_array
+
+
+def load_arrays(filename, column, category_column=None):
+    # Code array (and aligned category array) for one codelist column
+    sha = file_sha(filename)
+    cached = read_cache(sha, column, category_column)
+    if cached is not None:
+        return cached
+
+    code_array, category_array = compile_csv(filename, column, category_column)
+    try:
+        write_cache(sha, column, category_column, code_array, category_array)
+    except OSError:
+        # A read-only checkout still works, it just re-parses every time
+        pass
+    return code_array, category_array
+
+
+def cached_codelist_from_csv(filename, system, column="code", category_column=None):
+    code_array, category_array = load_arrays(filename, column, category_column)
+    codes = np.char.decode(code_array, "utf-8").tolist()
+    if category_column:
+        categories = np.char.decode(category_array, "utf-8").tolist()
+        result = codelist(list(zip(codes, categories)), system)
+    else:
+        result = codelist(codes, system)
+    # Which CSV contents the codes came from, so that caches of extracted
+    # variables can key on the sha instead of hashing every code
+    result.source = (file_sha(filename), column, category_column)
+    return result
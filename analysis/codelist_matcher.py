@@ -0,0 +1,150 @@
+import numpy as np
+import pyarrow as pa
+
+from codelist_cache import encode
+from query_plan import frozen
+
+
+# MATCHING EVENTS AGAINST EVERY CODELIST AT ONCE
+# The study's variables use about 30 distinct codelists (combined and
+# filtered lists included), nearly all CTV3. Rather than scanning the event
+# stream once per list, each coding system's lists are compiled into one
+# sorted table of every code they contain, with a bitset per code of the
+# lists it belongs to (bit i for list i). Tagging a stream of events is then
+# one binary search per event (or per distinct code, for a dictionary
+# encoded stream), after which membership of any list is a bit test.
+#
+# Lists with categories (ethnicity, smoking) also keep each code's category,
+# as an index into the list's categories. With prefix=True a code matches
+# every table code it starts with, as ICD-10 codes are matched on death
+# certificates and hospital diagnoses; the table is searched at each code
+# length in it, which walks the same path a prefix trie would.
+def code_and_category(item):
+    return item if isinstance(item, tuple) else (item, None)
+
+
+def study_codelists(covariate_definitions):
+    # {system: {list name: codelist}}, each distinct list once under the
+    # name of the first variable using it, and {variable: (system, list name)}
+    lists = {}
+    names = {}
+    variable_lists = {}
+    for variable, (funcname, args) in covariate_definitions.items():
+        for key in ("codelist", "with_these_diagnoses"):
+            codes = args.get(key)
+            if not codes or getattr(codes, "system", None) is None:
+                continue
+            list_key = frozen(codes)
+            if list_key not in names:
+                names[list_key] = variable
+                lists.setdefault(codes.system, {})[variable] = codes
+            variable_lists[variable] = (codes.system, names[list_key])
+    return lists, variable_lists
+
+
+class CodelistMatcher:
+    """The codelists of one coding system as an interned code table with membership bitsets."""
+
+    def __init__(self, system, codelists):
+        self.system = system
+        self.names = list(codelists)
+        self.list_index = {name: i for i, name in enumerate(self.names)}
+        items = {name: [code_and_category(item) for item in codes] for name, codes in codelists.items()}
+        self.codes = encode(sorted({code for pairs in items.values() for code, _ in pairs}))
+        self.lengths = sorted({len(code) for code in self.codes})
+
+        self.bits = np.zeros((len(self.codes), (len(self.names) + 63) // 64), dtype=np.uint64)
+        self.categories = {}
+        for i, (name, pairs) in enumerate(items.items()):
+            rows = np.searchsorted(self.codes, encode([code for code, _ in pairs]))
+            self.bits[rows, i // 64] |= np.uint64(1 << (i % 64))
+            if any(category is not None for _, category in pairs):
+                labels = tuple(sorted({category for _, category in pairs}))
+                index = {label: j for j, label in enumerate(labels)}
+                codes = np.full(len(self.codes), -1, dtype=np.int16)
+                codes[rows] = [index[category] for _, category in pairs]
+                self.categories[name] = (labels, codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    # INTERNING
+    def exact_ids(self, codes):
+        positions = np.searchsorted(self.codes, codes)
+        positions[positions == len(self.codes)] = 0
+        return np.where(self.codes[positions] == codes, positions, -1)
+
+    def lookup(self, codes, prefix=False):
+        # The table row of each code (the longest table code it starts with,
+        # if prefix), -1 where there is none
+        if isinstance(codes, (pa.DictionaryArray, pa.ChunkedArray)):
+            return self.lookup_dictionary(codes, prefix)
+        codes = as_bytes(codes)
+        if not prefix:
+            return self.exact_ids(codes)
+        ids = np.full(len(codes), -1, dtype=np.int64)
+        for length in self.lengths:
+            found = self.exact_ids(codes.astype(f"S{length}"))
+            ids = np.where(found >= 0, found, ids)
+        return ids
+
+    def lookup_dictionary(self, codes, prefix):
+        # Only the distinct codes are searched for, then spread to the events
+        if isinstance(codes, pa.ChunkedArray):
+            return np.concatenate([self.lookup(chunk, prefix) for chunk in codes.chunks] or [np.empty(0, np.int64)])
+        ids = np.append(self.lookup(codes.dictionary.to_numpy(zero_copy_only=False), prefix), -1)
+        indices = codes.indices.fill_null(len(codes.dictionary)).to_numpy(zero_copy_only=False)
+        return ids[indices]
+
+    # MEMBERSHIP
+    def match(self, codes, prefix=False):
+        # The membership bitsets of each event's code (all zero if it is in no list)
+        if not prefix:
+            return self.bits_of(self.lookup(codes))
+        if isinstance(codes, (pa.DictionaryArray, pa.ChunkedArray)):
+            if isinstance(codes, pa.ChunkedArray):
+                return np.concatenate([self.match(chunk, prefix) for chunk in codes.chunks])
+            bits = self.match(codes.dictionary.to_numpy(zero_copy_only=False), prefix)
+            bits = np.vstack([bits, np.zeros((1, bits.shape[1]), np.uint64)])
+            return bits[codes.indices.fill_null(len(codes.dictionary)).to_numpy(zero_copy_only=False)]
+        # A code can start with several table codes, so their lists are combined
+        codes = as_bytes(codes)
+        bits = np.zeros((len(codes), self.bits.shape[1]), dtype=np.uint64)
+        for length in self.lengths:
+            bits |= self.bits_of(self.exact_ids(codes.astype(f"S{length}")))
+        return bits
+
+    def bits_of(self, ids):
+        bits = self.bits[np.maximum(ids, 0)]
+        bits[ids < 0] = 0
+        return bits
+
+    def mask(self, bits, name):
+        i = self.list_index[name]
+        return (bits[:, i // 64] >> np.uint64(i % 64)) & np.uint64(1) == 1
+
+    def masks(self, codes, prefix=False):
+        # {list name: which events are in it} for every list, from one lookup
+        bits = self.match(codes, prefix)
+        return {name: self.mask(bits, name) for name in self.names}
+
+    def category(self, ids, name):
+        # (categories, index of each event's category, -1 for none)
+        labels, codes = self.categories[name]
+        return labels, np.where(ids >= 0, codes[np.maximum(ids, 0)], -1)
+
+
+def as_bytes(codes):
+    codes = np.asarray(codes)
+    if codes.dtype.kind == "S":
+        return codes
+    if codes.dtype.kind == "O":
+        codes = codes.astype(str)
+    return np.char.encode(codes, "utf-8")
+
+
+def study_matchers(covariate_definitions):
+    lists, variable_lists = study_codelists(covariate_definitions)
+    matchers = {system: CodelistMatcher(system, codelists) for system, codelists in lists.items()}
+    return matchers, variable_lists
+
@@ -1,34 +1,9 @@
-from cohortextractor import (
-    codelist_from_csv,
-    codelist,
-)
-
-
-# OUTCOME CODELISTS
-covid_codelist = codelist_from_csv(
-    "codelists/opensafely-covid-identification.csv",
-    system="icd10",
-    column="icd10_code",
-)
-
-covid_identification_in_primary_care_case_codes_clinical = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_test = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-covid_identification_in_primary_care_case_codes_seq = codelist_from_csv(
-    "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
+from cohortextractor import codelist
 
+from codelist_cache import cached_codelist_from_csv
+
+
+# CODELISTS DEFINED INLINE (cheap to build, so created on import)
 snomed_covid = codelist(["1325171000000109", 
                         "1325181000000106", 
                         "1325161000000102",
@@ -36,170 +11,233 @@ snomed_covid = codelist(["1325171000000109",
                         "1240751000000100"], 
                 system="snomed")
 
-aplastic_codes = codelist_from_csv(
-    "codelists/opensafely-aplastic-anaemia.csv", system="ctv3", column="CTV3ID"
-)
-
-hiv_codes = codelist_from_csv(
-    "codelists/opensafely-hiv.csv", system="ctv3", column="CTV3ID", category_column="CTV3ID"
-)
-
-permanent_immune_codes = codelist_from_csv(
-    "codelists/opensafely-permanent-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-temp_immune_codes = codelist_from_csv(
-    "codelists/opensafely-temporary-immunosuppression.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-stroke = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID"
-)
-
-dementia = codelist_from_csv(
-    "codelists/opensafely-dementia.csv", system="ctv3", column="CTV3ID"
-)
-
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-unclear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-unclear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-other_neuro = codelist_from_csv(
-    "codelists/opensafely-other-neurological-conditions.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-ethnicity_codes_16 = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_16",
-)
-
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-asthma_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-diagnosis.csv", system="ctv3", column="CTV3ID"
-)
-
-salbutamol_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-salbutamol-medication.csv",
-    system="snomed",
-    column="id",
-)
-
-ics_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-inhaler-steroid-medication.csv",
-    system="snomed",
-    column="id",
-)
-
-pred_codes = codelist_from_csv(
-    "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
-    system="snomed",
-    column="snomed_id",
-)
-
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID"
-)
-
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID"
-)
-
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID"
-)
-
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-bone_marrow_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-bone-marrow-transplant.csv", system="ctv3", column="CTV3ID"
-)
-
-chemo_radio_therapy_codes = codelist_from_csv(
-    "codelists/opensafely-chemotherapy-or-radiotherapy-updated.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID"
-)
-gi_bleed_and_ulcer_codes = codelist_from_csv(
-    "codelists/opensafely-gi-bleed-or-ulcer.csv", system="ctv3", column="CTV3ID"
-)
-inflammatory_bowel_disease_codes = codelist_from_csv(
-    "codelists/opensafely-inflammatory-bowel-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
 creatinine_codes = codelist(["XE2q5"], system="ctv3")
 
 hba1c_new_codes = codelist(["XaPbt", "Xaeze", "Xaezd"], system="ctv3")
 hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
 
-
-dialysis_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-kidney-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-spleen_codes = codelist_from_csv(
-    "codelists/opensafely-asplenia.csv", system="ctv3", column="CTV3ID"
-)
-
-sickle_cell_codes = codelist_from_csv(
-    "codelists/opensafely-sickle-cell-disease.csv", system="ctv3", column="CTV3ID"
-)
-
-ra_sle_psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-ra-sle-psoriasis.csv", system="ctv3", column="CTV3ID"
-)
-
 systolic_blood_pressure_codes = codelist(["2469."], system="ctv3")
 diastolic_blood_pressure_codes = codelist(["246A."], system="ctv3")
 
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv", system="ctv3", column="CTV3ID"
-)
 
+# CODELISTS READ FROM THE CODELIST FOLDER
+# Each CSV is only parsed the first time its codelist is used (for example by
+# `from codelists import ethnicity_codes`) and is then kept on this module, so
+# importing this file no longer reads every CSV under codelists/. Parsed CSVs
+# are also cached on disk against the sha1 of the CSV (see
+# codelist_cache.py)
+_CODELIST_CSVS = {
+    # OUTCOME CODELISTS
+    "covid_codelist": dict(
+        filename="codelists/opensafely-covid-identification.csv",
+        system="icd10",
+        column="icd10_code",
+    ),
+    "covid_identification_in_primary_care_case_codes_clinical": dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "covid_identification_in_primary_care_case_codes_test": dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "covid_identification_in_primary_care_case_codes_seq": dict(
+        filename="codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "aplastic_codes": dict(
+        filename="codelists/opensafely-aplastic-anaemia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "hiv_codes": dict(
+        filename="codelists/opensafely-hiv.csv",
+        system="ctv3",
+        column="CTV3ID",
+        category_column="CTV3ID",
+    ),
+    "permanent_immune_codes": dict(
+        filename="codelists/opensafely-permanent-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "temp_immune_codes": dict(
+        filename="codelists/opensafely-temporary-immunosuppression.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "stroke": dict(
+        filename="codelists/opensafely-stroke-updated.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "dementia": dict(
+        filename="codelists/opensafely-dementia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "clear_smoking_codes": dict(
+        filename="codelists/opensafely-smoking-clear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+    "unclear_smoking_codes": dict(
+        filename="codelists/opensafely-smoking-unclear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+    "other_neuro": dict(
+        filename="codelists/opensafely-other-neurological-conditions.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "ethnicity_codes": dict(
+        filename="codelists/opensafely-ethnicity.csv",
+        system="ctv3",
+        column="Code",
+        category_column="Grouping_6",
+    ),
+    "ethnicity_codes_16": dict(
+        filename="codelists/opensafely-ethnicity.csv",
+        system="ctv3",
+        column="Code",
+        category_column="Grouping_16",
+    ),
+    "chronic_respiratory_disease_codes": dict(
+        filename="codelists/opensafely-chronic-respiratory-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "asthma_codes": dict(
+        filename="codelists/opensafely-asthma-diagnosis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "salbutamol_codes": dict(
+        filename="codelists/opensafely-asthma-inhaler-salbutamol-medication.csv",
+        system="snomed",
+        column="id",
+    ),
+    "ics_codes": dict(
+        filename="codelists/opensafely-asthma-inhaler-steroid-medication.csv",
+        system="snomed",
+        column="id",
+    ),
+    "pred_codes": dict(
+        filename="codelists/opensafely-asthma-oral-prednisolone-medication.csv",
+        system="snomed",
+        column="snomed_id",
+    ),
+    "chronic_cardiac_disease_codes": dict(
+        filename="codelists/opensafely-chronic-cardiac-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "diabetes_codes": dict(
+        filename="codelists/opensafely-diabetes.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "lung_cancer_codes": dict(
+        filename="codelists/opensafely-lung-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "haem_cancer_codes": dict(
+        filename="codelists/opensafely-haematological-cancer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "other_cancer_codes": dict(
+        filename="codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "bone_marrow_transplant_codes": dict(
+        filename="codelists/opensafely-bone-marrow-transplant.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "chemo_radio_therapy_codes": dict(
+        filename="codelists/opensafely-chemotherapy-or-radiotherapy-updated.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "chronic_liver_disease_codes": dict(
+        filename="codelists/opensafely-chronic-liver-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "gi_bleed_and_ulcer_codes": dict(
+        filename="codelists/opensafely-gi-bleed-or-ulcer.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "inflammatory_bowel_disease_codes": dict(
+        filename="codelists/opensafely-inflammatory-bowel-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "dialysis_codes": dict(
+        filename="codelists/opensafely-chronic-kidney-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "organ_transplant_codes": dict(
+        filename="codelists/opensafely-solid-organ-transplantation.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "spleen_codes": dict(
+        filename="codelists/opensafely-asplenia.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "sickle_cell_codes": dict(
+        filename="codelists/opensafely-sickle-cell-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "ra_sle_psoriasis_codes": dict(
+        filename="codelists/opensafely-ra-sle-psoriasis.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "hypertension_codes": dict(
+        filename="codelists/opensafely-hypertension.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+}
+
+
+def load_codelist(name):
+    codes = cached_codelist_from_csv(**_CODELIST_CSVS[name])
+    globals()[name] = codes
+    return codes
+
+
+def __getattr__(name):
+    if name in _CODELIST_CSVS:
+        return load_codelist(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_CODELIST_CSVS))
+
+
+__all__ = [
+    "snomed_covid",
+    "creatinine_codes",
+    "hba1c_new_codes",
+    "hba1c_old_codes",
+    "systolic_blood_pressure_codes",
+    "diastolic_blood_pressure_codes",
+    *_CODELIST_CSVS,
+]
@@ -0,0 +1,340 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cohort_schema import Column, schema_from_json, study_schema
+from cr_columnar import (
+    ARROW_TYPES,
+    SCHEMA_KEY,
+    arrow_schema,
+    convert_array,
+    csv_batches,
+    feather_batches,
+    present_columns,
+)
+
+
+# STRUCT-OF-ARRAYS COHORT
+# The cohort in memory as one numpy array per column, typed from the cohort
+# schema (cohort_schema.py, i.e. from each variable's returning, date_format
+# and include_month):
+#   dates       int32 days since 1970-01-01 (YYYY-MM and YYYY dates as the
+#               first day, as in cr_columnar.py)
+#   categories  uint8 codes into the column's categories (uint16 where there
+#               are more than 256, as for msoa), sorted as pandas and Stata's
+#               encode sort them
+#   ints        int32, floats float32, bools uint8
+# Missing values are one bit per patient (np.packbits, in Arrow's bit order),
+# kept only for columns that have any; the value under a missing bit is 0.
+# Blank categories count as missing, as they do in cr_main.do.
+#
+# For the study's 62 columns this is about 220 bytes per patient (150 of them
+# the 38 dates), against about 3KB for the same extract read as strings.
+#
+# cr_main.py reads the extract as CohortArrays a chunk at a time
+# (cohort_chunks), and an_cox.py and an_table1.py read output/main.parquet
+# the same way: a Parquet file without a cohort schema (as cr_main.py writes
+# it) is typed from its Arrow schema (schema_from_arrow).
+STORAGE_TYPES = {
+    "id": np.int64,
+    "long": np.int64,
+    "date": np.int32,
+    "int": np.int32,
+    "float": np.float32,
+    "bool": np.uint8,
+}
+
+
+def code_type(categories):
+    if len(categories) <= 2**8:
+        return np.uint8
+    if len(categories) <= 2**16:
+        return np.uint16
+    return np.int32
+
+
+def pack_missing(missing):
+    # None when nothing is missing, so complete columns cost no bitmap
+    if not missing.any():
+        return None
+    return np.packbits(missing, bitorder="little")
+
+
+class CategoryEncoder:
+    """Codes for the values of one category column, seen a batch at a time."""
+
+    def __init__(self, categories=None):
+        self.categories = list(categories or ())
+        self.index = {category: code for code, category in enumerate(self.categories)}
+
+    def encode(self, array):
+        # (int32 codes, missing) for a dictionary array
+        dictionary = array.dictionary.to_pylist()
+        lookup = np.array([self.code(value) for value in dictionary] + [-1], dtype=np.int32)
+        indices = array.indices.fill_null(len(dictionary)).to_numpy(zero_copy_only=False)
+        codes = lookup[indices]
+        missing = codes < 0
+        codes[missing] = 0
+        return codes, missing
+
+    def code(self, value):
+        if value is None or value == "":
+            return -1
+        if value not in self.index:
+            self.index[value] = len(self.categories)
+            self.categories.append(value)
+        return self.index[value]
+
+    def finish(self, codes):
+        # Renumber the codes so the categories are in sorted order
+        order = sorted(range(len(self.categories)), key=self.categories.__getitem__)
+        renumber = np.empty(len(order), dtype=np.int64)
+        renumber[order] = np.arange(len(order))
+        categories = tuple(self.categories[i] for i in order)
+        if len(order):
+            codes = renumber[codes]
+        return categories, codes.astype(code_type(categories))
+
+
+class CohortArrays:
+    """The cohort as typed numpy arrays, one per column of the schema."""
+
+    def __init__(self, schema, values, missing, categories):
+        self.schema = list(schema)
+        self.columns = {column.name: column for column in self.schema}
+        self.values = values
+        self.missing_bits = missing
+        self.categories = categories
+        self.rows = len(next(iter(values.values()))) if values else 0
+
+    def __len__(self):
+        return self.rows
+
+    @classmethod
+    def from_batches(cls, schema, batches):
+        # Record batches of the extract, either as read from the CSV or
+        # feather file or already typed by cr_columnar.py
+        schema = list(schema)
+        encoders = {column.name: CategoryEncoder(column.categories) for column in schema if column.kind == "category"}
+        chunks = {column.name: [] for column in schema}
+        missing_chunks = {column.name: [] for column in schema}
+        for batch in batches:
+            for column in schema:
+                array = batch.column(column.name)
+                if array.type != ARROW_TYPES[column.kind]:
+                    array = convert_array(array, column)
+                if column.kind == "category":
+                    values, missing = encoders[column.name].encode(array)
+                else:
+                    missing = array.is_null().to_numpy(zero_copy_only=False)
+                    if column.kind == "date":
+                        array = array.cast(pa.int32())
+                    values = array.fill_null(0).to_numpy(zero_copy_only=False)
+                chunks[column.name].append(values)
+                missing_chunks[column.name].append(missing)
+
+        values = {}
+        missing = {}
+        categories = {}
+        for column in schema:
+            # No batches at all for an empty file
+            column_values = np.concatenate(chunks.pop(column.name) or [np.zeros(0, np.int64)])
+            if column.kind == "category":
+                categories[column.name], column_values = encoders[column.name].finish(column_values)
+            else:
+                column_values = column_values.astype(STORAGE_TYPES[column.kind])
+            values[column.name] = column_values
+            missing[column.name] = pack_missing(np.concatenate(missing_chunks.pop(column.name) or [np.zeros(0, bool)]))
+        return cls(schema, values, missing, categories)
+
+    # COLUMNS
+    def missing(self, name):
+        bits = self.missing_bits[name]
+        if bits is None:
+            return np.zeros(self.rows, dtype=bool)
+        return np.unpackbits(bits, count=self.rows, bitorder="little").view(bool)
+
+    def floats(self, name):
+        # Float64 with NaN for missing, dates as days and categories as codes
+        values = self.values[name].astype(float)
+        values[self.missing(name)] = np.nan
+        return values
+
+    def dates(self, name):
+        values = self.values[name].astype("datetime64[D]")
+        values[self.missing(name)] = np.datetime64("NaT")
+        return values
+
+    def labels(self, name):
+        # The category of each patient, "" where missing
+        categories = np.array(("",) + self.categories[name], dtype=object)
+        codes = self.values[name].astype(np.int64) + 1
+        codes[self.missing(name)] = 0
+        return categories[codes]
+
+    def take(self, rows):
+        # The patients at rows (indices or a boolean mask)
+        values = {name: array[rows] for name, array in self.values.items()}
+        missing = {
+            name: None if bits is None else pack_missing(self.missing(name)[rows])
+            for name, bits in self.missing_bits.items()
+        }
+        return CohortArrays(self.schema, values, missing, self.categories)
+
+    def select(self, names):
+        schema = [self.columns[name] for name in names]
+        return CohortArrays(
+            schema,
+            {name: self.values[name] for name in names},
+            {name: self.missing_bits[name] for name in names},
+            {name: self.categories[name] for name in names if name in self.categories},
+        )
+
+    # MEMORY
+    def nbytes(self, name=None):
+        names = self.values if name is None else [name]
+        total = 0
+        for name in names:
+            bits = self.missing_bits[name]
+            total += self.values[name].nbytes + (0 if bits is None else bits.nbytes)
+        return total
+
+    def memory_by_kind(self):
+        totals = {}
+        for column in self.schema:
+            totals[column.kind] = totals.get(column.kind, 0) + self.nbytes(column.name)
+        return totals
+
+    def numbers(self, name):
+        # As floats, but categories as the numbers their labels spell (NaN
+        # for labels that are not numbers), as destring would make them
+        if name not in self.categories:
+            return self.floats(name)
+        numbers = np.array([number(label) for label in self.categories[name]] + [np.nan])
+        codes = self.values[name].astype(np.int64)
+        codes[self.missing(name)] = len(self.categories[name])
+        return numbers[codes]
+
+    # ARROW
+    def arrow_column(self, name):
+        # One column as Arrow, sharing its value buffer
+        column = self.columns[name]
+        bits = self.missing_bits[name]
+        validity = None if bits is None else pa.py_buffer(np.bitwise_not(bits))
+        values = self.values[name]
+        if column.kind == "category":
+            indices = pa.Array.from_buffers(pa.int32(), self.rows, [validity, pa.py_buffer(values.astype(np.int32))])
+            return pa.DictionaryArray.from_arrays(indices, pa.array(self.categories[name], pa.string()))
+        if column.kind == "bool":
+            return pa.array(values.view(bool), mask=self.missing(name))
+        return pa.Array.from_buffers(ARROW_TYPES[column.kind], self.rows, [validity, pa.py_buffer(values)])
+
+    def to_arrow(self):
+        # A record batch in cr_columnar.py's schema
+        arrays = [self.arrow_column(column.name) for column in self.schema]
+        return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema(self.schema))
+
+
+def number(label):
+    try:
+        return float(label)
+    except ValueError:
+        return np.nan
+
+
+# READING
+ARROW_KINDS = [
+    (pa.types.is_date, "date"),
+    (pa.types.is_dictionary, "category"),
+    (pa.types.is_string, "category"),
+    (pa.types.is_boolean, "bool"),
+    (pa.types.is_int64, "long"),
+    (pa.types.is_integer, "int"),
+    (pa.types.is_floating, "float"),
+]
+
+
+def schema_from_arrow(schema):
+    # The cohort schema of a file that does not carry one
+    columns = []
+    for field in schema:
+        kind = next(kind for test, kind in ARROW_KINDS if test(field.type))
+        columns.append(Column(field.name, kind, "YYYY-MM-DD" if kind == "date" else None, None))
+    return columns
+
+
+def file_schema(schema):
+    if schema.metadata and SCHEMA_KEY in schema.metadata:
+        return schema_from_json(json.loads(schema.metadata[SCHEMA_KEY]))
+    return schema_from_arrow(schema)
+
+
+def source_batches(path, names=None, schema=None, batch_size=None):
+    # (schema, record batches) of the extract (.csv or .feather, typed from
+    # the study's schema), its Parquet copy (cr_columnar.py) or any Parquet
+    # file, or an Arrow stream of CohortArrays batches (shards.py)
+    if path.endswith((".parquet", ".arrows")):
+        if path.endswith(".parquet"):
+            file = pq.ParquetFile(path)
+            schema = file_schema(file.schema_arrow)
+        else:
+            reader = pa.ipc.open_stream(path)
+            schema = file_schema(reader.schema)
+        if names is not None:
+            schema = [column for column in schema if column.name in names]
+        selected = [column.name for column in schema]
+        if path.endswith(".parquet"):
+            batches = file.iter_batches(batch_size or 65_536, columns=selected)
+        else:
+            batches = (batch.select(selected) for batch in reader)
+        return schema, batches
+    schema = schema or study_schema()
+    if names is not None:
+        schema = [column for column in schema if column.name in names]
+    schema = present_columns(path, schema)
+    if path.endswith(".feather"):
+        return schema, feather_batches(path, schema)
+    return schema, csv_batches(path, schema)
+
+
+def cohort_chunks(path, names=None, chunk_size=250_000, schema=None):
+    # The cohort as CohortArrays of at most chunk_size patients
+    schema, batches = source_batches(path, names, schema, chunk_size)
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunk_size):
+            yield CohortArrays.from_batches(schema, [batch.slice(start, chunk_size)])
+
+
+def read_cohort_arrays(path, names=None, schema=None):
+    schema, batches = source_batches(path, names, schema)
+    return CohortArrays.from_batches(schema, batches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--compare", action="store_true", help="also measure the extract read as strings")
+    options = parser.parse_args()
+
+    start = time.perf_counter()
+    cohort = read_cohort_arrays(options.input)
+    seconds = time.perf_counter() - start
+    total = cohort.nbytes()
+    print(f"Read {cohort.rows} patients, {len(cohort.schema)} columns in {seconds:.1f}s")
+    print(f"{total / 2**20:.1f}MB, {total / max(cohort.rows, 1):.0f} bytes per patient")
+    for kind, size in sorted(cohort.memory_by_kind().items()):
+        print(f"  {kind:<9} {size / max(cohort.rows, 1):6.1f} bytes per patient")
+
+    if options.compare and options.input.endswith(".csv"):
+        frame = pd.read_csv(options.input, dtype=str, keep_default_na=False, na_values=[""])
+        strings = frame.memory_usage(deep=True).sum()
+        print(f"As strings: {strings / max(len(frame), 1):.0f} bytes per patient ({strings / total:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
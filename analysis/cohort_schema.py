@@ -0,0 +1,106 @@
+import argparse
+import json
+import sys
+from collections import namedtuple
+
+
+# COHORT SCHEMA
+# One entry per column of output/input.csv, worked out from the variables in
+# the StudyDefinition (via cohortextractor's own pandas typing, so IMD and
+# rural/urban are categories as they are in cohortextractor).
+#   kind:        "id", "date", "category", "int", "float" or "bool" ("long",
+#                a 64-bit integer, only for files typed from their own
+#                Arrow schema, see cohort_arrays.py)
+#   date_format: "YYYY-MM-DD", "YYYY-MM" or "YYYY" for dates
+#   categories:  the possible values of a category, where the study defines
+#                them (categorised_as, or returning a codelist category);
+#                None where they only come from the data (region, stp, ...)
+#
+# The schema is committed as analysis/cohort_schema.json, so that actions
+# running in the python image, which has no cohortextractor, can type the
+# extract without importing the study definition. After changing the study
+# definition, regenerate it with `python analysis/cohort_schema.py`
+# (`--check` fails if it is out of date).
+Column = namedtuple("Column", "name kind date_format categories")
+
+SCHEMA_JSON = "analysis/cohort_schema.json"
+
+PANDAS_KINDS = {
+    "category": "category",
+    "Int64": "int",
+    "float": "float",
+    "bool": "bool",
+}
+
+
+def column_categories(funcname, args):
+    if funcname == "categorised_as":
+        return tuple(sorted(str(category) for category in args["category_definitions"]))
+    if args.get("returning") == "category" and args.get("codelist") is not None:
+        return tuple(sorted({str(category) for _, category in args["codelist"]}))
+    return None
+
+
+def cohort_schema(study):
+    csv_args = study.pandas_csv_args
+    columns = [Column("patient_id", "id", None, None)]
+    for name, args in csv_args["args"].items():
+        if name in csv_args["parse_dates"]:
+            date_format = args.get("date_format") or "YYYY"
+            columns.append(Column(name, "date", date_format, None))
+            continue
+        kind = PANDAS_KINDS[csv_args["dtype"][name]]
+        categories = column_categories(args["funcname"], args) if kind == "category" else None
+        columns.append(Column(name, kind, None, categories))
+    return columns
+
+
+def load_study_schema():
+    # Importing the study definition pulls in cohortextractor, so only do it
+    # when a schema is actually needed
+    from study_definition import study
+
+    return cohort_schema(study)
+
+
+def study_schema(path=SCHEMA_JSON):
+    # The committed schema, without importing the study definition
+    with open(path) as f:
+        return schema_from_json(json.load(f))
+
+
+def schema_to_json(columns):
+    return [column._asdict() for column in columns]
+
+
+def schema_from_json(records):
+    return [
+        Column(
+            record["name"],
+            record["kind"],
+            record["date_format"],
+            None if record["categories"] is None else tuple(record["categories"]),
+        )
+        for record in records
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=SCHEMA_JSON)
+    parser.add_argument("--check", action="store_true", help="fail if the committed schema is out of date")
+    options = parser.parse_args()
+
+    text = json.dumps(schema_to_json(load_study_schema()), indent=1) + "\n"
+    if options.check:
+        with open(options.output) as f:
+            if f.read() != text:
+                sys.exit(f"{options.output} is out of date; rerun analysis/cohort_schema.py")
+        return
+    with open(options.output, "w") as f:
+        f.write(text)
+    print(f"Wrote {options.output}")
+
+
+if __name__ == "__main__":
+    main()
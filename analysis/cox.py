@@ -0,0 +1,515 @@
+import functools
+import itertools
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse, stats
+
+from stset import EpisodeColumns, Episodes, SurvivalSetup, stset
+
+
+# COX PROPORTIONAL HAZARDS
+# A numpy version of stcox for the models in an_cox.do:
+#   - Breslow (stcox's default) or Efron ties
+#   - strata(), delayed entry and robust (Lin-Wei) standard errors,
+#     clustered on an id when a patient has several records
+#   - factor variable terms as Stata writes them: i.x, ib2.x, c.x, x#y, x##y
+#   - tvc() terms, whose effect is multiplied by analysis time (texp(_t)),
+#     with Breslow ties and model-based standard errors
+#   - split=, fitting to the records stsplit at those analysis times, with
+#     _period (the number of cuts before an episode) usable in the formula
+#
+# The risk sets are worked out once for each stset (RiskSets) and shared by
+# every model fitted to it: the distinct event times of each stratum, and for
+# each record the range of those event times it is at risk for. Sums over a
+# risk set then become a bincount and a cumulative sum, so a Newton step costs
+# a few passes over the data whatever the number of event times, and a model
+# fitted to a subset (an `if` condition, or dropping missing covariates) needs
+# only that subset's rows.
+#
+# A tvc() model is the one Stata fits after splitting every record at every
+# failure time, but nothing is split: a record's covariates at the event
+# times it is at risk for differ only in the tvc terms, z * t, so the sums
+# over a risk set are the fixed covariates' sums kept separately for each
+# distinct z (two, for i.sgtf), weighted by exp(gamma * z * t) at each time.
+# Splits at a few times (split=) are held as offsets into the records
+# (stset.Episodes), with only the columns the model reads expanded.
+#
+# fit_models fits a batch of models on a pool of processes, each of which
+# loads the cohort once and keeps the risk sets it has built. A model that
+# cannot be estimated (no failures in its sample, a singular information
+# matrix, or no convergence) gives a result with its reason in `error` rather
+# than stopping the batch; lincom and lrtest then give missing values.
+CoxModel = namedtuple(
+    "CoxModel",
+    "name formula condition exit failure origin entry strata ties robust cluster tvc split",
+    defaults=(None, None, None, None, None, None, "breslow", False, None, None, None),
+)
+CoxResult = namedtuple(
+    "CoxResult", "name names coef variance loglik n events iterations converged error", defaults=(None,)
+)
+
+Factor = namedtuple("Factor", "name categorical base")
+FACTOR = re.compile(r"^(?:(c|i|ib(\d+))\.)?(\w+)$")
+CONDITION = re.compile(r"^\s*(\w+)\s*(==|!=|>=|<=|>|<)\s*(-?[\d.]+)\s*$")
+OPERATORS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    ">": np.greater,
+    "<": np.less,
+}
+
+
+# TERMS
+def parse_factor(text):
+    match = FACTOR.match(text)
+    if match is None:
+        raise ValueError(f"Unsupported term '{text}'")
+    prefix, base, name = match.groups()
+    if prefix in (None, "c"):
+        return Factor(name, False, None)
+    return Factor(name, True, int(base) if base else None)
+
+
+def parse_terms(formula):
+    # Each term is a tuple of factors; a##b expands to a, b and a#b
+    terms = []
+    for token in formula.split():
+        if "##" in token:
+            factors = [parse_factor(part) for part in token.split("##")]
+            for size in range(1, len(factors) + 1):
+                terms.extend(itertools.combinations(factors, size))
+        else:
+            terms.append(tuple(parse_factor(part) for part in token.split("#")))
+    return terms
+
+
+def formula_variables(formula):
+    return list(dict.fromkeys(factor.name for term in parse_terms(formula) for factor in term))
+
+
+def condition_variables(condition):
+    return [CONDITION.match(part).group(1) for part in condition.split("&")] if condition else []
+
+
+def model_variables(model):
+    # Every column the model reads
+    names = formula_variables(model.formula) + condition_variables(model.condition)
+    names += formula_variables(model.tvc) if model.tvc else []
+    names += [model.exit, model.failure, model.origin, model.entry, model.strata, model.cluster]
+    return [name for name in dict.fromkeys(names) if name and name != "_period"]
+
+
+def condition_mask(columns, condition):
+    # `if` conditions: comparisons of a variable with a number joined by &.
+    # As in Stata, missing values are larger than any number
+    mask = None
+    for part in condition.split("&"):
+        match = CONDITION.match(part)
+        if match is None:
+            raise ValueError(f"Unsupported condition '{part.strip()}'")
+        name, operator, number = match.groups()
+        values = columns[name]
+        values = np.where(np.isnan(values), np.inf, values)
+        result = OPERATORS[operator](values, float(number))
+        mask = result if mask is None else mask & result
+    return mask
+
+
+def level_label(level):
+    return str(int(level)) if float(level).is_integer() else str(level)
+
+
+def factor_columns(factor, values, interacted):
+    if not factor.categorical:
+        return [(f"c.{factor.name}" if interacted else factor.name, values)]
+    levels = np.unique(values)
+    base = factor.base if factor.base is not None else levels[0]
+    return [
+        (f"{level_label(level)}.{factor.name}", (values == level).astype(float))
+        for level in levels
+        if level != base
+    ]
+
+
+def independent_columns(X, tolerance=1e-9):
+    # Like Stata, omit columns that are constant in the sample or collinear
+    # with the ones before them
+    centred = X - X.mean(axis=0)
+    gram = centred.T @ centred
+    keep = []
+    for j in range(len(gram)):
+        residual = gram[j, j]
+        if keep:
+            known = gram[keep, j]
+            residual -= known @ np.linalg.solve(gram[np.ix_(keep, keep)], known)
+        if gram[j, j] > 0 and residual > tolerance * gram[j, j]:
+            keep.append(j)
+    return keep
+
+
+def design_matrix(columns, formula, rows):
+    names = []
+    arrays = []
+    for term in parse_terms(formula):
+        parts = [factor_columns(factor, columns[factor.name][rows], len(term) > 1) for factor in term]
+        for combination in itertools.product(*parts):
+            name = "#".join(name for name, _ in combination)
+            if name not in names:
+                names.append(name)
+                arrays.append(functools.reduce(np.multiply, [values for _, values in combination]))
+    X = np.column_stack(arrays)
+    keep = independent_columns(X)
+    return [names[j] for j in keep], np.ascontiguousarray(X[:, keep])
+
+
+# RISK SETS
+class RiskSets:
+    """The event times of one stset and the records at risk at each.
+
+    `times` are the distinct failure times, ordered by stratum and then time,
+    and `time` the analysis time of each. A record is at risk for the event times `lo <= k < hi`: those in its own
+    stratum after it entered and no later than its exit.
+    """
+
+    def __init__(self, exit, failure, strata=None, entry=None):
+        n = len(exit)
+        entry = np.zeros(n) if entry is None else entry
+        strata = np.zeros(n, dtype=np.int64) if strata is None else strata
+        # stset drops records ending on or before they start
+        self.valid = (exit > entry) & (strata >= 0)
+        self.event = self.valid & (np.nan_to_num(failure) != 0)
+
+        origin = np.min(entry[self.valid], initial=0)
+        span = np.max(exit[self.valid], initial=0) - origin + 1
+
+        def key(times):
+            return np.where(self.valid, strata * span + (times - origin), np.inf)
+
+        exit_key = key(exit)
+        self.times = np.unique(exit_key[self.event])
+        self.hi = np.searchsorted(self.times, exit_key, side="right")
+        self.lo = np.searchsorted(self.times, key(entry), side="right")
+        self.time = np.zeros(len(self.times))
+        self.time[self.hi[self.event] - 1] = exit[self.event]
+
+
+def indicator(index, groups, values=None):
+    # Sparse (groups x records) matrix summing the records by index
+    values = np.ones(len(index)) if values is None else values
+    return sparse.csr_matrix((values, (index, np.arange(len(index)))), shape=(groups, len(index)))
+
+
+def group_sums(index, weights, groups):
+    if weights.ndim == 1:
+        return np.bincount(index, weights, groups)
+    return indicator(index, groups) @ weights
+
+
+def over_risk_sets(lo, hi, per_time):
+    # For each record, the sum of per_time over the event times it is at risk for
+    cumulative = np.cumsum(per_time, axis=0)
+    cumulative = np.concatenate([np.zeros((1,) + per_time.shape[1:]), cumulative])
+    return cumulative[hi] - cumulative[lo]
+
+
+# FITTING
+def fit_cox(risk_sets, X, rows, ties="breslow", robust=False, cluster=None, max_iterations=50):
+    # X holds the covariates of `rows`, the records in the estimation sample
+    lo = risk_sets.lo[rows]
+    hi = risk_sets.hi[rows]
+    event = risk_sets.event[rows]
+    groups = len(risk_sets.times)
+    event_time = hi[event] - 1
+    deaths = np.bincount(event_time, minlength=groups)
+
+    # One term of the partial likelihood per failure: with Efron ties the
+    # l-th of d tied failures removes l/d of the failures' weight from the
+    # risk set
+    term_time = np.repeat(np.arange(groups), deaths)
+    if ties == "efron":
+        first = np.repeat(np.cumsum(deaths) - deaths, deaths)
+        fraction = (np.arange(len(term_time)) - first) / deaths[term_time]
+    elif ties == "breslow":
+        fraction = np.zeros(len(term_time))
+    else:
+        raise ValueError(f"Unsupported ties '{ties}'")
+
+    # Records enter the risk sets at lo and leave at hi: the sums over each risk
+    # set are cumulative sums of (entering - leaving) at each event time
+    change = indicator(lo, groups + 1) - indicator(hi, groups + 1)
+    failures = indicator(np.where(event, hi - 1, 0), groups, event.astype(float))
+    X_event_sum = X[event].sum(axis=0)
+
+    def evaluate(beta):
+        xb = X @ beta
+        shift = xb.max()
+        w = np.exp(xb - shift)
+        weighted_change = change.multiply(w).tocsr()
+        weighted_failures = failures.multiply(w).tocsr()
+        s0 = np.cumsum(np.asarray(weighted_change.sum(axis=1)).ravel())[:groups]
+        s1 = np.cumsum(weighted_change @ X, axis=0)[:groups]
+        d0 = np.asarray(weighted_failures.sum(axis=1)).ravel()
+        d1 = weighted_failures @ X
+        denominator = s0[term_time] - fraction * d0[term_time]
+        mean = (s1[term_time] - fraction[:, None] * d1[term_time]) / denominator[:, None]
+
+        loglik = np.sum(xb[event] - shift) - np.sum(np.log(denominator))
+        score = X_event_sum - mean.sum(axis=0)
+        inverse = np.bincount(term_time, 1 / denominator, groups)
+        tied = np.bincount(term_time, fraction / denominator, groups)
+        row_weight = w * over_risk_sets(lo, hi, inverse)
+        row_weight[event] -= w[event] * tied[event_time]
+        information = (X * row_weight[:, None]).T @ X - mean.T @ mean
+        return loglik, score, information, (w, denominator, mean, inverse, tied)
+
+    beta, (loglik, score, information, parts), iteration, converged = newton(evaluate, X.shape[1], max_iterations)
+    variance = np.linalg.inv(information)
+    if robust:
+        residuals = score_residuals(X, event, event_time, lo, hi, term_time, fraction, deaths, parts)
+        clusters = len(residuals)
+        if cluster is not None:
+            codes = np.unique(cluster[rows], return_inverse=True)[1]
+            clusters = codes.max() + 1
+            residuals = group_sums(codes, residuals, clusters)
+        # With the M/(M - 1) factor Stata applies to clustered variances
+        middle = residuals.T @ residuals * clusters / (clusters - 1)
+        variance = variance @ middle @ variance
+    return beta, variance, loglik, iteration, converged
+
+
+def newton(evaluate, k, max_iterations):
+    # Maximises the partial likelihood from zero; evaluate(beta) returns
+    # (loglik, score, information, ...)
+    beta = np.zeros(k)
+    current = evaluate(beta)
+    converged = False
+    for iteration in range(1, max_iterations + 1):
+        loglik, score, information = current[:3]
+        step = np.linalg.solve(information, score)
+        # Step halving, as ml does, if a full Newton step lowers the likelihood
+        for _ in range(30):
+            new = evaluate(beta + step)
+            if new[0] >= loglik - 1e-10 * abs(loglik):
+                break
+            step = step / 2
+        beta = beta + step
+        change_in_loglik = abs(new[0] - loglik)
+        current = new
+        # ml's default ltolerance(1e-7) and nrtolerance(1e-5)
+        if change_in_loglik <= 1e-7 * abs(new[0]) and new[1] @ np.linalg.solve(new[2], new[1]) < 1e-5:
+            converged = True
+            break
+    return beta, current, iteration, converged
+
+
+def fit_cox_tvc(risk_sets, X, Z, rows, max_iterations=50):
+    # Breslow ties with covariates X and tvc terms Z * t: at event time k a
+    # record's covariates are [X, Z * time[k]]. Records are grouped by their
+    # row of Z, whose risk set sums are kept apart and combined at each time
+    lo = risk_sets.lo[rows]
+    hi = risk_sets.hi[rows]
+    event = risk_sets.event[rows]
+    groups = len(risk_sets.times)
+    t = risk_sets.time
+    event_time = hi[event] - 1
+    deaths = np.bincount(event_time, minlength=groups).astype(float)
+    patterns, pattern = np.unique(Z, axis=0, return_inverse=True)
+    pattern = pattern.ravel()
+    members = [np.flatnonzero(pattern == p) for p in range(len(patterns))]
+    changes = [indicator(lo[m], groups + 1) - indicator(hi[m], groups + 1) for m in members]
+    a = X.shape[1]
+    event_sum = np.concatenate([X[event].sum(axis=0), (Z[event] * t[event_time, None]).sum(axis=0)])
+
+    def evaluate(beta):
+        b, gamma = beta[:a], beta[a:]
+        xb = X @ b
+        shift = xb.max()
+        w = np.exp(xb - shift)
+        # The tvc part of each pattern's linear predictor at each time,
+        # scaled by its largest at that time
+        zt = t[:, None] * (patterns @ gamma)[None, :]
+        scale = zt.max(axis=1)
+        v = np.exp(zt - scale[:, None])
+        a0 = []
+        a1 = []
+        for m, change in zip(members, changes):
+            weighted = change.multiply(w[m]).tocsr()
+            a0.append(np.cumsum(np.asarray(weighted.sum(axis=1)).ravel())[:groups])
+            a1.append(np.cumsum(weighted @ X[m], axis=0)[:groups])
+        s0 = sum(v[:, p] * a0[p] for p in range(len(patterns)))
+        s1 = np.hstack([
+            sum(v[:, p, None] * a1[p] for p in range(len(patterns))),
+            sum((v[:, p] * a0[p] * t)[:, None] * patterns[p] for p in range(len(patterns))),
+        ])
+        mean = s1 / s0[:, None]
+
+        loglik = np.sum(xb[event] - shift + zt[event_time, pattern[event]] - scale[event_time])
+        loglik -= deaths @ np.log(s0)
+        score = event_sum - deaths @ mean
+        # Each block of the sum over failures of s2 / s0, through the records
+        # for the fixed covariates and through the patterns' sums for the rest
+        weight = deaths[:, None] * v / s0[:, None]
+        row_weight = w * over_risk_sets(lo, hi, weight)[np.arange(len(w)), pattern]
+        information = np.zeros((len(beta), len(beta)))
+        information[:a, :a] = (X * row_weight[:, None]).T @ X
+        for p, z in enumerate(patterns):
+            cross = np.outer((weight[:, p] * t) @ a1[p], z)
+            information[:a, a:] += cross
+            information[a:, :a] += cross.T
+            information[a:, a:] += np.outer(z, z) * ((weight[:, p] * t * t) @ a0[p])
+        information -= (mean * deaths[:, None]).T @ mean
+        return loglik, score, information
+
+    beta, (loglik, score, information), iteration, converged = newton(evaluate, a + Z.shape[1], max_iterations)
+    return beta, np.linalg.inv(information), loglik, iteration, converged
+
+
+def score_residuals(X, event, event_time, lo, hi, term_time, fraction, deaths, parts):
+    w, denominator, mean, inverse, tied = parts
+    groups = len(deaths)
+    risk_mean = group_sums(term_time, mean / denominator[:, None], groups)
+    tied_mean = group_sums(term_time, mean * (fraction / denominator)[:, None], groups)
+    failure_mean = group_sums(term_time, mean, groups) / np.maximum(deaths, 1)[:, None]
+
+    residuals = -w[:, None] * (X * over_risk_sets(lo, hi, inverse)[:, None] - over_risk_sets(lo, hi, risk_mean))
+    k = event_time
+    residuals[event] += (
+        X[event] - failure_mean[k] + w[event, None] * (X[event] * tied[k, None] - tied_mean[k])
+    )
+    return residuals
+
+
+def stset_times(columns, model):
+    origin = columns[model.origin] if model.origin else 0
+    exit = columns[model.exit] - origin
+    entry = columns[model.entry] - origin if model.entry else None
+    return exit, entry
+
+
+def model_risk_sets(columns, model, cache):
+    key = (model.exit, model.failure, model.origin, model.entry, model.strata, model.split)
+    if key not in cache:
+        exit, entry = stset_times(columns, model)
+        strata = columns[model.strata] if model.strata else None
+        cache[key] = RiskSets(exit, columns[model.failure], strata, entry)
+    return cache[key]
+
+
+def split_columns(columns, model, cache):
+    # The records stsplit at model.split, as columns over the episodes
+    key = ("split", model.exit, model.failure, model.origin, model.entry, model.split)
+    if key not in cache:
+        times = stset(columns, SurvivalSetup(model.exit, model.failure, model.origin, model.entry))
+        cache[key] = EpisodeColumns(columns, Episodes(times, model.split))
+    return cache[key]
+
+
+def not_estimable(model, n, events, error):
+    return CoxResult(model.name, [], np.zeros(0), np.zeros((0, 0)), np.nan, n, events, 0, False, error)
+
+
+def estimable(result):
+    return result.error is None and result.converged
+
+
+def fit_model(columns, model, cache=None):
+    cache = {} if cache is None else cache
+    if model.split:
+        # The cuts, as a tuple, key the cached episodes and risk sets
+        model = model._replace(split=tuple(model.split))
+        columns = split_columns(columns, model, cache)
+        model = model._replace(exit="_t", failure="_d", origin=None, entry="_t0")
+    risk_sets = model_risk_sets(columns, model, cache)
+    sample = risk_sets.valid.copy()
+    variables = formula_variables(model.formula) + (formula_variables(model.tvc) if model.tvc else [])
+    for name in variables:
+        sample &= ~np.isnan(columns[name])
+    if model.condition:
+        sample &= condition_mask(columns, model.condition)
+    rows = np.flatnonzero(sample)
+    events = int(risk_sets.event[rows].sum())
+    if model.tvc and (model.ties != "breslow" or model.robust):
+        raise ValueError("tvc() is only supported with Breslow ties and model-based standard errors")
+    if not events:
+        return not_estimable(model, len(rows), events, "no failures")
+
+    cluster = columns[model.cluster] if model.cluster else None
+    try:
+        names, X = design_matrix(columns, model.formula, rows)
+        if model.tvc:
+            tvc_names, Z = design_matrix(columns, model.tvc, rows)
+            names = names + [f"tvc:{name}" for name in tvc_names]
+            coef, variance, loglik, iterations, converged = fit_cox_tvc(risk_sets, X, Z, rows)
+        else:
+            coef, variance, loglik, iterations, converged = fit_cox(
+                risk_sets, X, rows, model.ties, model.robust, cluster
+            )
+    except np.linalg.LinAlgError:
+        return not_estimable(model, len(rows), events, "singular information matrix")
+    return CoxResult(model.name, names, coef, variance, loglik, len(rows), events, iterations, converged)
+
+
+# POST-ESTIMATION
+Estimate = namedtuple("Estimate", "estimate lb ub p")
+
+
+def lincom(result, names, eform=True, level=95):
+    # lincom a + b + ...: the sum of the named coefficients. Omitted terms
+    # count as zero, as in Stata
+    if not estimable(result):
+        return Estimate(np.nan, np.nan, np.nan, np.nan)
+    weights = np.zeros(len(result.names))
+    for name in names:
+        if name in result.names:
+            weights[result.names.index(name)] += 1
+    estimate = weights @ result.coef
+    se = np.sqrt(weights @ result.variance @ weights)
+    z = stats.norm.ppf(0.5 + level / 200)
+    p = 2 * stats.norm.sf(abs(estimate / se))
+    lb, ub = estimate - z * se, estimate + z * se
+    if eform:
+        # Huge (separated) estimates give an infinite upper bound, as in Stata
+        with np.errstate(over="ignore"):
+            return Estimate(np.exp(estimate), np.exp(lb), np.exp(ub), p)
+    return Estimate(estimate, lb, ub, p)
+
+
+def lrtest(restricted, full):
+    if not (estimable(restricted) and estimable(full)):
+        return np.nan
+    if restricted.n != full.n:
+        raise ValueError(f"{restricted.name} and {full.name} were fitted to different samples")
+    chi2 = 2 * (full.loglik - restricted.loglik)
+    df = len(full.names) - len(restricted.names)
+    return stats.chi2.sf(chi2, df)
+
+
+# PARALLEL BATCHES
+_columns = None
+_risk_sets = {}
+
+
+def _start_worker(load_cohort):
+    global _columns
+    _columns = load_cohort()
+    _risk_sets.clear()
+
+
+def _fit(model):
+    return fit_model(_columns, model, _risk_sets)
+
+
+def fit_models(models, load_cohort, workers=1):
+    # load_cohort returns {column: float array}; in a pool it must be picklable
+    if workers == 1:
+        _start_worker(load_cohort)
+        results = [_fit(model) for model in models]
+    else:
+        with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(load_cohort,)) as pool:
+            results = list(pool.map(_fit, models))
+    return {result.name: result for result in results}
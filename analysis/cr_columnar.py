@@ -0,0 +1,205 @@
+import argparse
+import csv
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from cohort_schema import schema_from_json, schema_to_json, study_schema
+
+
+# TYPED COLUMNAR COPY OF THE COHORT
+# Converts output/input.csv (or the .feather file cohortextractor writes when
+# generate_cohort is run with --output-format feather) into a Parquet file
+# typed from the StudyDefinition (by its committed schema, cohort_schema.json):
+#   dates       date32, i.e. int32 days since 1970-01-01 (YYYY-MM values are
+#               stored as the 1st of the month and YYYY values as 1 January,
+#               as cohortextractor does)
+#   categories  dictionary encoded strings (sgtf, region, stp, ae_destination...)
+#   ints        int32, floats float32 (the precision Stata keeps by default)
+# The input is read in blocks, so memory use does not grow with the cohort.
+SCHEMA_KEY = b"cohort_schema"
+BLOCK_SIZE = 64 * 1024 * 1024
+
+ARROW_TYPES = {
+    "id": pa.int64(),
+    "long": pa.int64(),
+    "date": pa.date32(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "int": pa.int32(),
+    "float": pa.float32(),
+    "bool": pa.bool_(),
+}
+
+DATE_PADDING = {"YYYY-MM-DD": "", "YYYY-MM": "-01", "YYYY": "-01-01"}
+DATE_UNITS = {"YYYY-MM-DD": "D", "YYYY-MM": "M", "YYYY": "Y"}
+DATE_STRFTIME = {"YYYY-MM-DD": "%Y-%m-%d", "YYYY-MM": "%Y-%m", "YYYY": "%Y"}
+
+
+def arrow_schema(columns):
+    fields = [pa.field(column.name, ARROW_TYPES[column.kind]) for column in columns]
+    metadata = {SCHEMA_KEY: json.dumps(schema_to_json(columns))}
+    return pa.schema(fields, metadata=metadata)
+
+
+def csv_read_types(columns):
+    # Dates and categories are read as plain strings and converted per block
+    read_types = {}
+    for column in columns:
+        if column.kind in ("date", "category"):
+            read_types[column.name] = pa.string()
+        else:
+            read_types[column.name] = ARROW_TYPES[column.kind]
+    return read_types
+
+
+def convert_array(array, column):
+    if column.kind == "date":
+        if pa.types.is_string(array.type):
+            padding = DATE_PADDING[column.date_format]
+            if padding:
+                array = pc.binary_join_element_wise(array, padding, "")
+            return pc.cast(array, pa.timestamp("s")).cast(pa.date32())
+        return pc.cast(array, pa.date32())
+    if column.kind == "category":
+        if pa.types.is_dictionary(array.type):
+            array = array.dictionary_decode()
+        return pc.dictionary_encode(pc.cast(array, pa.string()))
+    return pc.cast(array, ARROW_TYPES[column.kind])
+
+
+def convert_batch(batch, columns):
+    arrays = [convert_array(batch.column(column.name), column) for column in columns]
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema(columns))
+
+
+def csv_batches(path, columns, block_size=BLOCK_SIZE):
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=csv_read_types(columns),
+            strings_can_be_null=True,
+            include_columns=[column.name for column in columns],
+        ),
+    )
+    yield from reader
+
+
+def feather_batches(path, columns):
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).select([column.name for column in columns])
+
+
+def present_columns(path, columns):
+    # Only convert the schema columns that the extract actually contains
+    if path.endswith(".feather"):
+        with pa.memory_map(path) as source:
+            names = set(pa.ipc.open_file(source).schema.names)
+    else:
+        with open(path) as f:
+            names = set(next(csv.reader(f)))
+    return [column for column in columns if column.name in names]
+
+
+def convert(input_path, output_path, columns, block_size=BLOCK_SIZE):
+    columns = present_columns(input_path, columns)
+    if input_path.endswith(".feather"):
+        batches = feather_batches(input_path, columns)
+    else:
+        batches = csv_batches(input_path, columns, block_size)
+
+    rows = 0
+    with pq.ParquetWriter(output_path, arrow_schema(columns)) as writer:
+        for batch in batches:
+            writer.write_batch(convert_batch(batch, columns))
+            rows += batch.num_rows
+    return rows
+
+
+# WRITING EXTRACTED COLUMNS
+def to_record_batch(columns, schema, first_id=1):
+    # Columns as produced by an extraction backend: dates as datetime64[D]
+    # arrays, categories as dictionary arrays and the rest as numpy arrays.
+    # Patients are numbered from first_id if there is no patient_id column
+    rows = len(next(iter(columns.values())))
+    arrays = []
+    for column in schema:
+        if column.kind == "id" and column.name not in columns:
+            arrays.append(pa.array(np.arange(first_id, first_id + rows), pa.int64()))
+            continue
+        values = columns[column.name]
+        if column.kind == "date":
+            # Reduced to the precision requested, stored as the first day
+            unit = DATE_UNITS[column.date_format]
+            if unit != "D":
+                values = values.astype(f"datetime64[{unit}]").astype("datetime64[D]")
+            arrays.append(pa.array(values, pa.date32()))
+        elif column.kind == "category":
+            arrays.append(values)
+        else:
+            arrays.append(pc.cast(pa.array(values), ARROW_TYPES[column.kind]))
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema(schema))
+
+
+def csv_batch(batch, schema):
+    # Dates formatted as in the extract, categories and bools as plain values
+    arrays = []
+    for column, array in zip(schema, batch.columns):
+        if column.kind == "date":
+            form = DATE_STRFTIME[column.date_format]
+            array = pc.strftime(pc.cast(array, pa.timestamp("s")), format=form)
+        elif column.kind == "category":
+            array = array.dictionary_decode()
+        elif column.kind == "bool":
+            array = pc.cast(array, pa.int8())
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def write_batches(batches, schema, path):
+    batches = iter(batches)
+    if path.endswith(".csv"):
+        first = csv_batch(next(batches), schema)
+        with pa_csv.CSVWriter(path, first.schema) as writer:
+            writer.write_batch(first)
+            for batch in batches:
+                writer.write_batch(csv_batch(batch, schema))
+    else:
+        with pq.ParquetWriter(path, arrow_schema(schema)) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+
+# READING THE CONVERTED FILE
+def read_schema(path):
+    metadata = pq.read_schema(path).metadata
+    return schema_from_json(json.loads(metadata[SCHEMA_KEY]))
+
+
+def read_cohort(path, columns=None):
+    # Dates come back as int32 day offsets (a zero copy view of date32)
+    table = pq.read_table(path, columns=columns)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_date32(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.int32()))
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--output", default="output/input.parquet")
+    options = parser.parse_args()
+
+    rows = convert(options.input, options.output, study_schema())
+    print(f"Wrote {rows} rows to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from cox import formula_variables
+from imputation import ImputationModel, multiple_imputation, with_imputations
+
+
+# PYTHON VERSION OF cr_imputed.do
+# Imputes missing ethnicity (eth2, recoded 1 = White, 0 = not White) in
+# output/main.parquet (cr_main.py) with 10 logistic imputations, run in
+# parallel, and writes output/main_imputed.parquet: the cohort once, plus the
+# imputed ethnicity of the rows where it is missing as _1_eth2 ... _10_eth2
+# (see imputation.py).
+IMPUTATIONS = 10
+SEED = 6012022  # rseed(06012022)
+ITERATIONS = 20
+
+ETH2 = ImputationModel(
+    "eth2",
+    "logit",
+    "age1 age2 age3 i.male i.obese4cat i.smoke_nomiss i.imd i.comorb_cat i.region i.vax "
+    "i.rural_urban i.hh_total_cat i.home_bin i.sgtf i.start_week cox_ae",
+)
+
+
+def read_cohort(path, columns=None):
+    table = pq.read_table(path, columns=columns)
+    # recode eth2 6=. 5=0
+    eth2 = table.column("eth2")
+    eth2 = pc.if_else(pc.equal(eth2, 6), pa.scalar(None, eth2.type), eth2)
+    eth2 = pc.if_else(pc.equal(eth2, 5), pa.scalar(0, eth2.type), eth2)
+    table = table.set_column(table.column_names.index("eth2"), "eth2", eth2)
+
+    # egen inc = rowmiss(...), keep if inc==0
+    complete = None
+    for name in formula_variables(ETH2.formula):
+        present = pc.is_valid(table.column(name))
+        complete = present if complete is None else pc.and_(complete, present)
+    return table.filter(complete)
+
+
+def imputation_columns(path):
+    names = [ETH2.variable] + formula_variables(ETH2.formula)
+    table = read_cohort(path, names)
+    return {name: table.column(name).to_numpy().astype(float) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/main.parquet")
+    parser.add_argument("--output", default="output/main_imputed.parquet")
+    parser.add_argument("--imputations", type=int, default=IMPUTATIONS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    table = read_cohort(options.input)
+    missing = table.column("eth2").null_count
+    print(f"{table.num_rows} complete rows; eth2 missing for {missing}")
+
+    start = time.perf_counter()
+    imputations = multiple_imputation(
+        partial(imputation_columns, options.input),
+        [ETH2],
+        options.imputations,
+        options.seed,
+        ITERATIONS,
+        options.workers,
+    )
+    print(f"Made {len(imputations)} imputations in {time.perf_counter() - start:.1f}s")
+    for k, imputation in enumerate(imputations if missing else [], 1):
+        print(f"  imputation {k}: {np.mean(imputation['eth2']):.3f} of missing eth2 imputed as White")
+
+    pq.write_table(with_imputations(table, imputations), options.output)
+    print(f"Wrote {options.output}")
+
+
+if __name__ == "__main__":
+    main()
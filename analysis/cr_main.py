@@ -0,0 +1,720 @@
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cohort_arrays import cohort_chunks
+from msoa_lookup import msoa_ids, msoa_utla_index, utla_ids
+from shards import merge_sorted, sort_file, split_chunks
+from stset import survival_columns
+
+
+# PYTHON VERSION OF cr_main.do
+# Applies the same exclusions and derivations as cr_main.do, but reads the
+# extract in chunks and appends each prepared chunk to output/main.parquet,
+# so memory use stays constant however large the extract. The extract is
+# output/input.parquet (cr_columnar.py), or output/input.csv typed the same
+# way, and each chunk is held as CohortArrays (cohort_arrays.py): dates as
+# days, categories as codes and numbers as float32, the type import
+# delimited gives them in cr_main.do. The few steps that need the whole cohort (IMD quintiles, the STP
+# numbering and the age spline knots) use small summaries gathered in a
+# first pass over just the columns they need.
+#
+# Differences from main.dta:
+#   - dates are date32 (days since 1970-01-01) rather than Stata %td
+#   - rows are kept in extract order rather than sorted by patient_id
+#   - the cancer, immunosuppression and HbA1c windows use each patient's
+#     own study_start; cr_main.do builds them with `local`, which takes
+#     study_start from the first observation only
+#
+# With --shard-by region (or stp) the extract is instead split into one
+# shard per region in a single read, which also gathers the whole-cohort
+# summaries, the shards are prepared on a pool of processes, and the
+# prepared shards are merged into output/main.parquet sorted by patient_id.
+# The prepared shards are kept in output/shards for analyses that can
+# combine per-shard results (an_table1.py). Apart from the row order the
+# output is the same as without sharding.
+CHUNK_SIZE = 250_000
+
+STUDY_END = "2022-01-01"
+EC_DATA_DATE = "2022-01-28"
+
+# Full dates, converted with date(x, "YMD") in cr_main.do
+DATE_COLUMNS = [
+    "sgss_pos_inrange",
+    "died_date_ons",
+    "ae_covid_date",
+    "ae_any_date",
+    "vaxdate1",
+    "vaxdate2",
+    "vaxdate3",
+    "last_covid_tpp_probable",
+    "last_pos_test_sgss",
+]
+
+# Year-month dates, set to the 15th of the month as cr_main.do does
+MONTH_DATE_COLUMNS = [
+    "bp_sys_date_measured",
+    "bp_dias_date_measured",
+    "hba1c_percentage_date",
+    "hba1c_mmol_per_mol_date",
+    "hypertension",
+    "bmi_date_measured",
+    "chronic_respiratory_disease",
+    "chronic_cardiac_disease",
+    "diabetes",
+    "lung_cancer",
+    "haem_cancer",
+    "other_cancer",
+    "chronic_liver_disease",
+    "stroke",
+    "dementia",
+    "other_neuro",
+    "organ_transplant",
+    "dysplenia",
+    "sickle_cell",
+    "aplastic_anaemia",
+    "hiv_date",
+    "permanent_immunodeficiency",
+    "temporary_immunodeficiency",
+    "ra_sle_psoriasis",
+    "dialysis",
+]
+
+NUMERIC_COLUMNS = [
+    "patient_id",
+    "sgtf",
+    "ae_destination",
+    "age",
+    "imd",
+    "rural_urban",
+    "household_size",
+    "bmi",
+    "ethnicity",
+    "ethnicity_16",
+    "asthma",
+    "creatinine",
+    "hba1c_mmol_per_mol",
+    "hba1c_percentage",
+    "bp_sys",
+    "bp_dias",
+]
+
+STRING_COLUMNS = [
+    "sex",
+    "stp",
+    "msoa",
+    "region",
+    "care_home_type",
+    "smoking_status",
+]
+
+INPUT_COLUMNS = DATE_COLUMNS + MONTH_DATE_COLUMNS + NUMERIC_COLUMNS + STRING_COLUMNS
+
+# Comorbidities ever before study_start
+COMORBIDITY_COLUMNS = [
+    "chronic_respiratory_disease",
+    "chronic_cardiac_disease",
+    "diabetes",
+    "chronic_liver_disease",
+    "stroke",
+    "dementia",
+    "other_neuro",
+    "organ_transplant",
+    "aplastic_anaemia",
+    "hypertension",
+    "dysplenia",
+    "sickle_cell",
+    "hiv",
+    "permanent_immunodeficiency",
+    "temporary_immunodeficiency",
+    "ra_sle_psoriasis",
+    "dialysis",
+]
+
+UTLA_GROUPS = {
+    "Barking and Dagenham": "Redbridge, Barking and Dagenham",
+    "Redbridge": "Redbridge, Barking and Dagenham",
+    "Buckinghamshire": "Bucks/Ox/West. Berks/Swindon",
+    "Oxfordshire": "Bucks/Ox/West. Berks/Swindon",
+    "Swindon": "Bucks/Ox/West. Berks/Swindon",
+    "West Berkshire": "Bucks/Ox/West. Berks/Swindon",
+    "Camden": "Camden and Westminster",
+    "Westminster": "Camden and Westminster",
+    "Isles of Scilly": "",
+    "Richmond upon Thames": "Richmond and Hounslow",
+    "Hounslow": "Richmond and Hounslow",
+    "Rutland": "Rutland and Lincoln",
+    "Lincolnshire": "Rutland and Lincoln",
+    "Bolton": "Bolton and Tameside",
+    "Tameside": "Bolton and Tameside",
+}
+
+REGIONS = {
+    "East": 0,
+    "East Midlands": 1,
+    "London": 2,
+    "North East": 3,
+    "North West": 4,
+    "South East": 5,
+    "South West": 6,
+    "West Midlands": 7,
+    "Yorkshire and The Humber": 8,
+}
+
+SMOKING = {"N": 1, "E": 2, "S": 3}
+
+RURAL_URBAN5 = {1: 1, 2: 2, 3: 3, 4: 3, 5: 4, 6: 4, 7: 5, 8: 5}
+
+# Re-ordered 5 category ethnicity (6 = missing)
+ETH5 = {1: 1, 3: 2, 4: 3, 2: 4, 5: 5}
+
+AE_DESTINATIONS = {
+    306689006: "Home",
+    306691003: "Home",
+    306694006: "Home",
+    306705005: "Police/legal",
+    50861005: "Police/legal",
+    306706006: "Admitted",
+    1066371000000106: "Admitted",
+    1066391000000105: "Admitted",
+    1066341000000100: "Admitted",
+    1066361000000104: "Admitted",
+    1066331000000109: "Admitted",
+    1066401000000108: "Baby unit",
+    1066381000000108: "Baby unit",
+    1066351000000102: "Transfer/hospice",
+    183919006: "Transfer/hospice",
+    19712007: "Transfer/hospice",
+    305398007: "Mortuary",
+}
+
+# Saturday ending each epidemiological week, latest first
+EPI_WEEKS = [
+    (52, "2022-01-01"),
+    (51, "2021-12-25"),
+    (50, "2021-12-18"),
+    (49, "2021-12-11"),
+    (48, "2021-12-04"),
+    (47, "2021-11-27"),
+    (46, "2021-11-20"),
+    (45, "2021-11-13"),
+    (44, "2021-11-06"),
+    (43, "2021-10-30"),
+    (42, "2021-10-23"),
+    (41, "2021-10-16"),
+    (40, "2021-10-09"),
+]
+
+# Harrell's knot percentiles, as used by mkspline ..., cubic nknots(4)
+SPLINE_PERCENTILES = [5, 35, 65, 95]
+
+
+# HELPERS
+def day(date):
+    return (np.datetime64(date, "D") - np.datetime64("1970-01-01", "D")).astype(float)
+
+
+def month_days(chunk, column):
+    # YYYY-MM dates on the 15th of the month; they are held as the 1st
+    return chunk.floats(column) + 14
+
+
+def inrange(values, low, high):
+    return (values >= low) & (values <= high)
+
+
+def recode_bins(values, edges, codes):
+    # recode x a/b=0 b/c=1 ..., leaving missing values missing
+    result = np.full(len(values), np.nan)
+    present = ~np.isnan(values)
+    result[present] = np.asarray(codes)[np.searchsorted(edges, values[present], side="right")]
+    return result
+
+
+def stata_percentile(counts, p):
+    # _pctile's default definition, computed from a Counter of values
+    values = np.array(sorted(counts))
+    cumulative = np.cumsum([counts[value] for value in values])
+    position = cumulative[-1] * p / 100
+    index = np.searchsorted(cumulative, position, side="left")
+    if position == cumulative[index] and index + 1 < len(values):
+        return (values[index] + values[index + 1]) / 2
+    return values[index]
+
+
+def restricted_cubic_spline(x, knots):
+    # mkspline's restricted cubic spline basis
+    k = np.asarray(knots, dtype=float)
+    n = len(k)
+    scale = (k[-1] - k[0]) ** 2
+
+    def cube(values):
+        return np.where(values > 0, values, 0) ** 3
+
+    basis = [x]
+    for i in range(n - 2):
+        term = (
+            cube(x - k[i])
+            - cube(x - k[n - 2]) * (k[n - 1] - k[i]) / (k[n - 1] - k[n - 2])
+            + cube(x - k[n - 1]) * (k[n - 2] - k[i]) / (k[n - 1] - k[n - 2])
+        )
+        basis.append(term / scale)
+    return basis
+
+
+# EXCLUSIONS
+def apply_exclusions(chunk, counts):
+    study_start = chunk.floats("sgss_pos_inrange")
+    died = chunk.floats("died_date_ons")
+    age = chunk.floats("age")
+
+    steps = [
+        ("no positive test in study period", np.isnan(study_start)),
+        ("died on/before study start date", died <= study_start),
+        ("age > 105 or missing", ~(age <= 105)),
+        ("gender not M/F", ~np.isin(chunk.labels("sex"), ["M", "F"])),
+    ]
+    keep = np.ones(len(chunk), dtype=bool)
+    for label, excluded in steps:
+        counts[label] += int((keep & excluded).sum())
+        keep &= ~excluded
+    return chunk.take(keep)
+
+
+# FIRST PASS: SUMMARIES NEEDING THE WHOLE COHORT
+STATISTICS_COLUMNS = ["sgss_pos_inrange", "died_date_ons", "age", "sex", "imd", "stp"]
+
+
+def add_statistics(summaries, chunk):
+    imd_counts, age_counts, stps = summaries
+    chunk = apply_exclusions(chunk.select(STATISTICS_COLUMNS), Counter())
+    imd = chunk.numbers("imd")
+    imd_counts.update(imd[~np.isnan(imd)].tolist())
+    age_counts.update(chunk.floats("age").tolist())
+    # Missing STP is a group of its own, numbered first as "" sorts first
+    stps.update(chunk.labels("stp"))
+
+
+def collect_statistics(path, chunk_size=CHUNK_SIZE):
+    summaries = (Counter(), Counter(), set())
+    for chunk in cohort_chunks(path, STATISTICS_COLUMNS, chunk_size):
+        add_statistics(summaries, chunk)
+    return statistics_from(summaries)
+
+
+def statistics_from(summaries):
+    imd_counts, age_counts, stps = summaries
+    # egen imd = cut(imd_o), group(5): quintile cut points
+    imd_cuts = [stata_percentile(imd_counts, p) for p in (20, 40, 60, 80)] if imd_counts else []
+    age_knots = [stata_percentile(age_counts, p) - 65 for p in SPLINE_PERCENTILES] if age_counts else []
+    # STPs are numbered 1, 2, ... in sorted order, as bysort stp: _n==1 does
+    stp_numbers = {stp: i + 1 for i, stp in enumerate(sorted(stps))}
+    return {"imd_cuts": imd_cuts, "age_knots": age_knots, "stp_numbers": stp_numbers}
+
+
+# SECOND PASS: DERIVED VARIABLES
+def prepare_chunk(chunk, statistics, msoa_index):
+    n = len(chunk)
+    out = {"patient_id": chunk.floats("patient_id")}
+
+    dates = {column: chunk.floats(column) for column in DATE_COLUMNS}
+    for column in MONTH_DATE_COLUMNS:
+        dates[column] = month_days(chunk, column)
+    study_start = dates["sgss_pos_inrange"]
+    out["study_start"] = study_start
+    out["study_end"] = np.full(n, day(STUDY_END))
+
+    # SGTF
+    sgtf = chunk.numbers("sgtf")
+    sgtf[np.isnan(sgtf)] = 99
+    out["sgtf"] = sgtf
+    out["has_sgtf"] = inrange(sgtf, 0, 1).astype(float)
+
+    # Vaccination and prior infection status
+    vax = np.zeros(n)
+    vax[dates["vaxdate1"] + 14 < study_start] = 1
+    vax[dates["vaxdate2"] + 14 < study_start] = 2
+    vax[dates["vaxdate3"] + 14 < study_start] = 3
+    out["vax"] = vax
+    out["prev_inf"] = (
+        (dates["last_covid_tpp_probable"] < study_start)
+        | (dates["last_pos_test_sgss"] < study_start)
+    ).astype(float)
+
+    # BMI
+    bmi = chunk.floats("bmi")
+    bmi[~inrange(bmi, 15, 50)] = np.nan
+    out["bmi"] = bmi
+    out["bmi_date_measured"] = dates["bmi_date_measured"]
+    bmicat = recode_bins(bmi, [18.5, 25, 30, 35, 40], [1, 2, 3, 4, 5, 6])
+    out["bmicat"] = bmicat
+    obese4cat = recode_bins(bmicat, [4, 5, 6], [1, 2, 3, 4])
+    obese4cat[np.isnan(bmicat)] = 1
+    out["obese4cat"] = obese4cat
+
+    # Sex
+    male = (chunk.labels("sex") == "M").astype(float)
+    out["male"] = male
+
+    # Smoking
+    smoke = pd.Series(chunk.labels("smoking_status")).map(SMOKING).to_numpy(dtype=float)
+    out["smoke"] = smoke
+    smoke_nomiss = np.where(np.isnan(smoke), 1, smoke)
+    out["smoke_nomiss"] = smoke_nomiss
+    out["smoke_nomiss2"] = np.where(smoke_nomiss == 3, 2, smoke_nomiss)
+
+    # Ethnicity
+    ethnicity = chunk.numbers("ethnicity")
+    eth5 = pd.Series(ethnicity).map(ETH5).fillna(6).to_numpy(dtype=float)
+    out["eth5"] = eth5
+    out["eth2"] = np.where(inrange(eth5, 2, 4), 5, eth5)
+    ethnicity_16 = chunk.numbers("ethnicity_16")
+    ethnicity_16[np.isnan(ethnicity)] = np.nan
+    out["ethnicity_16"] = ethnicity_16
+    out["ethnicity_16_combinemixed"] = np.where(inrange(ethnicity_16, 4, 7), 4, ethnicity_16)
+
+    # STP, UTLA and region
+    out["stp"] = pd.Series(chunk.labels("stp")).map(statistics["stp_numbers"]).to_numpy(dtype=float)
+    # merge m:1 msoa using MSOA_lookup, as a gather of integer UTLA ids
+    utla = utla_ids(msoa_ids(chunk.arrow_column("msoa"), msoa_index), msoa_index)
+    out["utla_group"] = utla_group_names(msoa_index)[utla]
+    out["region"] = pd.Series(chunk.labels("region")).map(REGIONS).to_numpy(dtype=float)
+
+    # Age
+    age = chunk.floats("age")
+    out["age"] = age
+    out["agegroup"] = recode_bins(age, [18, 30, 40, 50, 60, 70, 80], range(8))
+    agegroup_a = recode_bins(age, [65, 75, 85], [1, 2, 3, 4])
+    out["agegroupA"] = agegroup_a
+    out["agegroupB"] = np.where(agegroup_a == 4, 3, agegroup_a)
+    out["agegroup6"] = recode_bins(age, [40, 55, 65, 75, 85], range(6))
+    out["agegroup3"] = recode_bins(age, [40, 70], range(3))
+    out["age70"] = recode_bins(age, [70], [0, 1])
+    for i, spline in enumerate(restricted_cubic_spline(age - 65, statistics["age_knots"])):
+        out[f"age{i + 1}"] = spline
+
+    # IMD quintile, reversed so 5 is most deprived
+    imd_o = chunk.numbers("imd")
+    imd = np.searchsorted(statistics["imd_cuts"], imd_o, side="right") + 1.0
+    imd[np.isnan(imd_o) | (imd_o == -1)] = np.nan
+    out["imd"] = 6 - imd
+
+    # Household size, rural/urban, care home
+    household_size = chunk.floats("household_size")
+    out["hh_total_cat"] = recode_bins(household_size, [1, 3, 6, 11], [np.nan, 1, 2, 3, 4])
+    rural_urban = chunk.numbers("rural_urban")
+    out["rural_urban"] = rural_urban
+    out["rural_urban5"] = pd.Series(rural_urban).map(RURAL_URBAN5).to_numpy(dtype=float)
+    out["home_bin"] = np.isin(chunk.labels("care_home_type"), ["PC", "PN", "PS"]).astype(float)
+
+    # Comorbidities ever before study_start
+    flags = {
+        column: (dates[f"{column}_date" if column == "hiv" else column] < study_start).astype(float)
+        for column in COMORBIDITY_COLUMNS
+    }
+    out["chronic_cardiac_disease"] = flags["chronic_cardiac_disease"]
+    stroke_dementia = np.maximum(flags["stroke"], flags["dementia"])
+    spleen = np.maximum(flags["dysplenia"], flags["sickle_cell"])
+
+    # Cancer, grouped by time since diagnosis
+    five_years_before = study_start - 5 * 365.25
+    one_year_before = study_start - 365.25
+
+    def cancer_category(*cancer_dates):
+        category = np.ones(n)
+        for value, low, high in [
+            (4, day("1900-01-01"), five_years_before),
+            (3, five_years_before, one_year_before),
+            (2, one_year_before, study_start),
+        ]:
+            hit = np.zeros(n, dtype=bool)
+            for cancer_date in cancer_dates:
+                hit |= inrange(cancer_date, low, high)
+            category[hit] = value
+        return category
+
+    cancer_haem_cat = cancer_category(dates["haem_cancer"])
+    cancer_exhaem_cat = cancer_category(dates["lung_cancer"], dates["other_cancer"])
+
+    # Immunosuppression
+    other_immunosuppression = np.maximum.reduce([
+        flags["hiv"],
+        flags["permanent_immunodeficiency"],
+        inrange(dates["temporary_immunodeficiency"], one_year_before, study_start).astype(float),
+        inrange(dates["aplastic_anaemia"], one_year_before, study_start).astype(float),
+    ])
+
+    # eGFR, using the CKD-EPI formula with no ethnicity term
+    creatinine = chunk.floats("creatinine")
+    creatinine[~inrange(creatinine, 20, 3000)] = np.nan
+    scr_adj = creatinine / 88.4
+    with np.errstate(invalid="ignore", divide="ignore"):
+        egfr_min = np.where(male == 1, (scr_adj / 0.9) ** -0.411, (scr_adj / 0.7) ** -0.329)
+        egfr_min = np.where(egfr_min < 1, 1, egfr_min)
+        egfr_max = np.where(male == 1, scr_adj / 0.9, scr_adj / 0.7) ** -1.209
+        egfr_max = np.where(egfr_max > 1, 1, egfr_max)
+    egfr = egfr_min * egfr_max * 141 * 0.993 ** age
+    egfr = np.where(male == 0, egfr * 1.018, egfr)
+    # egen egfr_cat = cut(egfr), at(0, 15, 30, 45, 60, 5000), recoded to CKD stage
+    ckd = recode_bins(egfr, [0, 15, 30, 45, 60, 5000], [np.nan, 5, 4, 3, 2, 0, np.nan])
+    reduced_kidney_function_cat2 = recode_bins(ckd, [2, 4, 5], [1, 2, 3, 4])
+    reduced_kidney_function_cat2[np.isnan(creatinine)] = 1
+    reduced_kidney_function_cat2[flags["dialysis"] == 1] = 4
+    out["reduced_kidney_function_cat2"] = reduced_kidney_function_cat2
+    # Stata treats missing as larger than any number
+    egfr60 = (~(reduced_kidney_function_cat2 <= 1)).astype(float)
+    out["egfr60"] = egfr60
+
+    # HbA1c in the last 15 months, as a percentage
+    fifteen_months_before = study_start - 15 * (365.25 / 12)
+    hba1c_percentage = chunk.floats("hba1c_percentage")
+    hba1c_mmol_per_mol = chunk.floats("hba1c_mmol_per_mol")
+    hba1c_percentage[~(hba1c_percentage > 0)] = np.nan
+    hba1c_mmol_per_mol[~(hba1c_mmol_per_mol > 0)] = np.nan
+    hba1c_percentage[dates["hba1c_percentage_date"] < fifteen_months_before] = np.nan
+    hba1c_mmol_per_mol[dates["hba1c_mmol_per_mol_date"] < fifteen_months_before] = np.nan
+    hba1c_pct = np.where(
+        np.isnan(hba1c_mmol_per_mol), hba1c_percentage, hba1c_mmol_per_mol / 10.929 + 2.15
+    )
+    hba1c_pct[~inrange(hba1c_pct, 0, 20)] = np.nan
+    # round(x, 0.1), which rounds halves away from zero
+    hba1c_pct = np.floor(hba1c_pct * 10 + 0.5) / 10
+    hba1ccat = recode_bins(hba1c_pct, [6.5, 7.5, 8, 9], range(5))
+
+    # Diabetes, split by control
+    diabetes = flags["diabetes"]
+    diabcat = np.where(diabetes == 0, 1.0, 4.0)
+    diabcat[(diabetes == 1) & np.isin(hba1ccat, [0, 1])] = 2
+    diabcat[(diabetes == 1) & np.isin(hba1ccat, [2, 3, 4])] = 3
+    out["diabcat"] = diabcat
+    dm = (diabcat > 1).astype(float)
+    out["dm"] = dm
+
+    # Asthma (coded: 0 No, 1 Yes no OCS, 2 Yes with OCS)
+    asthma = chunk.numbers("asthma")
+    asthma_severe = (asthma == 2).astype(float)
+
+    # Aggregated comorbidities
+    renal_flag = np.isin(reduced_kidney_function_cat2, [2, 3, 4, 5]) | (flags["organ_transplant"] == 1)
+    out["renal_flag"] = renal_flag.astype(float)
+    total_comorbidities = (
+        flags["chronic_respiratory_disease"]
+        + asthma_severe
+        + flags["chronic_cardiac_disease"]
+        + dm
+        + (cancer_exhaem_cat == 2)
+        + inrange(cancer_haem_cat, 2, 3)
+        + flags["chronic_liver_disease"]
+        + stroke_dementia
+        + egfr60
+        + flags["organ_transplant"]
+        + spleen
+        + other_immunosuppression
+    )
+    out["comorb_cat"] = np.minimum(total_comorbidities, 2)
+
+    # Epidemiological week
+    start_week = np.full(n, np.nan)
+    for week, saturday in EPI_WEEKS:
+        start_week[study_start <= day(saturday)] = week
+    out["start_week"] = start_week
+
+    # Outcomes and survival time
+    ec_data_cens = day(EC_DATA_DATE) - 7
+    ae_covid_date = dates["ae_covid_date"]
+    died_date_ons = dates["died_date_ons"]
+    out["ec_data_cens"] = np.full(n, ec_data_cens)
+    out["ae_14_pop"] = (study_start + 14 <= ec_data_cens).astype(float)
+    out["ae_covid_date"] = ae_covid_date
+    out["died_date_ons"] = died_date_ons
+    ae_pre_cens = ae_covid_date < ec_data_cens
+    out["ae_pre_cens"] = ae_pre_cens.astype(float)
+    out["ae_time"] = np.where(ae_pre_cens, ae_covid_date - study_start, np.nan)
+    any_ae = ~np.isnan(ae_covid_date)
+    out["any_ae"] = any_ae.astype(float)
+    out["all_ae"] = (~np.isnan(dates["ae_any_date"])).astype(float)
+    out["died"] = (~np.isnan(died_date_ons)).astype(float)
+
+    ae_destination = chunk.numbers("ae_destination")
+    out["ae_destination"] = ae_destination
+    ae_dest = pd.Series(ae_destination).map(AE_DESTINATIONS).fillna("")
+    out["ae_dest"] = ae_dest.to_numpy(dtype=object)
+    ae_admit = np.where(ae_dest == "", np.nan, (ae_dest == "Admitted").astype(float))
+    out["ae_admit"] = ae_admit
+
+    out["cox_pop"] = (study_start < ec_data_cens).astype(float)
+    out.update(survival_columns(study_start, ae_covid_date, died_date_ons, ec_data_cens, ae_admit))
+
+    prepared = pd.DataFrame(out)
+    # drop if imd>=.
+    return prepared[~np.isnan(prepared["imd"])].reset_index(drop=True)
+
+
+# OUTPUT
+DATE_OUTPUTS = [
+    "study_start",
+    "study_end",
+    "bmi_date_measured",
+    "ec_data_cens",
+    "ae_covid_date",
+    "died_date_ons",
+    "ae_surv_d",
+    "ae_surv_d1",
+    "ae_surv_d14",
+]
+FLOAT_OUTPUTS = ["age1", "age2", "age3", "bmi", "ae_time", "cox_ae_time"]
+STRING_OUTPUTS = ["utla_group", "ae_dest"]
+INT64_OUTPUTS = ["patient_id", "ae_destination"]
+
+# The columns of main.parquet, in the order prepare_chunk makes them, so the
+# file has the same schema whether or not any rows survive the exclusions
+OUTPUT_COLUMNS = [
+    "patient_id", "study_start", "study_end", "sgtf", "has_sgtf", "vax", "prev_inf",
+    "bmi", "bmi_date_measured", "bmicat", "obese4cat", "male",
+    "smoke", "smoke_nomiss", "smoke_nomiss2",
+    "eth5", "eth2", "ethnicity_16", "ethnicity_16_combinemixed",
+    "stp", "utla_group", "region",
+    "age", "agegroup", "agegroupA", "agegroupB", "agegroup6", "agegroup3", "age70", "age1", "age2", "age3",
+    "imd", "hh_total_cat", "rural_urban", "rural_urban5", "home_bin",
+    "chronic_cardiac_disease", "reduced_kidney_function_cat2", "egfr60", "diabcat", "dm", "renal_flag", "comorb_cat",
+    "start_week", "ec_data_cens", "ae_14_pop", "ae_covid_date", "died_date_ons", "ae_pre_cens", "ae_time",
+    "any_ae", "all_ae", "died", "ae_destination", "ae_dest", "ae_admit", "cox_pop",
+    "ae_surv_d", "ae_surv_d1", "ae_surv_d14", "cox_ae", "cox_ae14", "cox_admit", "cox_ae_time",
+]
+
+
+def output_type(column):
+    if column in DATE_OUTPUTS:
+        return pa.date32()
+    if column in FLOAT_OUTPUTS:
+        return pa.float32()
+    if column in STRING_OUTPUTS:
+        return pa.string()
+    if column in INT64_OUTPUTS:
+        return pa.int64()
+    return pa.int16()
+
+
+def output_schema():
+    return pa.schema([(column, output_type(column)) for column in OUTPUT_COLUMNS])
+
+
+def to_arrow(prepared):
+    arrays = []
+    for column in OUTPUT_COLUMNS:
+        values = prepared[column].to_numpy()
+        arrow_type = output_type(column)
+        if pa.types.is_string(arrow_type):
+            arrays.append(pa.array(values, type=arrow_type))
+            continue
+        missing = np.isnan(values)
+        if pa.types.is_date32(arrow_type):
+            integers = np.where(missing, 0, values).astype(np.int32)
+            arrays.append(pa.array(integers, mask=missing).cast(arrow_type))
+        elif pa.types.is_floating(arrow_type):
+            arrays.append(pa.array(values.astype(np.float32), mask=missing))
+        else:
+            integers = np.where(missing, 0, values).astype(arrow_type.to_pandas_dtype())
+            arrays.append(pa.array(integers, mask=missing))
+    return pa.Table.from_arrays(arrays, schema=output_schema())
+
+
+def utla_group_names(msoa_index):
+    # utla_group for each UTLA id ("" for the missing id, -1)
+    return np.array(
+        [UTLA_GROUPS.get(name, name) for name in msoa_index.utla_names], dtype=object
+    )
+
+
+def prepare(input_path, output_path, chunk_size=CHUNK_SIZE, statistics=None):
+    if statistics is None:
+        statistics = collect_statistics(input_path, chunk_size)
+    msoa_index = msoa_utla_index()
+    counts = Counter()
+    rows = 0
+    # Written even if no chunk arrives or no row survives, so the analyses
+    # read an empty cohort rather than a missing file
+    with pq.ParquetWriter(output_path, output_schema()) as writer:
+        for chunk in cohort_chunks(input_path, INPUT_COLUMNS, chunk_size):
+            counts["input rows"] += len(chunk)
+            chunk = apply_exclusions(chunk, counts)
+            # Nothing to derive, and no age knots if no row survives anywhere
+            if not len(chunk):
+                continue
+            prepared = prepare_chunk(chunk, statistics, msoa_index)
+            counts["no IMD"] += len(chunk) - len(prepared)
+            writer.write_table(to_arrow(prepared))
+            rows += len(prepared)
+    counts["output rows"] = rows
+    return counts
+
+
+# SHARDED
+def prepare_shard(paths, chunk_size, statistics):
+    # One shard, sorted by patient_id for the merge
+    input_path, output_path = paths
+    counts = prepare(input_path, output_path, chunk_size, statistics)
+    if counts["output rows"]:
+        sort_file(output_path, "patient_id")
+    return counts
+
+
+def prepare_sharded(input_path, output_path, shard_by, chunk_size=CHUNK_SIZE, workers=1, directory="output/shards"):
+    summaries = (Counter(), Counter(), set())
+
+    def chunks():
+        for chunk in cohort_chunks(input_path, INPUT_COLUMNS, chunk_size):
+            add_statistics(summaries, chunk)
+            yield chunk
+
+    inputs = split_chunks(chunks(), shard_by, directory)
+    statistics = statistics_from(summaries)
+    jobs = [(path, os.path.join(directory, f"main_{name}.parquet")) for name, path in sorted(inputs.items())]
+    prepare_one = partial(prepare_shard, chunk_size=chunk_size, statistics=statistics)
+    # No shards at all for an empty extract
+    if workers == 1 or len(jobs) < 2:
+        results = [prepare_one(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            results = list(pool.map(prepare_one, jobs))
+
+    counts = Counter()
+    for result in results:
+        counts.update(result)
+    prepared = [output for (_, output), result in zip(jobs, results) if result["output rows"]]
+    merge_sorted(prepared, output_path, "patient_id", schema=output_schema())
+    for path, _ in jobs:
+        os.remove(path)
+    counts["shards"] = len(jobs)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input.csv")
+    parser.add_argument("--output", default="output/main.parquet")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--shard-by", choices=["region", "stp"], help="prepare the cohort in shards on a process pool")
+    parser.add_argument("--shard-dir", default="output/shards")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    options = parser.parse_args()
+
+    if options.shard_by:
+        counts = prepare_sharded(
+            options.input, options.output, options.shard_by, options.chunk_size, options.workers, options.shard_dir
+        )
+    else:
+        counts = prepare(options.input, options.output, options.chunk_size)
+    for label, count in counts.items():
+        print(f"{label}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import re
+import weakref
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pyarrow as pa
+
+
+# DATE EXPRESSIONS
+# The dates study definitions give as arguments: fixed ("2021-10-03"), another
+# variable's date ("sgss_pos_inrange"), or either shifted by whole days,
+# months or years ("sgss_pos_inrange - 1 year", "vaxdate1 + 19 days"),
+# optionally through cohortextractor's first/last_day_of_month/year:
+#   expression := term (("+" | "-") number unit)*
+#   term       := YYYY-MM-DD | name | function "(" expression ")"
+# Each expression is parsed once into a small tree and evaluated over whole
+# columns of datetime64[D] (int64 days since 1970-01-01 underneath), with NaT
+# for missing dates. Missing anchors stay missing, and months and years keep
+# the day of the month, or use the last day of a shorter month
+# ("2020-02-29 + 1 year" is 2021-02-28), as SQL Server's DATEADD does.
+#
+# Results are memoized on the expression and the anchor column they were
+# computed from, so the variables that share "sgss_pos_inrange - 7 days"
+# (and so on) evaluate it once. The memo holds only a weak reference to the
+# anchor and drops the result as soon as the anchor is freed, so a batch's
+# results go with its columns. The memoized arrays are read-only.
+#
+# iso_days reads YYYY-MM-DD strings as day numbers, as date(x, "YMD") does in
+# cr_main.do, by arithmetic on the bytes of each distinct string rather than
+# by a date parser.
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+TOKEN = re.compile(
+    r"\s*(?:(?P<date>\d{4}-\d{2}-\d{2})|(?P<number>\d+)|(?P<sign>[+-])|(?P<paren>[()])|(?P<word>[A-Za-z_]\w*))"
+)
+UNITS = {"day": "day", "days": "day", "month": "month", "months": "month", "year": "year", "years": "year"}
+EPOCH = np.datetime64("1970-01-01", "D")
+CACHE_SIZE = 64
+
+Fixed = namedtuple("Fixed", "date")
+Anchor = namedtuple("Anchor", "name")
+Function = namedtuple("Function", "name operand")
+Shift = namedtuple("Shift", "operand number unit")
+
+
+# ARITHMETIC
+# Months and years are shifted on (year, month, day) computed from the day
+# numbers with integer arithmetic (Howard Hinnant's civil date algorithms),
+# rather than numpy's much slower datetime64[M] conversions, and only once
+# for each day in the column's range
+MONTH_DAYS = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def days_from_civil(year, month, day):
+    # Days since 1970-01-01 of proleptic Gregorian dates (years counted from
+    # March, so leap days fall last)
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def civil_from_days(days):
+    # (year, month, day) of days since 1970-01-01
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = shifted_month + np.where(shifted_month < 10, 3, -9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def month_length(year, month):
+    leap = (month == 2) & (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return MONTH_DAYS[month] + leap
+
+
+def shift_days(days, months):
+    year, month, day = civil_from_days(days)
+    months = year * 12 + month - 1 + months
+    year, month = months // 12, months % 12 + 1
+    return days_from_civil(year, month, np.minimum(day, month_length(year, month)))
+
+
+def shift_dates(dates, number, unit):
+    if unit == "day":
+        return dates + np.timedelta64(number, "D")
+    # Months and years keep the day of the month, or use the last day of a
+    # shorter month
+    months = number * 12 if unit == "year" else number
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    missing = np.isnat(dates)
+    present = dates.view(np.int64)[~missing]
+    low = present.min() if len(present) else 0
+    days = np.where(missing, low, dates.view(np.int64))
+    if len(present) and present.max() - low < days.size:
+        # Each day in the column's range is shifted once and looked up
+        days = shift_days(np.arange(low, present.max() + 1), months)[days - low]
+    else:
+        days = shift_days(days, months)
+    shifted = np.where(missing, np.datetime64("NaT", "D"), np.asarray(days).astype("datetime64[D]"))
+    return shifted if shifted.ndim else shifted[()]
+
+
+def first_day_of(dates, unit):
+    return dates.astype(f"datetime64[{unit}]").astype("datetime64[D]")
+
+
+def last_day_of(dates, unit):
+    return (dates.astype(f"datetime64[{unit}]") + 1).astype("datetime64[D]") - np.timedelta64(1, "D")
+
+
+FUNCTIONS = {
+    "first_day_of_month": lambda dates: first_day_of(dates, "M"),
+    "last_day_of_month": lambda dates: last_day_of(dates, "M"),
+    "first_day_of_year": lambda dates: first_day_of(dates, "Y"),
+    "last_day_of_year": lambda dates: last_day_of(dates, "Y"),
+}
+
+
+# PARSING
+class Parser:
+    """A recursive descent parser over the tokens of one date expression."""
+
+    def __init__(self, value):
+        self.value = value
+        self.tokens = []
+        position = 0
+        text = value.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if match is None:
+                raise self.error()
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        self.position = 0
+
+    def error(self):
+        return ValueError(f"Unsupported date expression '{self.value}'")
+
+    def take(self, kind):
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == kind:
+            self.position += 1
+            return self.tokens[self.position - 1][1]
+        return None
+
+    def parse(self):
+        node = self.expression()
+        if self.position != len(self.tokens):
+            raise self.error()
+        return node
+
+    def expression(self):
+        node = self.term()
+        while True:
+            sign = self.take("sign")
+            if sign is None:
+                return node
+            number, unit = self.take("number"), self.take("word")
+            if number is None or unit not in UNITS:
+                raise self.error()
+            node = Shift(node, int(number) if sign == "+" else -int(number), UNITS[unit])
+
+    def term(self):
+        date = self.take("date")
+        if date is not None:
+            return Fixed(np.datetime64(date, "D"))
+        name = self.take("word")
+        if name is None:
+            raise self.error()
+        if name not in FUNCTIONS:
+            return Anchor(name)
+        if self.take("paren") != "(":
+            raise self.error()
+        node = Function(name, self.expression())
+        if self.take("paren") != ")":
+            raise self.error()
+        return node
+
+
+@lru_cache(maxsize=None)
+def parse_date(value):
+    return Parser(value).parse()
+
+
+def anchor_of(node):
+    # The variable a parsed expression is relative to, or None for a fixed date
+    while isinstance(node, (Function, Shift)):
+        node = node.operand
+    return node.name if isinstance(node, Anchor) else None
+
+
+def date_anchor(value):
+    # The variable a date expression is relative to, or None for a fixed
+    # date; raises ValueError for anything else
+    if value is None:
+        return None
+    return anchor_of(parse_date(value))
+
+
+# EVALUATING
+_results = OrderedDict()
+
+
+def evaluate_node(node, columns):
+    if isinstance(node, Fixed):
+        return node.date
+    if isinstance(node, Anchor):
+        return np.asarray(columns[node.name]).astype("datetime64[D]", copy=False)
+    anchor = columns[anchor_of(node)] if anchor_of(node) is not None else None
+    key = (node, id(anchor))
+    cached = _results.get(key)
+    if cached is not None and (cached[0] is None or cached[0]() is anchor):
+        _results.move_to_end(key)
+        return cached[1]
+
+    dates = evaluate_node(node.operand, columns)
+    if isinstance(node, Function):
+        result = FUNCTIONS[node.name](dates)
+    else:
+        result = shift_dates(dates, node.number, node.unit)
+    if isinstance(result, np.ndarray):
+        result.flags.writeable = False
+    # Freeing the anchor drops its results before its id can be reused
+    reference = None if anchor is None else weakref.ref(anchor, lambda _, key=key: _results.pop(key, None))
+    _results[key] = (reference, result)
+    if len(_results) > CACHE_SIZE:
+        _results.popitem(last=False)
+    return result
+
+
+def evaluate_date(value, columns):
+    # A datetime64[D] for a fixed date, an array over the patients for one
+    # relative to a column, or None for no date
+    if value is None:
+        return None
+    return evaluate_node(parse_date(value), columns)
+
+
+def evaluate_days(value, columns, rows):
+    # (days since 1970-01-01, missing) for every patient, with 0 under missing
+    dates = np.broadcast_to(evaluate_date(value, columns), rows)
+    missing = np.isnat(dates)
+    return np.where(missing, 0, (dates - EPOCH).astype(np.int64)), missing
+
+
+def clear_cache():
+    _results.clear()
+
+
+# READING DATES
+def parse_iso(text, day=None):
+    # (days, valid) for an array of distinct YYYY-MM-DD (or YYYY-MM) strings
+    width = 11 if day is None else 8
+    # As code points, so any text can be checked: every position must be a
+    # digit, a "-" or (the last) the end of the string
+    characters = np.asarray(text, dtype=f"U{width}").view(np.uint32).reshape(len(text), width)
+    # Characters below "0" wrap round to above 9
+    positions = [0, 1, 2, 3, 5, 6] if day is not None else [0, 1, 2, 3, 5, 6, 8, 9]
+    digits = (characters[:, positions] - np.uint32(ord("0"))).astype(np.int64)
+    valid = np.all(digits <= 9, axis=1) & (characters[:, 4] == ord("-")) & (characters[:, width - 1] == 0)
+    if day is None:
+        valid &= characters[:, 7] == ord("-")
+        day = digits[:, 6] * 10 + digits[:, 7]
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    valid &= (month >= 1) & (month <= 12) & (day >= 1)
+    month = np.where(valid, month, 1)
+    valid &= day <= month_length(year, month)
+    return np.where(valid, days_from_civil(year, month, day), 0), valid
+
+
+def iso_days(values, day=None):
+    # (days since 1970-01-01, missing) for YYYY-MM-DD strings, or for YYYY-MM
+    # strings on the given day of the month; blanks, None, NaN and anything
+    # that is not a valid date are missing, with 0 under them. A column has
+    # few distinct dates, so each is parsed once
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if not isinstance(values, pa.Array):
+        values = pa.array(np.asarray(values, dtype=object), pa.string(), from_pandas=True)
+    if not pa.types.is_dictionary(values.type):
+        values = values.dictionary_encode()
+    dictionary = values.dictionary.to_numpy(zero_copy_only=False)
+    days, valid = parse_iso(dictionary, day)
+    indices = values.indices.fill_null(len(dictionary)).to_numpy(zero_copy_only=False)
+    days, valid = np.append(days, 0)[indices], np.append(valid, False)[indices]
+    return days, ~valid
+
@@ -1,6 +1,5 @@
-import pandas as pd
+from msoa_lookup import uniform_msoa_ratios
 
-MSOAs = pd.read_csv(
-    filepath_or_buffer = './lookups/MSOAs.csv'
-)
-dict_msoa = { msoa : 1/len(MSOAs.index) for msoa in MSOAs['msoa_id'].tolist() }
\ No newline at end of file
+# Equal ratios for every MSOA code in lookups/MSOAs.csv (for dummy data). The
+# file is only read when the ratios are first used
+dict_msoa = uniform_msoa_ratios()
@@ -0,0 +1,295 @@
+import argparse
+import copy
+import csv
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import cohortextractor
+import numpy as np
+import pyarrow as pa
+from cohortextractor.study_definition import merge
+
+from cohort_schema import cohort_schema
+from cr_columnar import to_record_batch, write_batches
+from date_expressions import evaluate_date
+from extract_scheduler import extract_serial, merge_columns
+from study_graph import VariableGraph
+
+
+# HIGH VOLUME DUMMY DATA
+# Generates dummy cohorts from the return_expectations in the StudyDefinition,
+# as cohortextractor's make_df_from_expectations does, but with numpy and one
+# batch of rows at a time, so tens of millions of rows can be written to
+# Parquet (typed as in cr_columnar.py) or CSV without holding them in memory.
+# Differences from cohortextractor's dummy data:
+#   - date filters are honoured, including ones that refer to other variables
+#     (vaxdate2 falls on or after vaxdate1 + 19 days, last_pos_test_sgss on or
+#     before sgss_pos_inrange - 7 days). Dates are drawn inside the allowed
+#     window rather than blanked when they fall outside it, so incidences
+#     hold; a date is missing if the date it refers to is missing
+#   - incidence is applied row by row rather than as an exact count
+#   - as in cohortextractor, the population definition is not applied
+# Each variable in each batch has its own random stream derived from --seed,
+# so the output depends only on the seed, the number of rows and the batch
+# size, and not on the order the variables are generated in.
+BATCH_SIZE = 1_000_000
+
+
+UNSUPPORTED = ("aggregate_of", "with_value_from_file", "which_exist_in_file", "fixed_value")
+
+DummyVariable = namedtuple("DummyVariable", "name dtype expectations between date_column")
+
+
+# WORKING OUT WHAT TO GENERATE
+def variable_expectations(study, name):
+    args = study.pandas_csv_args["args"][name]
+    if "source" in args:
+        # include_date_of_match columns share the expectations of their source
+        args = study.pandas_csv_args["args"][args["source"]]
+    expectations = args["return_expectations"] or {}
+    if not study.default_expectations and not expectations:
+        raise ValueError(
+            f"No `return_expectations` defined for {name} "
+            "and no `default_expectations` defined for the study"
+        )
+    return merge(study.default_expectations, expectations)
+
+
+def date_filter(study, name):
+    args = study.pandas_csv_args["args"][name]
+    if "source" in args:
+        args = study.pandas_csv_args["args"][args["source"]]
+    return args.get("between") or (None, None)
+
+
+def dummy_variables(study):
+    csv_args = study.pandas_csv_args
+    for name, args in csv_args["args"].items():
+        if args["funcname"] in UNSUPPORTED:
+            raise ValueError(f"Dummy data for {args['funcname']} ({name}) is not supported")
+
+    variables = {}
+    for name in csv_args["parse_dates"]:
+        expectations = variable_expectations(study, name)
+        study.check_date_expectations_defined(name, expectations)
+        variables[name] = DummyVariable(name, "date", expectations, date_filter(study, name), None)
+
+    for name, dtype in csv_args["dtype"].items():
+        expectations = variable_expectations(study, name)
+        if dtype == "category":
+            study.validate_category_expectations(
+                **dict(csv_args["args"][name], return_expectations=expectations)
+            )
+        expected = {"Int64": "int"}.get(dtype, dtype)
+        if expected not in expectations and dtype != "bool":
+            raise ValueError(f"Column definition {name} does not return expected type {dtype}")
+        date_column = csv_args["date_col_for"].get(name)
+        variables[name] = DummyVariable(name, dtype, expectations, None, date_column)
+    return variables
+
+
+# DATES
+def presence(rows, expectations, rng):
+    if expectations.get("rate") == "universal":
+        return np.ones(rows, dtype=bool)
+    incidence = expectations.get("incidence")
+    if incidence is None:
+        raise ValueError("You must specify an incidence, or a `universal` rate")
+    return rng.random(rows) < incidence
+
+
+def date_fractions(rate, rows, rng):
+    # How far back from the latest allowed date each date falls, as a fraction
+    # of the window
+    u = rng.random(rows)
+    if rate in ("uniform", "universal"):
+        return u
+    if rate == "exponential_increase":
+        # cohortextractor's exponential (scale 0.1 of the window), truncated
+        # to the window
+        return -0.1 * np.log1p(-u * (1 - np.exp(-10)))
+    raise ValueError("Only exponential_increase and uniform distributions currently supported")
+
+
+def generate_dates(variable, columns, rows, rng):
+    expectations = variable.expectations
+    lower = np.datetime64(expectations["date"]["earliest"], "D")
+    upper = np.datetime64(expectations["date"]["latest"], "D")
+    start, end = (evaluate_date(value, columns) for value in variable.between)
+    if start is not None:
+        lower = np.maximum(lower, start)
+    if end is not None:
+        upper = np.minimum(upper, end)
+    lower = np.broadcast_to(lower, rows)
+    upper = np.broadcast_to(upper, rows)
+    # Comparisons with NaT are False, so this also drops rows whose
+    # reference date is missing
+    present = presence(rows, expectations, rng) & (upper >= lower)
+    span = np.where(present, (upper - lower).view(np.int64), 0)
+    fraction = date_fractions(expectations.get("rate", "exponential_increase"), rows, rng)
+    days_back = np.floor(fraction * (span + 1)).astype("timedelta64[D]")
+    dates = upper - days_back
+    dates[~present] = np.datetime64("NaT")
+    return dates
+
+
+# VALUES
+@lru_cache(maxsize=None)
+def population_age_probabilities(max_age=110):
+    # cohortextractor's UK population shape: each age gets a fifth of its five
+    # year band, with the most common age trimmed so the total is 1
+    path = os.path.join(os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv")
+    with open(path, newline="") as f:
+        bands = list(csv.DictReader(f))
+    ends = np.array([int(band["band"].split("-")[1]) for band in bands])
+    counts = np.array([int(band["range"].replace(",", "")) for band in bands])
+    probabilities = counts[np.searchsorted(ends, np.arange(max_age))] / counts.sum() / 5
+    probabilities[np.argmax(probabilities)] -= probabilities.sum() - 1
+    return probabilities
+
+
+def generate_ints(expected, rows, rng):
+    distribution = expected["distribution"]
+    if distribution == "normal":
+        return rng.normal(expected["mean"], expected["stddev"], rows).astype(np.int64)
+    if distribution == "poisson":
+        return rng.poisson(expected["mean"], rows)
+    if distribution == "population_ages":
+        probabilities = population_age_probabilities()
+        return rng.choice(len(probabilities), size=rows, p=probabilities)
+    raise ValueError(
+        "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+    )
+
+
+def generate_floats(expected, rows, rng):
+    if expected["distribution"] == "normal":
+        return rng.normal(expected["mean"], expected["stddev"], rows)
+    raise ValueError("Only `normal` distributions currently supported for floats")
+
+
+def generate_categories(ratios, present, rng):
+    rows = len(present)
+    if hasattr(ratios, "codes"):
+        # Equal ratios over an array of codes (dict_msoa)
+        labels = ratios.codes
+        indices = rng.integers(len(labels), size=rows)
+    else:
+        labels = np.array(list(ratios.keys()), dtype=str)
+        probabilities = np.array(list(ratios.values()), dtype=float)
+        indices = rng.choice(len(labels), size=rows, p=probabilities / probabilities.sum())
+    # A "" category is a missing value in the extract
+    empty = labels == ""
+    missing = ~present | empty[indices]
+    if empty.any():
+        indices = (np.cumsum(~empty) - 1)[indices]
+        labels = labels[~empty]
+    return pa.DictionaryArray.from_arrays(
+        pa.array(indices.astype(np.int32), mask=missing), pa.array(labels)
+    )
+
+
+def generate_values(variable, present, rng):
+    rows = len(present)
+    expectations = variable.expectations
+    if variable.dtype == "category":
+        return generate_categories(expectations["category"]["ratios"], present, rng)
+    if variable.dtype == "bool":
+        return present.copy()
+    if variable.dtype == "Int64":
+        values = generate_ints(expectations["int"], rows, rng)
+    else:
+        values = generate_floats(expectations["float"], rows, rng)
+    # Missing numbers are 0, as they are in the extract
+    values[~present] = 0
+    return values
+
+
+# VARIABLES
+class DummyBackend:
+    """Dummy values for the variables of a StudyDefinition, one at a time.
+
+    `extract(name, columns)` takes the columns of the variables `name` depends
+    on and returns the columns it produces: dates are datetime64[D] arrays
+    (NaT where missing), categories dictionary arrays and everything else
+    numpy arrays. Hidden variables have no dummy data.
+    """
+
+    def __init__(self, study, rows, seed=0, batch=0):
+        self.rows = rows
+        self.seed = seed
+        self.batch = batch
+        self.variables = dummy_variables(study)
+        self.positions = {name: i for i, name in enumerate(study.covariate_definitions)}
+        # include_date_of_match dates are made along with their values, so
+        # the values can follow their incidence
+        self.sources = {date: value for value, date in study.pandas_csv_args["date_col_for"].items()}
+
+    def for_batch(self, batch, rows):
+        backend = copy.copy(self)
+        backend.batch = batch
+        backend.rows = rows
+        return backend
+
+    def random_stream(self, name):
+        key = (self.batch, self.positions[name])
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=key))
+
+    def extract(self, name, columns):
+        if name in self.sources:
+            return {name: columns[name]}
+        if name not in self.variables:
+            return {}
+        rng = self.random_stream(name)
+        variable = self.variables[name]
+        if variable.dtype == "date":
+            return {name: generate_dates(variable, columns, self.rows, rng)}
+        if variable.date_column:
+            dates = generate_dates(self.variables[variable.date_column], columns, self.rows, rng)
+            return {variable.date_column: dates, name: generate_values(variable, ~np.isnat(dates), rng)}
+        present = presence(self.rows, variable.expectations, rng)
+        return {name: generate_values(variable, present, rng)}
+
+
+def study_backend(rows, seed=0):
+    # For worker processes, which need to load the study definition themselves
+    from study_definition import study
+
+    return DummyBackend(study, rows, seed)
+
+
+# BATCHES
+def generate_batches(study, rows, batch_size=BATCH_SIZE, seed=0):
+    graph = VariableGraph.from_study(study)
+    backend = DummyBackend(study, rows, seed)
+    schema = cohort_schema(study)
+    first_id = 1
+    for batch, start in enumerate(range(0, rows, batch_size)):
+        size = min(batch_size, rows - start)
+        results = extract_serial(graph, backend.for_batch(batch, size))
+        yield to_record_batch(merge_columns(results), schema, first_id)
+        first_id += size
+
+
+def write_dummy_cohort(study, path, rows, batch_size=BATCH_SIZE, seed=0):
+    batches = generate_batches(study, rows, batch_size, seed)
+    write_batches(batches, cohort_schema(study), path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="output/dummy_input.parquet")
+    options = parser.parse_args()
+
+    from study_definition import study
+
+    write_dummy_cohort(study, options.output, options.rows, options.batch_size, options.seed)
+    print(f"Wrote {options.rows} rows to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
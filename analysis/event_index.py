@@ -0,0 +1,226 @@
+import numpy as np
+import pyarrow as pa
+
+from codelist_matcher import CodelistMatcher, study_codelists
+from date_expressions import evaluate_days
+from query_plan import frozen
+from sqlite_backend import SQLiteBackend, is_last
+
+
+# PER-PATIENT EVENT INDEX
+# Events held as flat arrays sorted by patient and then date, with each
+# patient's run found by offsets (CSR, as in a sparse matrix). Each event
+# also has a key, patient * span + day, so the keys are sorted too and a
+# window [lower, upper] for every patient at once is two np.searchsorted
+# calls over the keys: the first event on or after each patient's lower
+# bound and the first after their upper bound. From those positions
+#   count  = stop - start
+#   first  = the event at start, last = the event at stop - 1
+#   mean on the most recent day = a difference of cumulative sums from the
+#          first event on the last event's day up to stop
+# with no per-patient loop and no filtering of rows. Bounds can be fixed
+# dates or per-patient dates ("sgss_pos_inrange - 7 days"); a patient whose
+# bound is missing has an empty window.
+#
+# IndexedBackend answers the event queries of the local database
+# (sqlite_backend.py) from indexes built once per process: clinical events
+# and medications are read in one pass, tagged against every codelist by a
+# CodelistMatcher, and each codelist gets the index of its matching events.
+# Events on the same day are ordered by code and then value, missing first,
+# as the SQL queries order them, so both pick the same event from a tie.
+class EventIndex:
+    """Events grouped by patient in date, code and value order, with CSR offsets."""
+
+    def __init__(self, offsets, dates, values=None, codes=None):
+        self.offsets = offsets
+        self.dates = dates
+        self.values = values
+        self.codes = codes
+        self.rows = len(offsets) - 1
+        patients = np.repeat(np.arange(self.rows, dtype=np.int64), np.diff(offsets))
+        self.origin = int(dates.min()) if len(dates) else 0
+        # Wider than any day, so a bound one past the last day stays
+        # below the next patient's keys
+        self.span = (int(dates.max()) - self.origin + 2) if len(dates) else 2
+        self.keys = patients * self.span + (dates - self.origin)
+        self._sums = None
+
+    def __len__(self):
+        return len(self.dates)
+
+    @classmethod
+    def from_events(cls, patients, dates, rows, values=None, codes=None):
+        # patients are positions 0..rows-1; events can come in any order.
+        # codes are rows of a CodelistMatcher's sorted table, so they order
+        # the events as the codes themselves do
+        keys = [dates, patients]
+        if codes is not None:
+            keys.insert(0, codes)
+        if values is not None:
+            values = np.asarray(values, dtype=float)
+            keys[:0] = [np.nan_to_num(values), ~np.isnan(values)]
+        order = np.lexsort(keys)
+        offsets = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(patients, minlength=rows), out=offsets[1:])
+        return cls(
+            offsets,
+            np.asarray(dates, dtype=np.int64)[order],
+            None if values is None else np.asarray(values, dtype=float)[order],
+            None if codes is None else np.asarray(codes)[order],
+        )
+
+    def subset(self, mask):
+        # The index of the events where mask is True
+        offsets = np.zeros(self.rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.keys[mask] // self.span, minlength=self.rows), out=offsets[1:])
+        return EventIndex(
+            offsets,
+            self.dates[mask],
+            None if self.values is None else self.values[mask],
+            None if self.codes is None else self.codes[mask],
+        )
+
+    # WINDOWS
+    def window(self, lower=None, upper=None):
+        # (start, stop) of each patient's events between lower and upper
+        # inclusive: None, a day, or an array of days with a mask of missing
+        base = np.arange(self.rows, dtype=np.int64) * self.span
+        empty = np.zeros(self.rows, dtype=bool)
+        if lower is None:
+            start = self.offsets[:-1].copy()
+        else:
+            days, missing = lower
+            start = np.searchsorted(self.keys, base + np.clip(days - self.origin, 0, self.span - 1), "left")
+            empty |= missing
+        if upper is None:
+            stop = self.offsets[1:].copy()
+        else:
+            days, missing = upper
+            stop = np.searchsorted(self.keys, base + np.clip(days - self.origin, -1, self.span - 1), "right")
+            empty |= missing
+        stop = np.maximum(stop, start)
+        stop[empty] = start[empty]
+        return start, stop
+
+    def first(self, start, stop):
+        # Position of each patient's first event in the window, -1 for none
+        return np.where(stop > start, start, -1)
+
+    def last(self, start, stop):
+        return np.where(stop > start, stop - 1, -1)
+
+    def mean_on_last_day(self, start, stop):
+        # (position of the last event, mean of the values on its day)
+        last = self.last(start, stop)
+        found = last >= 0
+        if self._sums is None:
+            present = ~np.isnan(self.values)
+            self._sums = (
+                np.concatenate([[0], np.cumsum(np.where(present, self.values, 0))]),
+                np.concatenate([[0], np.cumsum(present)]),
+            )
+        sums, counts = self._sums
+        day = np.where(found, self.dates[np.maximum(last, 0)], self.origin)
+        patients = np.arange(self.rows, dtype=np.int64)
+        day_start = np.maximum(np.searchsorted(self.keys, patients * self.span + day - self.origin, "left"), start)
+        n = counts[stop] - counts[day_start]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (sums[stop] - sums[day_start]) / n
+        means[~found | (n == 0)] = np.nan
+        return last, means
+
+
+def bound_days(value, columns, rows):
+    # A between bound as (days, missing) for every patient, or None
+    if value is None:
+        return None
+    return evaluate_days(value, columns, rows)
+
+
+# EXTRACTING FROM INDEXES
+INDEXED_TABLES = {
+    "with_these_clinical_events": "clinical_event",
+    "mean_recorded_value": "clinical_event",
+    "with_these_medications": "medication",
+}
+
+
+class IndexedBackend(SQLiteBackend):
+    """The local database backend, with event queries answered from event indexes."""
+
+    def __init__(self, path, study):
+        super().__init__(path, study)
+        lists, _ = study_codelists(study.covariate_definitions)
+        self.matchers = {system: CodelistMatcher(system, codelists) for system, codelists in lists.items()}
+        self.list_names = {frozen(codes): (system, name) for system, named in lists.items() for name, codes in named.items()}
+        self.tables = {}
+        self.indexes = {}
+
+    def query(self, funcname, args, columns):
+        if funcname not in INDEXED_TABLES:
+            return super().query(funcname, args, columns)
+        system, list_name = self.list_names[frozen(args["codelist"])]
+        index = self.codelist_index(INDEXED_TABLES[funcname], system, list_name)
+        between = args.get("between") or (None, None)
+        start, stop = index.window(*(bound_days(value, columns, self.rows) for value in between))
+        self.rows_scanned += int((stop - start).sum())
+
+        if funcname == "mean_recorded_value":
+            picked, means = index.mean_on_last_day(start, stop)
+            found = picked >= 0
+            return {
+                "date": (np.flatnonzero(found), index.dates[picked[found]]),
+                "numeric_value": (np.flatnonzero(found), means[found]),
+            }
+        picked = index.last(start, stop) if is_last(args) else index.first(start, stop)
+        found = np.flatnonzero(picked >= 0)
+        picked = picked[found]
+        counts = stop - start
+        fields = {
+            "date": (found, index.dates[picked]),
+            "binary_flag": (found, np.ones(len(found), dtype=bool)),
+            "number_of_matches_in_period": (np.arange(self.rows), counts),
+        }
+        if index.values is not None:
+            values = index.values[picked]
+            present = ~np.isnan(values)
+            fields["numeric_value"] = (found[present], values[present])
+        matcher = self.matchers[system]
+        if list_name in matcher.categories:
+            labels, categories = matcher.category(index.codes[picked], list_name)
+            present = categories >= 0
+            fields["category"] = (found[present], np.array(labels, dtype=object)[categories[present]])
+        return fields
+
+    def codelist_index(self, table, system, list_name):
+        key = (table, list_name)
+        if key not in self.indexes:
+            events, bits = self.table_index(table, system)
+            self.indexes[key] = events.subset(self.matchers[system].mask(bits, list_name))
+        return self.indexes[key]
+
+    def table_index(self, table, system):
+        # Every event of a table, with its code's row in the matcher's table
+        # and the bitset of codelists it is in
+        if table not in self.tables:
+            value = "numeric_value" if table == "clinical_event" else "NULL"
+            rows = self.connection.execute(f"SELECT patient_id, code, date, {value} FROM {table}").fetchall()
+            patients, codes, dates, values = zip(*rows) if rows else ((), (), (), ())
+            codes = pa.array(codes, pa.string()).dictionary_encode()
+            matcher = self.matchers[system]
+            events = EventIndex.from_events(
+                np.searchsorted(self.patient_ids, np.array(patients, dtype=np.int64)),
+                np.array(dates, dtype=np.int64),
+                self.rows,
+                np.array(values, dtype=float),
+                matcher.lookup(codes),
+            )
+            self.tables[table] = (events, matcher.bits_of(events.codes))
+        return self.tables[table]
+
+
+def study_backend(path):
+    # For worker processes, which need to load the study definition themselves
+    from study_definition import study
+
+    return IndexedBackend(path, study)
@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pyarrow as pa
+
+
+# EXTRACTION PROFILE
+# Wraps a backend (see extract_scheduler.py) and records, for every task it
+# runs (one variable, or one scan with query fusion):
+#   - wall time, and when it started and finished
+#   - rows touched: the event rows its queries read (those matching their
+#     codes and window), from backends that count them in `rows_scanned`
+#     (sqlite_backend.py, event_index.py); for the dummy data backend, which
+#     reads no rows, the patients the task ran over
+#   - rows returned: patients with a non-missing value in any of its columns
+#   - memory: the size of the columns it returned and, with trace_memory
+#     (--trace-memory), the peak of Python/numpy allocations during the task
+# tracemalloc hooks every allocation, which made the tasks of a 10k-patient
+# local database extract 2-3 times slower, allocation-heavy numpy and pyarrow
+# ones most, and so reorders the slowest; it is therefore off unless asked
+# for. Time a run without it and trace memory in a run of its own;
+# peak_bytes is null in a run without it.
+# Each process appends its records to its own file in the profile directory,
+# so this works the same with extract_parallel. collect_profile merges them
+# into logs/extract_profile.json (slowest first) and logs/extract_trace.json,
+# a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) with
+# one row per worker process.
+PROFILE_JSON = "logs/extract_profile.json"
+TRACE_JSON = "logs/extract_trace.json"
+
+
+def present(values):
+    if isinstance(values, pa.Array):
+        return values.is_valid().to_numpy(zero_copy_only=False)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return ~np.isnat(values)
+    if values.dtype == object:
+        return np.array([value not in (None, "") for value in values], dtype=bool)
+    return values != 0
+
+
+def rows_returned(columns):
+    returned = None
+    for values in columns.values():
+        returned = present(values) if returned is None else returned | present(values)
+    return 0 if returned is None else int(returned.sum())
+
+
+def rows_scanned(backend):
+    # The rows a backend, or the backend it wraps, has read so far; None if
+    # it does not count them
+    while not hasattr(backend, "rows_scanned") and hasattr(backend, "backend"):
+        backend = backend.backend
+    return getattr(backend, "rows_scanned", None)
+
+
+class ProfiledBackend:
+    """A backend that times and measures every task of another backend."""
+
+    def __init__(self, backend, profile_dir, members=None, trace_memory=False):
+        self.backend = backend
+        self.members = members or {}
+        self.trace_memory = trace_memory
+        os.makedirs(profile_dir, exist_ok=True)
+        self.path = os.path.join(profile_dir, f"{os.getpid()}.jsonl")
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def extract(self, name, columns):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        scanned = rows_scanned(self.backend)
+        start_ns = time.time_ns()
+        start = time.perf_counter()
+        produced = self.backend.extract(name, columns)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+
+        if scanned is None:
+            touched = max((len(values) for values in produced.values()), default=0)
+        else:
+            touched = rows_scanned(self.backend) - scanned
+        record = {
+            "task": name,
+            "variables": self.members.get(name, [name]),
+            "pid": os.getpid(),
+            "start_us": start_ns // 1000,
+            "seconds": seconds,
+            "rows_touched": touched,
+            "rows_returned": rows_returned(produced),
+            "peak_bytes": peak,
+            "result_bytes": sum(values.nbytes for values in produced.values()),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return produced
+
+
+def profiled_backend(make_backend, profile_dir, members=None, trace_memory=False):
+    # For worker processes (see extract_scheduler.py)
+    return ProfiledBackend(make_backend(), profile_dir, members, trace_memory)
+
+
+def read_records(profile_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, "*.jsonl"))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f)
+    return records
+
+
+def chrome_trace(records):
+    origin = min((record["start_us"] for record in records), default=0)
+    pids = sorted({record["pid"] for record in records})
+    events = [
+        {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"worker {i}"}}
+        for i, pid in enumerate(pids)
+    ]
+    for record in records:
+        events.append(
+            {
+                "name": record["task"],
+                "cat": "extract",
+                "ph": "X",
+                "pid": record["pid"],
+                "tid": 0,
+                "ts": record["start_us"] - origin,
+                "dur": round(record["seconds"] * 1_000_000),
+                "args": {
+                    key: record[key]
+                    for key in ("variables", "rows_touched", "rows_returned", "peak_bytes", "result_bytes")
+                },
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def collect_profile(profile_dir, profile_path=PROFILE_JSON, trace_path=TRACE_JSON):
+    records = read_records(profile_dir)
+    records.sort(key=lambda record: record["seconds"], reverse=True)
+    for path in (profile_path, trace_path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(profile_path, "w") as f:
+        json.dump(records, f, indent=2)
+    with open(trace_path, "w") as f:
+        json.dump(chrome_trace(records), f)
+    return records
+
+
+def profile_report(records, top=15):
+    total = sum(record["seconds"] for record in records)
+    lines = [f"{len(records)} tasks, {total:.2f}s in total; slowest:"]
+    for record in records[:top]:
+        share = record["seconds"] / total if total else 0
+        peak = "" if record["peak_bytes"] is None else f" {record['peak_bytes'] / 2**20:8.1f} MB peak"
+        lines.append(
+            f"  {record['task']:<32} {record['seconds']:8.3f}s {share:6.1%} "
+            f"{record['rows_returned']:>10,}/{record['rows_touched']:<10,} rows{peak}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", default=PROFILE_JSON)
+    parser.add_argument("--top", type=int, default=15)
+    options = parser.parse_args()
+
+    # Summarises an existing profile
+    with open(options.profile) as f:
+        records = json.load(f)
+    print(profile_report(records, options.top))
+
+
+if __name__ == "__main__":
+    main()
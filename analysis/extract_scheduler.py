@@ -0,0 +1,173 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+from study_graph import VariableGraph
+
+
+# PARALLEL EXTRACTION
+# Extracts the variables of a StudyDefinition on a pool of processes in the
+# order the dependency graph (study_graph.py) allows: each variable starts as
+# soon as the variables it needs are done and is handed only their columns.
+# Only real dependency chains (vaxdate1 -> vaxdate2 -> vaxdate3) run one after
+# another; everything that just needs sgss_pos_inrange runs at once.
+#
+# A backend is any object with `extract(name, columns)` returning
+# {column: values} for the variable. Each worker process builds its own
+# backend by calling `make_backend`, which must be picklable (a module level
+# function or functools.partial of one). With query fusion (query_plan.py)
+# the graph's nodes are scans, each extracting several variables.
+#
+# `done` takes results that are already known (e.g. from a cache); those
+# variables are not extracted again but their columns are passed on.
+_backend = None
+
+
+def _start_worker(make_backend):
+    global _backend
+    _backend = make_backend()
+
+
+def _extract(name, columns):
+    return _backend.extract(name, columns)
+
+
+def dependency_columns(graph, name, results):
+    columns = {}
+    for other in graph.dependencies[name]:
+        columns.update(results[other])
+    return columns
+
+
+def extract_serial(graph, backend, done=None):
+    results = dict(done or {})
+    for name in graph.topological_order():
+        if name not in results:
+            results[name] = backend.extract(name, dependency_columns(graph, name, results))
+    return results
+
+
+def extract_parallel(graph, make_backend, workers=None, done=None):
+    results = dict(done or {})
+    waiting = {
+        name: {other for other in graph.dependencies[name] if other not in results}
+        for name in graph.topological_order()
+        if name not in results
+    }
+    running = {}
+
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(make_backend,)) as pool:
+
+        def submit_ready():
+            for name in [name for name, needs in waiting.items() if not needs]:
+                del waiting[name]
+                columns = dependency_columns(graph, name, results)
+                running[pool.submit(_extract, name, columns)] = name
+
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                for other in graph.dependents[name]:
+                    if other in waiting:
+                        waiting[other].discard(name)
+            submit_ready()
+    return results
+
+
+def merge_columns(results):
+    columns = {}
+    for produced in results.values():
+        columns.update(produced)
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="output/dummy_input.parquet")
+    parser.add_argument("--no-fusion", action="store_true", help="extract every variable separately")
+    parser.add_argument("--cache", action="store_true", help="reuse unchanged variables from the cache")
+    parser.add_argument("--cache-dir")
+    parser.add_argument("--prune", action="store_true", help="remove cache entries no longer used")
+    parser.add_argument("--profile", action="store_true", help="write per-task timings to logs/")
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="with --profile, also record each task's peak memory (slows the tasks)"
+    )
+    parser.add_argument("--database", help="extract from a local EHR database (sqlite_backend.py) instead of dummy data")
+    parser.add_argument("--event-index", action="store_true", help="answer the database's event queries from in-memory indexes (event_index.py)")
+    options = parser.parse_args()
+
+    # Runs the scheduler against the dummy data backend, or a local database
+    from cohort_schema import cohort_schema
+    from cr_columnar import to_record_batch, write_batches
+    from dummy_data import study_backend
+    from event_index import study_backend as indexed_study_backend
+    from sqlite_backend import study_backend as sqlite_study_backend
+    from extract_profile import collect_profile, profile_report, profiled_backend
+    from query_plan import fused_backend, fusion_report, plan_scans, scan_graph
+    from study_definition import study
+    from variable_cache import CACHE_DIR, extract_cached, node_keys, prune_cache
+
+    graph = VariableGraph.from_study(study)
+    members = {name: [name] for name in graph.topological_order()}
+    make_backend = partial(study_backend, options.rows, options.seed)
+    backend_key = f"dummy_data rows={options.rows} seed={options.seed}"
+    if options.database:
+        make_backend = partial(sqlite_study_backend, options.database)
+        backend_key = f"sqlite {os.path.abspath(options.database)} {os.path.getmtime(options.database)}"
+        if options.event_index:
+            make_backend = partial(indexed_study_backend, options.database)
+            backend_key += " indexed"
+    if not options.no_fusion:
+        scans = plan_scans(study.covariate_definitions)
+        print(fusion_report(scans))
+        graph = scan_graph(graph, scans)
+        members = {scan.name: scan.variables for scan in scans}
+        make_backend = partial(fused_backend, make_backend, scans)
+    if options.profile:
+        profile_dir = tempfile.mkdtemp()
+        make_backend = partial(profiled_backend, make_backend, profile_dir, members, options.trace_memory)
+    for depth, names in enumerate(graph.levels()):
+        print(f"Level {depth}: {len(names)} tasks")
+
+    start = time.perf_counter()
+    if options.cache:
+        results, extracted = extract_cached(
+            graph,
+            members,
+            study.covariate_definitions,
+            make_backend,
+            backend_key,
+            options.workers,
+            options.cache_dir or CACHE_DIR,
+        )
+        print(f"Reused {len(results) - len(extracted)} cached tasks; extracted: {', '.join(extracted) or 'none'}")
+        if options.prune:
+            keys = node_keys(graph, members, study.covariate_definitions, backend_key)
+            print(f"Pruned {prune_cache(keys, options.cache_dir or CACHE_DIR)} cache entries")
+    elif options.workers > 1:
+        results = extract_parallel(graph, make_backend, options.workers)
+    else:
+        results = extract_serial(graph, make_backend())
+    print(f"Ran {len(results)} tasks in {time.perf_counter() - start:.1f}s")
+    if options.profile:
+        print(profile_report(collect_profile(profile_dir)))
+        shutil.rmtree(profile_dir)
+
+    schema = cohort_schema(study)
+    batch = to_record_batch(merge_columns(results), schema, 1)
+    write_batches([batch], schema, options.output)
+    print(f"Wrote {batch.num_rows} rows to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import json
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from scipy import stats
+from scipy.special import expit
+
+from cox import design_matrix, formula_variables, independent_columns
+
+
+# MULTIPLE IMPUTATION
+# mi impute for the methods the study uses, one imputation per task on a pool
+# of processes:
+#   - logit: mi impute logit, for a 0/1 variable
+#   - regress: mi impute regress, for a continuous variable
+# Each imputation draws the model coefficients from their approximate
+# posterior, as mi impute does, and then the missing values. When several
+# variables are imputed and some predict others, the models are cycled as
+# chained equations (mi impute chained) for `iterations` passes; otherwise
+# one pass is exact and each model is fitted only once per process.
+#
+# Each model is fitted to the rows where its variable is observed, omitting
+# the predictors that are constant or collinear there. As with mi impute
+# logit, a logit model with perfect prediction is an error, naming the
+# predictor where it can.
+#
+# Imputation k uses the k-th child of SeedSequence(seed), so the results do
+# not depend on the number of workers. Only the imputed values of the missing
+# rows are returned; with_imputations stores them next to the original data
+# as columns _1_x, _2_x, ... (Stata's mi wide style) that are null wherever x
+# was observed, so the file grows with the amount of missing data rather than
+# with m copies of the cohort.
+#
+# mi_estimate is mi estimate: it fits a model to every imputed dataset on a
+# pool of processes and combines the estimates with Rubin's rules. The data
+# is put in shared memory once and each worker reads it in place; an
+# imputation only adds its own copy of the imputed columns.
+ImputationModel = namedtuple("ImputationModel", "variable method formula")
+MI_METADATA = b"mi"
+
+
+# MODELS
+def add_constant(X):
+    return np.column_stack([X, np.ones(len(X))])
+
+
+def perfect_predictors(names, X, y):
+    # (predictor, level, outcome) for the 0/1 predictors on one of whose
+    # levels y does not vary
+    found = []
+    for name, values in zip(names, X.T):
+        if np.isin(values, (0, 1)).all():
+            for level in (0, 1):
+                outcome = y[values == level]
+                if len(outcome) and outcome.min() == outcome.max():
+                    found.append((name, level, outcome[0]))
+    return found
+
+
+def fit_logit(X, y, max_iterations=50):
+    beta = np.zeros(X.shape[1])
+    try:
+        for _ in range(max_iterations):
+            p = expit(X @ beta)
+            information = (X * (p * (1 - p))[:, None]).T @ X
+            step = np.linalg.solve(information, X.T @ (y - p))
+            beta += step
+            if np.max(np.abs(step)) < 1e-8:
+                break
+        else:
+            raise np.linalg.LinAlgError
+        p = expit(X @ beta)
+        return beta, np.linalg.inv((X * (p * (1 - p))[:, None]).T @ X)
+    except np.linalg.LinAlgError:
+        # The coefficients diverge: some combination of predictors separates
+        # the outcomes
+        raise ValueError("perfect prediction: the logit model does not converge") from None
+
+
+def fit_regress(X, y):
+    beta, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    residuals = y - X @ beta
+    df = len(y) - X.shape[1]
+    sigma2 = residuals @ residuals / df
+    return beta, np.linalg.inv(X.T @ X) * sigma2, sigma2, df
+
+
+def draw_logit(fit, X, rng):
+    beta, variance = fit
+    beta = rng.multivariate_normal(beta, variance, method="cholesky")
+    return (rng.random(len(X)) < expit(X @ beta)).astype(float)
+
+
+def draw_regress(fit, X, rng):
+    beta, variance, sigma2, df = fit
+    # sigma*^2 = sigma^2 (n - k) / chi2(n - k), and beta* given sigma*
+    scale = df / rng.chisquare(df)
+    beta = rng.multivariate_normal(beta, variance * scale, method="cholesky")
+    return X @ beta + rng.normal(0, np.sqrt(sigma2 * scale), len(X))
+
+
+METHODS = {
+    "logit": (fit_logit, draw_logit),
+    "regress": (fit_regress, draw_regress),
+}
+
+
+def impute_variable(columns, model, missing, rng, fits):
+    fit_model, draw = METHODS[model.method]
+    if not missing.any():
+        # Nothing to impute (as in an empty cohort), so no model to fit
+        return columns[model.variable], (None, None)
+    if model in fits:
+        fit, X_missing = fits[model]
+    else:
+        names, X = design_matrix(columns, model.formula, np.arange(len(missing)))
+        keep = independent_columns(X[~missing])
+        names, X = [names[j] for j in keep], add_constant(X[:, keep])
+        y = columns[model.variable][~missing]
+        if model.method == "logit":
+            if len(y) and y.min() == y.max():
+                raise ValueError(f"mi impute logit {model.variable}: {model.variable} does not vary where observed")
+            found = [
+                f"{name} == {level} predicts {model.variable} == {outcome:g}"
+                for name, level, outcome in perfect_predictors(names, X[~missing], y)
+            ]
+            if found:
+                raise ValueError(f"mi impute logit {model.variable}: perfect prediction ({'; '.join(found)})")
+        try:
+            fit = fit_model(X[~missing], y)
+        except ValueError as error:
+            raise ValueError(f"mi impute {model.method} {model.variable}: {error}") from None
+        X_missing = X[missing]
+    values = columns[model.variable].copy()
+    values[missing] = draw(fit, X_missing, rng)
+    return values, (fit, X_missing)
+
+
+# IMPUTATION
+def impute_once(columns, models, rng, iterations, fits):
+    columns = dict(columns)
+    missing = {model.variable: np.isnan(columns[model.variable]) for model in models}
+    imputed = set(missing)
+    chained = any(imputed & set(formula_variables(model.formula)) for model in models)
+
+    if chained:
+        # Start the chains from random draws of the observed values
+        for variable, rows in missing.items():
+            values = columns[variable].copy()
+            values[rows] = rng.choice(values[~rows], rows.sum())
+            columns[variable] = values
+    for _ in range(iterations if chained else 1):
+        for model in models:
+            columns[model.variable], fit = impute_variable(
+                columns, model, missing[model.variable], rng, fits
+            )
+            if not chained:
+                fits[model] = fit
+    return {variable: columns[variable][rows] for variable, rows in missing.items()}
+
+
+_columns = None
+_fits = {}
+
+
+def _start_worker(load_columns):
+    global _columns
+    _columns = load_columns()
+    _fits.clear()
+
+
+def _impute(models, iterations, seed_sequence):
+    return impute_once(_columns, models, np.random.default_rng(seed_sequence), iterations, _fits)
+
+
+def multiple_imputation(load_columns, models, m, seed, iterations=10, workers=1):
+    # load_columns returns {column: float array} with NaN for missing values;
+    # in a pool it must be picklable. Returns, for each imputation, the values
+    # imputed for the missing rows of each variable
+    seeds = np.random.SeedSequence(seed).spawn(m)
+    impute = partial(_impute, models, iterations)
+    if workers == 1:
+        _start_worker(load_columns)
+        return [impute(seed_sequence) for seed_sequence in seeds]
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(load_columns,)) as pool:
+        return list(pool.map(impute, seeds))
+
+
+# STORAGE
+def imputed_column(name, k):
+    return f"_{k}_{name}"
+
+
+def with_imputations(table, imputations):
+    # The table with a _k_x column per imputation k and imputed variable x,
+    # holding the imputed values on the rows where x is missing
+    variables = list(imputations[0])
+    for variable in variables:
+        original = table.column(variable).combine_chunks()
+        missing = original.is_null().to_numpy(zero_copy_only=False)
+        for k, imputation in enumerate(imputations, 1):
+            values = np.zeros(len(missing))
+            values[missing] = imputation[variable]
+            array = pa.array(values, mask=~missing).cast(original.type)
+            table = table.append_column(imputed_column(variable, k), array)
+    metadata = dict(table.schema.metadata or {})
+    metadata[MI_METADATA] = json.dumps({"m": len(imputations), "imputed": variables}).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def mi_info(schema):
+    return json.loads(schema.metadata[MI_METADATA])
+
+
+def imputation(table, k):
+    # Imputed dataset k (0 is the original data) of a table from with_imputations
+    info = mi_info(table.schema)
+    extra = [imputed_column(variable, j) for variable in info["imputed"] for j in range(1, info["m"] + 1)]
+    data = table.drop([name for name in extra if name in table.column_names])
+    if k == 0:
+        return data
+    for variable in info["imputed"]:
+        filled = table.column(imputed_column(variable, k)).combine_chunks()
+        values = pc.coalesce(filled, table.column(variable).combine_chunks())
+        data = data.set_column(data.column_names.index(variable), variable, values)
+    return data
+
+
+# SHARED MEMORY
+class SharedColumns:
+    """Numpy arrays copied into shared memory, for attach_columns in other processes."""
+
+    def __init__(self, columns):
+        self.blocks = []
+        self.layout = {}
+        for name, values in columns.items():
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+            self.blocks.append(block)
+            self.layout[name] = (block.name, values.shape, values.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+def attach_columns(layout):
+    blocks = []
+    columns = {}
+    for name, (block_name, shape, dtype) in layout.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        columns[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+    return columns, blocks
+
+
+# POOLED ESTIMATION
+PooledEstimates = namedtuple("PooledEstimates", "names coef variance within between df m")
+
+
+def rubin(results):
+    # Rubin's rules for results with .names, .coef and .variance, with mi
+    # estimate's large-sample degrees of freedom
+    m = len(results)
+    for k, result in enumerate(results, 1):
+        if getattr(result, "error", None) is not None:
+            raise ValueError(f"Imputation {k} could not be estimated: {result.error}")
+    names = results[0].names
+    for result in results:
+        if result.names != names:
+            raise ValueError("Imputations estimated different coefficients")
+    coefs = np.array([result.coef for result in results])
+    within = np.mean([result.variance for result in results], axis=0)
+    between = np.atleast_2d(np.cov(coefs, rowvar=False, ddof=1))
+    variance = within + (1 + 1 / m) * between
+    with np.errstate(divide="ignore"):
+        increase = (1 + 1 / m) * np.diag(between) / np.diag(within)
+        df = (m - 1) * (1 + 1 / increase) ** 2
+    return PooledEstimates(names, coefs.mean(axis=0), variance, within, between, df, m)
+
+
+def pooled_table(pooled, eform=True, level=95):
+    # (name, estimate, lb, ub, p) per coefficient, with t intervals on df
+    rows = []
+    se = np.sqrt(np.diag(pooled.variance))
+    for name, coef, error, df in zip(pooled.names, pooled.coef, se, pooled.df):
+        t = stats.t.ppf(0.5 + level / 200, df)
+        p = 2 * stats.t.sf(abs(coef / error), df)
+        estimate, lb, ub = coef, coef - t * error, coef + t * error
+        if eform:
+            estimate, lb, ub = np.exp([estimate, lb, ub])
+        rows.append((name, estimate, lb, ub, p))
+    return rows
+
+
+_shared = None
+_base = None
+_imputed = None
+_fit_cache = {}
+
+
+def _set_data(base, imputed):
+    global _base, _imputed
+    _base = base
+    _imputed = imputed
+    _fit_cache.clear()
+
+
+def _start_estimation(layout, imputed_layout):
+    global _shared
+    base, base_blocks = attach_columns(layout)
+    imputed, imputed_blocks = attach_columns(imputed_layout)
+    # The blocks must stay open while the arrays are in use
+    _shared = base_blocks + imputed_blocks
+    variables = {name.split(":")[0] for name in imputed}
+    _set_data(base, {variable: (imputed[f"{variable}:rows"], imputed[f"{variable}:values"]) for variable in variables})
+
+
+def _fit_imputation(fit, k):
+    # Imputation k: the shared columns with this imputation's values overlaid
+    columns = dict(_base)
+    for variable, (rows, values) in _imputed.items():
+        column = columns[variable].copy()
+        column[rows] = values[k]
+        columns[variable] = column
+    return fit(columns, cache=_fit_cache)
+
+
+def mi_estimate(fit, columns, imputed, workers=1):
+    # fit(columns, cache=...) returns a result for one imputed dataset and must
+    # be picklable. columns are the original data; imputed maps each imputed
+    # variable to (rows where it is missing, m x rows array of imputed values)
+    m = len(next(iter(imputed.values()))[1])
+    if workers == 1:
+        _set_data(columns, imputed)
+        results = [_fit_imputation(fit, k) for k in range(m)]
+        return rubin(results), results
+
+    imputed_columns = {}
+    for variable, (rows, values) in imputed.items():
+        imputed_columns[f"{variable}:rows"] = np.asarray(rows)
+        imputed_columns[f"{variable}:values"] = np.asarray(values)
+    base = SharedColumns(columns)
+    shared_imputed = SharedColumns(imputed_columns)
+    try:
+        with ProcessPoolExecutor(
+            workers, initializer=_start_estimation, initargs=(base.layout, shared_imputed.layout)
+        ) as pool:
+            results = list(pool.map(partial(_fit_imputation, fit), range(m)))
+    finally:
+        base.close()
+        shared_imputed.close()
+    return rubin(results), results
@@ -0,0 +1,159 @@
+import csv
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+
+
+MSOAS_CSV = "./lookups/MSOAs.csv"
+MSOA_LOOKUP_CSV = "./lookups/MSOA_lookup.csv"
+
+
+@lru_cache(maxsize=None)
+def msoa_codes(path=MSOAS_CSV):
+    # All MSOA codes as one fixed width string array, in file order
+    with open(path, newline="") as f:
+        codes = [row["msoa_id"].strip() for row in csv.DictReader(f)]
+    return np.array(codes, dtype=str)
+
+
+class UniformCategories(Mapping):
+    """Category ratios giving every code the same weight.
+
+    Behaves like the `{code: 1 / n}` dict that `return_expectations` expects,
+    but only holds an array of the codes, read the first time it is used.
+    """
+
+    def __init__(self, load_codes):
+        self._load_codes = load_codes
+        self._codes = None
+        self._order = None
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._codes = self._load_codes()
+            self._order = np.argsort(self._codes)
+        return self._codes
+
+    @property
+    def ratio(self):
+        return 1 / len(self)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.codes.tolist())
+
+    def __contains__(self, code):
+        codes = self.codes
+        position = np.searchsorted(codes, code, sorter=self._order)
+        return position < len(codes) and codes[self._order[position]] == code
+
+    def __getitem__(self, code):
+        if code not in self:
+            raise KeyError(code)
+        return self.ratio
+
+    def values(self):
+        return [self.ratio] * len(self)
+
+    def __deepcopy__(self, memo):
+        # Read-only, so the copies cohortextractor makes when merging
+        # expectations can share this object
+        return self
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} codes)"
+
+
+@lru_cache(maxsize=None)
+def uniform_msoa_ratios():
+    return UniformCategories(msoa_codes)
+
+
+# MSOA -> UTLA JOIN INDEX
+# Replaces `merge m:1 msoa using ./lookups/MSOA_lookup` with integer gathers.
+#   msoas:       sorted MSOA codes; an MSOA's position is its integer id
+#   utla_ids:    the UTLA id of each MSOA id
+#   utlas:       the code (E06.../E08.../E09.../E10...) of each UTLA id
+#   utla_names:  the name of each UTLA id
+# Id -1 stands for a missing or unknown MSOA or UTLA: utla_ids, utlas and
+# utla_names each end with an extra entry (-1, "" and "") so that gathering
+# with -1 gives a missing value without any masking.
+MsoaIndex = namedtuple("MsoaIndex", "msoas utla_ids utlas utla_names")
+
+
+@lru_cache(maxsize=None)
+def msoa_utla_index(path=MSOA_LOOKUP_CSV):
+    with open(path, newline="") as f:
+        rows = sorted(
+            (row["msoa"].strip(), row["utla"].strip(), row["utla_name"].strip())
+            for row in csv.DictReader(f)
+        )
+    msoas = np.array([msoa for msoa, _, _ in rows], dtype=str)
+    if len(np.unique(msoas)) != len(msoas):
+        raise ValueError(f"{path} has more than one row for some MSOAs")
+    utlas, utla_ids = np.unique([utla for _, utla, _ in rows], return_inverse=True)
+    names = {utla: name for _, utla, name in rows}
+    return MsoaIndex(
+        msoas,
+        np.append(utla_ids, -1).astype(np.int32),
+        np.append(utlas, ""),
+        np.append([names[utla] for utla in utlas], ""),
+    )
+
+
+def code_ids(codes, index):
+    # Integer id of each code in a (small) str array, -1 if unknown
+    codes = np.asarray(codes, dtype=str)
+    positions = np.minimum(np.searchsorted(index.msoas, codes), len(index.msoas) - 1)
+    return np.where(index.msoas[positions] == codes, positions, -1).astype(np.int32)
+
+
+def msoa_ids(msoas, index=None):
+    # Integer id of each MSOA in a column (numpy, pandas or Arrow), -1 where
+    # it is missing or unknown. The column is dictionary encoded (already so
+    # for dummy data and output/input.parquet), each distinct code is looked
+    # up once and the ids are gathered by the dictionary indices
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    index = index or msoa_utla_index()
+    if isinstance(msoas, pa.ChunkedArray):
+        msoas = msoas.combine_chunks()
+    elif not isinstance(msoas, pa.Array):
+        msoas = pa.array(np.asarray(msoas, dtype=object), from_pandas=True)
+    if not pa.types.is_dictionary(msoas.type):
+        msoas = pc.dictionary_encode(msoas)
+    dictionary = pc.fill_null(msoas.dictionary, "").to_numpy(zero_copy_only=False)
+    ids = np.append(code_ids(dictionary, index), -1)
+    return ids[pc.fill_null(msoas.indices, -1).to_numpy(zero_copy_only=False)]
+
+
+def utla_ids(msoa_id, index=None):
+    index = index or msoa_utla_index()
+    return index.utla_ids[msoa_id]
+
+
+def join_utla(msoas, index=None):
+    # utla and utla_name for a column of MSOA codes ("" where missing)
+    index = index or msoa_utla_index()
+    utla = utla_ids(msoa_ids(msoas, index), index)
+    return index.utlas[utla], index.utla_names[utla]
+
+
+def join_utla_arrow(array, index=None):
+    # utla and utla_name as dictionary encoded Arrow columns, null where the
+    # MSOA is missing or unknown
+    import pyarrow as pa
+
+    index = index or msoa_utla_index()
+    utla = utla_ids(msoa_ids(array, index), index)
+    indices = pa.array(utla, mask=utla < 0)
+    return (
+        pa.DictionaryArray.from_arrays(indices, pa.array(index.utlas[:-1])),
+        pa.DictionaryArray.from_arrays(indices, pa.array(index.utla_names[:-1])),
+    )
@@ -0,0 +1,125 @@
+import argparse
+from collections import namedtuple
+
+from study_graph import VariableGraph
+
+
+# QUERY FUSION
+# Several variables run the same query and only differ in what they return:
+# sgss_pos_inrange/sgtf (the same SGSS test), ae_covid_date/ae_destination
+# (the same A&E attendance), stp/msoa/region (the same practice
+# registration), and every include_date_of_match column, which is the date of
+# the row its source variable picked. These are planned as one scan returning
+# several columns.
+#
+# Two variables share a scan when they use the same patients.* function with
+# the same arguments, ignoring the arguments that only shape the returned value.
+RETURNING_ARGUMENTS = (
+    "returning",
+    "date_format",
+    "include_date_of_match",
+    "round_to_nearest",
+    "return_expectations",
+    "hidden",
+    "column_type",
+)
+
+Scan = namedtuple("Scan", "name funcname variables")
+
+
+def frozen(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, frozen(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        # Codelists compare by their codes and coding system
+        return (type(value).__name__, getattr(value, "system", None), tuple(map(frozen, value)))
+    return value
+
+
+def scan_key(funcname, args):
+    filters = {key: value for key, value in args.items() if key not in RETURNING_ARGUMENTS}
+    return funcname, frozen(filters)
+
+
+def plan_scans(covariate_definitions):
+    scans = {}
+    variable_scans = {}
+    for name, (funcname, args) in covariate_definitions.items():
+        if funcname == "value_from":
+            # An include_date_of_match column comes out of its source's scan
+            key = variable_scans[args["source"]]
+        else:
+            key = scan_key(funcname, args)
+        if key not in scans:
+            scans[key] = Scan(name, funcname, [])
+        scans[key].variables.append(name)
+        variable_scans[name] = key
+    return list(scans.values())
+
+
+def scan_graph(graph, scans):
+    # The variable graph with each scan as one node
+    scan_of = {name: scan.name for scan in scans for name in scan.variables}
+    dependencies = {}
+    for scan in scans:
+        needs = {scan_of[other] for name in scan.variables for other in graph.dependencies[name]}
+        needs.discard(scan.name)
+        dependencies[scan.name] = tuple(other.name for other in scans if other.name in needs)
+    return VariableGraph(dependencies)
+
+
+class FusedBackend:
+    """Runs a backend one scan at a time.
+
+    Backends that can return several columns from one query provide
+    `extract_scan(scan, columns)`; for the others the variables of a scan are
+    extracted one after another in the same task.
+    """
+
+    def __init__(self, backend, scans):
+        self.backend = backend
+        self.scans = {scan.name: scan for scan in scans}
+
+    def extract(self, name, columns):
+        scan = self.scans[name]
+        if hasattr(self.backend, "extract_scan"):
+            return self.backend.extract_scan(scan, columns)
+        produced = {}
+        for variable in scan.variables:
+            produced.update(self.backend.extract(variable, {**columns, **produced}))
+        return produced
+
+
+def fused_backend(make_backend, scans):
+    # For worker processes (see extract_scheduler.py)
+    return FusedBackend(make_backend(), scans)
+
+
+def fusion_report(scans):
+    fused = [scan for scan in scans if len(scan.variables) > 1]
+    variables = sum(len(scan.variables) for scan in scans)
+    lines = [
+        f"{variables} variables planned as {len(scans)} scans; "
+        f"{sum(len(scan.variables) for scan in fused)} variables fused into {len(fused)} scans"
+    ]
+    for scan in fused:
+        lines.append(f"  {scan.funcname}: {', '.join(scan.variables)}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="also write the report to this file")
+    options = parser.parse_args()
+
+    from study_definition import study
+
+    report = fusion_report(plan_scans(study.covariate_definitions))
+    print(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+
+
+# LOCAL PROJECT RUNNER
+# Runs the actions of project.yaml on this machine in the order their
+# `needs` allow, as extract_scheduler.py does for variables: each action
+# starts as soon as the actions it needs have succeeded, so anSUMM, anTAB1,
+# anCOX, anRISK and crIMP all run at once after crMAIN.
+#
+# An action is skipped if nothing it depends on has changed since it last
+# succeeded: its key is a sha256 of
+#   - its run command and declared outputs, as written in project.yaml
+#   - the contents of its scripts: the script it runs, the local modules a
+#     Python script imports (recursively), and for generate_cohort the study
+#     definition and the codelists
+#   - the contents of the outputs of the actions it needs
+#   - the contents of the data files no action produces, such as the MSOA
+#     lookups that crMAIN, crMAIN_PY and generate_cohort read: every file
+#     matching DATA_FILES is part of every action's key, as which action
+#     reads which lookup is not declared in project.yaml
+# and it is skipped when the key matches the one recorded at its last
+# success and its outputs are all still there. An upstream action that
+# reruns but writes the same bytes therefore does not rerun what follows.
+# Keys, and the file hashes (reused while a file's size and mtime are
+# unchanged), are kept in metadata/run_project.json; each action's output
+# goes to metadata/<action>.log.
+#
+# Images are mapped to local commands: python to this interpreter,
+# cohortextractor and stata-mp to those programs on the PATH.
+STATE_FILE = "metadata/run_project.json"
+LOG_DIR = "metadata"
+IMAGES = {
+    "python": [sys.executable],
+    "cohortextractor": ["cohortextractor"],
+    "stata-mp": ["stata-mp", "-b", "do"],
+}
+SCRIPT_EXTENSIONS = (".py", ".do")
+DATA_FILES = ["lookups/*"]
+
+Action = namedtuple("Action", "name image arguments needs outputs")
+
+
+# PROJECT
+def load_project(path):
+    with open(path) as f:
+        project = yaml.safe_load(f)
+    actions = {}
+    for name, spec in project["actions"].items():
+        image, *arguments = shlex.split(spec["run"])
+        outputs = [path for level in (spec.get("outputs") or {}).values() for path in level.values()]
+        actions[name] = Action(name, image.split(":")[0], arguments, list(spec.get("needs") or []), outputs)
+    for action in actions.values():
+        for other in action.needs:
+            if other not in actions:
+                raise ValueError(f"{action.name} needs unknown action {other}")
+    return actions
+
+
+def selected(actions, targets):
+    # The targets and every action they need, in project order
+    wanted = set()
+    pending = list(targets or actions)
+    while pending:
+        name = pending.pop()
+        if name not in actions:
+            raise ValueError(f"Unknown action {name}")
+        if name not in wanted:
+            wanted.add(name)
+            pending.extend(actions[name].needs)
+    return [name for name in actions if name in wanted]
+
+
+def command(action):
+    if action.image not in IMAGES:
+        raise ValueError(f"{action.name}: no local command for image {action.image}")
+    return IMAGES[action.image] + action.arguments
+
+
+# SCRIPTS
+def local_imports(path, seen=None):
+    # path and the modules beside it that it imports, recursively
+    seen = set() if seen is None else seen
+    if path in seen:
+        return seen
+    seen.add(path)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    directory = os.path.dirname(path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = os.path.join(directory, name.split(".")[0] + ".py")
+            if os.path.exists(module):
+                local_imports(module, seen)
+    return seen
+
+
+def action_scripts(action):
+    scripts = set()
+    for argument in action.arguments:
+        if argument.endswith(SCRIPT_EXTENSIONS) and os.path.exists(argument):
+            scripts |= local_imports(argument) if argument.endswith(".py") else {argument}
+    if action.image == "cohortextractor":
+        arguments = action.arguments
+        name = arguments[arguments.index("--study-definition") + 1] if "--study-definition" in arguments else "study_definition"
+        scripts |= local_imports(os.path.join("analysis", f"{name}.py"))
+        scripts |= set(glob.glob("codelists/*.csv"))
+    return sorted(scripts)
+
+
+def data_files(patterns):
+    return sorted({path for pattern in patterns for path in glob.glob(pattern) if os.path.isfile(path)})
+
+
+def output_files(action):
+    # The files matching each declared output, or None if one matches nothing
+    files = []
+    for pattern in action.outputs:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            return None
+        files += matches
+    return files
+
+
+# HASHING
+class FileHashes:
+    """sha256 of files, remembered while their size and mtime are unchanged."""
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def __call__(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = self.known.get(path)
+        if known is None or known[:2] != signature:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            known = signature + [digest.hexdigest()]
+            self.known[path] = known
+        return known[2]
+
+
+def action_key(action, actions, file_hash, data=DATA_FILES):
+    # None while a needed action's outputs are missing
+    digest = hashlib.sha256(repr((action.image, action.arguments, action.outputs)).encode())
+    for script in action_scripts(action):
+        digest.update(f"script {script} {file_hash(script)}".encode())
+    for path in data_files(data):
+        digest.update(f"data {path} {file_hash(path)}".encode())
+    for other in action.needs:
+        files = output_files(actions[other])
+        if files is None:
+            return None
+        for path in files:
+            digest.update(f"input {path} {file_hash(path)}".encode())
+    return digest.hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {"keys": {}, "files": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state, file_hash):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    state["files"] = file_hash.known
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+# RUNNING
+def run_action(action, log_dir):
+    # Returns (return code, seconds); the action's output goes to its log
+    os.makedirs(log_dir, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f"{action.name}.log"), "w") as log:
+        try:
+            returncode = subprocess.run(command(action), stdout=log, stderr=subprocess.STDOUT).returncode
+        except OSError as error:
+            log.write(f"{error}\n")
+            returncode = -1
+    return returncode, time.perf_counter() - start
+
+
+def run_project(actions, names, workers=None, force=False, dry_run=False, state_path=STATE_FILE, log_dir=LOG_DIR, data=DATA_FILES):
+    # Runs the named actions; returns {action: "ran", "skipped", "failed" or
+    # "blocked" (a needed action failed)}
+    state = load_state(state_path)
+    file_hash = FileHashes(state["files"])
+    status = {}
+    waiting = {name: {other for other in actions[name].needs if other in names} for name in names}
+    failed_needs = {name: [] for name in names}
+    running = {}
+
+    def unchanged(action, recorded):
+        key = action_key(action, actions, file_hash, data)
+        return key is not None and key == recorded and output_files(action) is not None
+
+    def finish(name, outcome, detail=""):
+        status[name] = outcome
+        print(f"{name:<16} {outcome}{detail}", flush=True)
+        for other, needs in waiting.items():
+            if name in needs:
+                needs.discard(name)
+                if outcome in ("failed", "blocked"):
+                    failed_needs[other].append(name)
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+
+        def submit_ready():
+            # Until nothing more is ready, as skipping an action readies those after it
+            ready = [name for name, needs in waiting.items() if not needs]
+            while ready:
+                name = ready.pop(0)
+                del waiting[name]
+                action = actions[name]
+                # In a dry run, whatever needs an action that would run would run too
+                stale = dry_run and any(status.get(other) == "would run" for other in action.needs)
+                if failed_needs[name]:
+                    finish(name, "blocked", f" ({', '.join(failed_needs[name])} failed)")
+                elif not (force or stale) and unchanged(action, state["keys"].get(name)):
+                    finish(name, "skipped", " (unchanged)")
+                elif dry_run:
+                    finish(name, "would run")
+                else:
+                    print(f"{name:<16} started: {' '.join(command(action))}", flush=True)
+                    running[pool.submit(run_action, action, log_dir)] = name
+                ready += [other for other, needs in waiting.items() if not needs and other not in ready]
+
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                action = actions[name]
+                returncode, seconds = future.result()
+                if returncode != 0:
+                    finish(name, "failed", f" (exit code {returncode}, see {log_dir}/{name}.log)")
+                elif output_files(action) is None:
+                    finish(name, "failed", " (declared outputs missing)")
+                else:
+                    # The key is taken after the run, from the inputs it read
+                    state["keys"][name] = action_key(action, actions, file_hash, data)
+                    save_state(state_path, state, file_hash)
+                    finish(name, "ran", f" in {seconds:.1f}s")
+            submit_ready()
+    if not dry_run:
+        save_state(state_path, state, file_hash)
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("actions", nargs="*", help="actions to run, with the actions they need (default: all)")
+    parser.add_argument("--project", default="project.yaml")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="run actions even if unchanged")
+    parser.add_argument("--dry-run", action="store_true", help="show what would run without running it")
+    parser.add_argument("--state", default=STATE_FILE)
+    options = parser.parse_args()
+
+    actions = load_project(options.project)
+    names = selected(actions, options.actions)
+    start = time.perf_counter()
+    status = run_project(actions, names, options.workers, options.force, options.dry_run, options.state)
+    counts = {outcome: sum(1 for value in status.values() if value == outcome) for outcome in dict.fromkeys(status.values())}
+    print(f"\n{len(names)} actions in {time.perf_counter() - start:.1f}s: " + ", ".join(f"{n} {outcome}" for outcome, n in counts.items()))
+    sys.exit(1 if any(outcome in ("failed", "blocked") for outcome in status.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# SHARDS
+# A cohort split into independent partitions by the value of one column
+# (region, or stp), for steps that treat each patient on their own and can
+# therefore run on a pool of processes, one shard each.
+#
+# split_chunks writes each value's rows to an Arrow stream of its own as the
+# chunks (CohortArrays, see cohort_arrays.py) arrive, so one read of the
+# extract makes all the shards, typed; they are read back once, so are left
+# uncompressed. A stream, unlike an Arrow file, lets each batch carry its own
+# categories.
+#
+# merge_sorted combines shards that are each sorted by a key (patient_id)
+# into one file in key order. Rather than loading every shard, it cuts the
+# key range at quantiles of the keys, which are all it reads up front, and
+# writes one range at a time: the rows of each shard in a range are
+# contiguous, so only they are read. The output is the same whatever the
+# shards and the order they were made in.
+ROW_GROUP_SIZE = 100_000
+MISSING_SHARD = "missing"
+
+
+def shard_name(value):
+    # A file name for a shard's value: "East Midlands" -> "east_midlands"
+    if not isinstance(value, str) or value == "":
+        return MISSING_SHARD
+    return re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_") or MISSING_SHARD
+
+
+def split_chunks(chunks, key, directory, prefix="input"):
+    # Writes each chunk's rows to directory/<prefix>_<shard>.arrows by the
+    # value of `key` and returns {shard: path} in the order first seen
+    os.makedirs(directory, exist_ok=True)
+    writers = {}
+    paths = {}
+    try:
+        for chunk in chunks:
+            codes, values = pd.factorize(chunk.labels(key))
+            names = np.array([shard_name(value) for value in values] + [MISSING_SHARD], dtype=object)[codes]
+            for name in dict.fromkeys(names):
+                batch = chunk.take(names == name).to_arrow()
+                if name not in writers:
+                    paths[name] = os.path.join(directory, f"{prefix}_{name}.arrows")
+                    writers[name] = pa.ipc.new_stream(paths[name], batch.schema)
+                writers[name].write_batch(batch)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths
+
+
+def sort_file(path, key):
+    # Rewrites a parquet file sorted by key, in row groups merge_sorted can
+    # read a range of
+    table = pq.read_table(path).sort_by(key)
+    pq.write_table(table, path, row_group_size=ROW_GROUP_SIZE)
+
+
+def read_rows(file, start, stop):
+    # Rows start:stop of a parquet file, reading only the row groups they span
+    if stop <= start:
+        return file.schema_arrow.empty_table()
+    sizes = [file.metadata.row_group(i).num_rows for i in range(file.num_row_groups)]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    first = np.searchsorted(offsets, start, "right") - 1
+    last = np.searchsorted(offsets, stop, "left")
+    table = file.read_row_groups(list(range(first, last)))
+    return table.slice(start - offsets[first], stop - start)
+
+
+def merge_sorted(paths, output_path, key, rows_per_range=500_000, schema=None):
+    # Merges files sorted by key into output_path, sorted by key; returns the
+    # number of rows written. With no files, writes an empty file of schema
+    files = [pq.ParquetFile(path) for path in paths]
+    keys = [file.read(columns=[key]).column(key).to_numpy() for file in files]
+    every_key = np.sort(np.concatenate(keys)) if keys else np.empty(0)
+    bounds = np.unique(every_key[::rows_per_range])
+    bounds = np.append(bounds, np.inf)
+    if files:
+        schema = files[0].schema_arrow
+    elif schema is None:
+        raise ValueError("merge_sorted needs a schema when there are no files")
+    rows = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            parts = []
+            for file, values in zip(files, keys):
+                start, stop = np.searchsorted(values, [low, high], "left")
+                parts.append(read_rows(file, start, stop))
+            table = pa.concat_tables(parts).sort_by(key)
+            writer.write_table(table)
+            rows += len(table)
+    return rows
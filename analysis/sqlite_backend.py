@@ -0,0 +1,813 @@
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from category_expressions import compiled
+from cohort_schema import cohort_schema
+from date_expressions import ISO_DATE, evaluate_date
+from dummy_data import population_age_probabilities
+
+
+# LOCAL STAND-IN EHR DATABASE
+# An SQLite file of synthetic event level data, shaped like the TPP tables
+# the study definition queries, and a backend that runs the study's
+# patients.* calls against it as SQL. It gives the extraction a real query
+# path (joins, per-patient date windows, codelist joins and indexes) to time
+# and tune offline; the values mean nothing.
+#
+# Dates are stored as integer days since 1970-01-01 (the int32 day offsets
+# used everywhere else), so windows are integer comparisons. Every event
+# table is indexed on the column queries filter on first (the code, test
+# result or vaccine target) followed by patient_id and date, so each query
+# reads only the index; the tables are loaded before the indexes are built.
+#
+# The backend has the extract(name, columns) interface of the scheduler
+# (extract_scheduler.py) and extract_scan for fused scans (query_plan.py):
+# variables sharing a query (sgss_pos_inrange/sgtf, stp/msoa/region, ...)
+# are answered by one SELECT. Per-patient dates such as
+# "sgss_pos_inrange - 7 days" are loaded into a temporary table joined on
+# patient_id, and codelists into a temporary table the event index is
+# probed from. categorised_as and care home expressions are compiled into
+# numpy operations over the columns they use (category_expressions.py).
+DATABASE = "output/local_ehr.sqlite"
+EPOCH = np.datetime64("1970-01-01", "D")
+DATA_END = "2022-02-28"
+
+BMI_CODE = "22K.."
+MEASUREMENTS = {
+    # code: (mean, sd) of its numeric values
+    BMI_CODE: (28.0, 6.0),
+    "XE2q5": (75.0, 20.0),  # creatinine
+    "2469.": (130.0, 15.0),  # systolic BP
+    "246A.": (80.0, 10.0),  # diastolic BP
+    "XaPbt": (42.0, 12.0),  # HbA1c mmol/mol
+    "Xaeze": (42.0, 12.0),
+    "Xaezd": (42.0, 12.0),
+    "X772q": (6.0, 1.0),  # HbA1c %
+    "XaERo": (6.0, 1.0),
+    "XaERp": (6.0, 1.0),
+}
+REGIONS = [
+    "North East",
+    "North West",
+    "Yorkshire and The Humber",
+    "East Midlands",
+    "West Midlands",
+    "East of England",
+    "London",
+    "South East",
+    "South West",
+]
+DISCHARGE_DESTINATIONS = ["306689006", "306706006", "305398007", "306705005", "50861005", "306694006"]
+COVID_VACCINE = "SARS-2 CORONAVIRUS"
+
+SCHEMA = """
+CREATE TABLE patient (patient_id INTEGER PRIMARY KEY, date_of_birth INTEGER, sex TEXT);
+CREATE TABLE practice (practice_id INTEGER PRIMARY KEY, stp_code TEXT, msoa_code TEXT, nuts1_region_name TEXT);
+CREATE TABLE registration (patient_id INTEGER, practice_id INTEGER, start_date INTEGER, end_date INTEGER);
+CREATE TABLE address (
+    patient_id INTEGER, start_date INTEGER, end_date INTEGER,
+    index_of_multiple_deprivation INTEGER, rural_urban_classification INTEGER,
+    IsPotentialCareHome INTEGER, LocationRequiresNursing TEXT, LocationDoesNotRequireNursing TEXT
+);
+CREATE TABLE household (patient_id INTEGER PRIMARY KEY, household_id INTEGER, household_size INTEGER);
+CREATE TABLE clinical_event (patient_id INTEGER, code TEXT, date INTEGER, numeric_value REAL);
+CREATE TABLE medication (patient_id INTEGER, code TEXT, date INTEGER);
+CREATE TABLE sgss_test (patient_id INTEGER, specimen_date INTEGER, result TEXT, s_gene_target_failure TEXT);
+CREATE TABLE emergency_care (
+    attendance_id INTEGER PRIMARY KEY, patient_id INTEGER, arrival_date INTEGER, discharge_destination TEXT
+);
+CREATE TABLE emergency_care_diagnosis (attendance_id INTEGER, code TEXT);
+CREATE TABLE vaccination (patient_id INTEGER, target_disease TEXT, date INTEGER);
+CREATE TABLE ons_death (patient_id INTEGER PRIMARY KEY, date_of_death INTEGER, underlying_cause TEXT);
+"""
+INDEXES = """
+CREATE INDEX registration_patient ON registration (patient_id, start_date, end_date, practice_id);
+CREATE INDEX address_patient ON address (patient_id, start_date);
+CREATE INDEX clinical_event_code ON clinical_event (code, patient_id, date, numeric_value);
+CREATE INDEX medication_code ON medication (code, patient_id, date);
+CREATE INDEX sgss_test_result ON sgss_test (result, patient_id, specimen_date, s_gene_target_failure);
+CREATE INDEX emergency_care_patient ON emergency_care (patient_id, arrival_date);
+CREATE INDEX emergency_care_diagnosis_code ON emergency_care_diagnosis (attendance_id, code);
+CREATE INDEX vaccination_target ON vaccination (target_disease, patient_id, date);
+"""
+
+
+# GENERATING THE DATABASE
+def days(date):
+    return int((np.datetime64(date, "D") - EPOCH).astype(int))
+
+
+def random_days(rng, start, end, size):
+    return rng.integers(days(start), days(end) + 1, size)
+
+
+def nullable(values, missing):
+    values = values.tolist()
+    for i in np.flatnonzero(missing):
+        values[i] = None
+    return values
+
+
+def insert(connection, table, *columns):
+    columns = [column if isinstance(column, list) else column.tolist() for column in columns]
+    placeholders = ", ".join("?" * len(columns))
+    connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", zip(*columns))
+
+
+def per_patient(ids, rng, mean):
+    # Patient ids repeated for a Poisson number of rows each
+    return np.repeat(ids, rng.poisson(mean, len(ids)))
+
+
+def noise_codes(rng, prefix, count, length, exclude):
+    # Codes in no codelist, for events the study does not look for
+    alphabet = np.array(list("0123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"))
+    codes = [prefix + "".join(chars) for chars in rng.choice(alphabet, (count, length - len(prefix)))]
+    return np.array(sorted(set(codes) - set(exclude)))
+
+
+def generate_patients(connection, ids, rng):
+    ages = rng.choice(len(population_age_probabilities()), len(ids), p=population_age_probabilities())
+    born = np.datetime64("2021-10-01", "D") - (ages * 365.25 + rng.integers(0, 365, len(ids))).astype("timedelta64[D]")
+    # TPP only holds the month of birth
+    born = born.astype("datetime64[M]").astype("datetime64[D]")
+    sex = rng.choice(np.array(["M", "F", "U"]), len(ids), p=[0.49, 0.5, 0.01])
+    insert(connection, "patient", ids, (born - EPOCH).astype(int), sex)
+    return (born - EPOCH).astype(int)
+
+
+def generate_practices(connection, rng, practices, stps=42):
+    from msoa_lookup import msoa_codes
+
+    stp_codes = np.array([f"E54000{number:03d}" for number in range(stps)])
+    stp_regions = rng.choice(np.array(REGIONS), stps)
+    stp = rng.integers(0, stps, practices)
+    msoa = rng.choice(msoa_codes(), practices)
+    insert(connection, "practice", np.arange(1, practices + 1), stp_codes[stp], msoa, stp_regions[stp])
+
+
+def generate_registrations(connection, ids, rng, practices):
+    start = random_days(rng, "1990-01-01", "2020-06-30", len(ids))
+    # Deregistered from all practices
+    end = np.where(rng.random(len(ids)) < 0.02, random_days(rng, "2021-11-01", DATA_END, len(ids)), -1)
+    insert(connection, "registration", ids, rng.integers(1, practices + 1, len(ids)), start, nullable(end, end < 0))
+    # A previous practice, ending the day before the current registration
+    moved = rng.random(len(ids)) < 0.15
+    previous_start = start[moved] - rng.integers(30, 3650, moved.sum())
+    insert(
+        connection,
+        "registration",
+        ids[moved],
+        rng.integers(1, practices + 1, moved.sum()),
+        previous_start,
+        start[moved] - 1,
+    )
+
+
+def generate_addresses(connection, ids, rng, born):
+    start = random_days(rng, "1995-01-01", "2019-12-31", len(ids))
+    age = (days("2021-12-01") - born) / 365.25
+    care_home = rng.random(len(ids)) < np.where(age > 75, 0.12, 0.002)
+    nursing = rng.random(len(ids)) < 0.5
+    insert(
+        connection,
+        "address",
+        ids,
+        start,
+        [None] * len(ids),
+        rng.integers(1, 32845, len(ids)),
+        rng.integers(1, 9, len(ids)),
+        care_home.astype(int),
+        np.where(care_home & nursing, "Y", "N"),
+        np.where(care_home & ~nursing, "Y", "N"),
+    )
+    # An earlier address that ended when the current one started
+    moved = rng.random(len(ids)) < 0.3
+    insert(
+        connection,
+        "address",
+        ids[moved],
+        start[moved] - rng.integers(365, 7300, moved.sum()),
+        start[moved] - 1,
+        rng.integers(1, 32845, moved.sum()),
+        rng.integers(1, 9, moved.sum()),
+        [0] * int(moved.sum()),
+        ["N"] * int(moved.sum()),
+        ["N"] * int(moved.sum()),
+    )
+
+
+def generate_households(connection, ids, rng):
+    sizes = rng.integers(1, 7, len(ids))
+    first = np.cumsum(sizes) - sizes
+    starts = first[first < len(ids)]
+    household = np.repeat(np.arange(1, len(starts) + 1), np.diff(np.append(starts, len(ids))))
+    size = np.bincount(household)[household]
+    insert(connection, "household", ids, household, size)
+
+
+def generate_tests(connection, ids, rng):
+    # Most patients have a positive test in the study period, as the
+    # population is people testing positive
+    positive = ids[rng.random(len(ids)) < 0.9]
+    dates = random_days(rng, "2021-10-03", "2022-01-01", len(positive))
+    sgtf = rng.choice(np.array(["0", "1", "9", ""]), len(positive), p=[0.6, 0.25, 0.05, 0.1])
+    insert(connection, "sgss_test", positive, dates, ["positive"] * len(positive), nullable(sgtf, sgtf == ""))
+    earlier = ids[rng.random(len(ids)) < 0.2]
+    insert(
+        connection,
+        "sgss_test",
+        earlier,
+        random_days(rng, "2020-08-01", "2021-09-30", len(earlier)),
+        ["positive"] * len(earlier),
+        [None] * len(earlier),
+    )
+    negative = per_patient(ids, rng, 1.5)
+    insert(
+        connection,
+        "sgss_test",
+        negative,
+        random_days(rng, "2020-03-01", DATA_END, len(negative)),
+        ["negative"] * len(negative),
+        [None] * len(negative),
+    )
+
+
+def generate_vaccinations(connection, ids, rng):
+    dose1 = ids[rng.random(len(ids)) < 0.8]
+    date1 = random_days(rng, "2020-12-08", "2021-07-31", len(dose1))
+    keep2 = rng.random(len(dose1)) < 0.88
+    dose2, date2 = dose1[keep2], date1[keep2] + rng.integers(21, 84, keep2.sum())
+    keep3 = rng.random(len(dose2)) < 0.6
+    dose3, date3 = dose2[keep3], np.maximum(date2[keep3] + rng.integers(90, 240, keep3.sum()), days("2021-09-16"))
+    keep3 = date3 <= days(DATA_END)
+    flu = ids[rng.random(len(ids)) < 0.3]
+    for patients, dates, target in (
+        (dose1, date1, COVID_VACCINE),
+        (dose2, date2, COVID_VACCINE),
+        (dose3[keep3], date3[keep3], COVID_VACCINE),
+        (flu, random_days(rng, "2020-09-01", "2021-12-31", len(flu)), "INFLUENZA"),
+    ):
+        insert(connection, "vaccination", patients, [target] * len(patients), dates)
+
+
+def generate_deaths(connection, ids, rng):
+    died = ids[rng.random(len(ids)) < 0.02]
+    causes = rng.choice(np.array(["U071", "I219", "C349", "J189"]), len(died))
+    insert(connection, "ons_death", died, random_days(rng, "2021-11-01", DATA_END, len(died)), causes)
+
+
+def generate_emergency_care(connection, ids, rng, covid_codes):
+    patients = per_patient(ids, rng, 0.4)
+    attendances = np.arange(1, len(patients) + 1)
+    destinations = rng.choice(np.array(DISCHARGE_DESTINATIONS), len(patients))
+    insert(
+        connection,
+        "emergency_care",
+        attendances,
+        patients,
+        random_days(rng, "2021-06-01", DATA_END, len(patients)),
+        destinations,
+    )
+    diagnosed = np.repeat(attendances, rng.integers(1, 3, len(attendances)))
+    other = noise_codes(rng, "", 500, 9, covid_codes)
+    codes = np.where(rng.random(len(diagnosed)) < 0.25, rng.choice(covid_codes, len(diagnosed)), rng.choice(other, len(diagnosed)))
+    insert(connection, "emergency_care_diagnosis", diagnosed, codes)
+
+
+def generate_clinical_events(connection, ids, rng, born, study_codes, events_per_patient):
+    patients = per_patient(ids, rng, events_per_patient)
+    kind = rng.choice(3, len(patients), p=[0.6, 0.3, 0.1])
+    other = noise_codes(rng, "Y", 5000, 5, study_codes)
+    measured = np.array(list(MEASUREMENTS))
+    codes = np.select(
+        [kind == 0, kind == 1],
+        [rng.choice(other, len(patients)), rng.choice(study_codes, len(patients))],
+        rng.choice(measured, len(patients)),
+    )
+    # Events fall after birth
+    dates = np.maximum(random_days(rng, "1990-01-01", DATA_END, len(patients)), born[patients - 1])
+    means = np.array([MEASUREMENTS.get(code, (np.nan, 0))[0] for code in measured])
+    sds = np.array([MEASUREMENTS.get(code, (np.nan, 0))[1] for code in measured])
+    which = np.searchsorted(measured, codes[kind == 2], sorter=np.argsort(measured))
+    which = np.argsort(measured)[which]
+    values = np.full(len(patients), np.nan)
+    values[kind == 2] = np.round(rng.normal(means[which], sds[which]), 1)
+    insert(connection, "clinical_event", patients, codes, dates, nullable(values, kind != 2))
+
+
+def generate_medications(connection, ids, rng, medication_codes):
+    patients = per_patient(ids, rng, 6)
+    other = noise_codes(rng, "3", 2000, 17, medication_codes)
+    codes = np.where(rng.random(len(patients)) < 0.2, rng.choice(medication_codes, len(patients)), rng.choice(other, len(patients)))
+    insert(connection, "medication", patients, codes, random_days(rng, "2019-01-01", DATA_END, len(patients)))
+
+
+def study_codes(covariate_definitions, system, funcnames):
+    from codelist_matcher import code_and_category, study_codelists
+
+    lists, _ = study_codelists(
+        {name: definition for name, definition in covariate_definitions.items() if definition[0] in funcnames}
+    )
+    return np.array(
+        sorted({code_and_category(item)[0] for codes in lists.get(system, {}).values() for item in codes})
+    )
+
+
+def make_database(path, study, patients, seed=0, practices=1000, events_per_patient=30):
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    definitions = study.covariate_definitions
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(SCHEMA)
+        ids = np.arange(1, patients + 1)
+        born = generate_patients(connection, ids, rng)
+        generate_practices(connection, rng, practices)
+        generate_registrations(connection, ids, rng, practices)
+        generate_addresses(connection, ids, rng, born)
+        generate_households(connection, ids, rng)
+        generate_tests(connection, ids, rng)
+        generate_vaccinations(connection, ids, rng)
+        generate_deaths(connection, ids, rng)
+        generate_emergency_care(
+            connection, ids, rng, study_codes(definitions, "snomed", ("attended_emergency_care",))
+        )
+        generate_clinical_events(
+            connection,
+            ids,
+            rng,
+            born,
+            study_codes(definitions, "ctv3", ("with_these_clinical_events",)),
+            events_per_patient,
+        )
+        generate_medications(connection, ids, rng, study_codes(definitions, "snomed", ("with_these_medications",)))
+        connection.commit()
+        connection.executescript(INDEXES)
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def table_sizes(path):
+    connection = sqlite3.connect(path)
+    try:
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        return {table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+    finally:
+        connection.close()
+
+
+# EXTRACTING
+# The value each patients.* function returns when `returning` is not given,
+# and the names under which the functions' queries return their values
+DEFAULT_RETURNING = {
+    "most_recent_bmi": "numeric_value",
+    "mean_recorded_value": "numeric_value",
+    "age_as_of": "age",
+    "date_deregistered_from_all_supported_practices": "date",
+    "sex": "sex",
+    "care_home_status_as_of": "category",
+    "categorised_as": "category",
+}
+RETURNING_FIELDS = {
+    "date_of_death": "date",
+    "date_arrived": "date",
+    "pseudo_id": "household_id",
+}
+# Codes drive the join into the event table's code index. SQLite does not
+# use that index from a temporary table of its own accord (it builds an
+# automatic index on every query instead), so it is named
+CODE_JOIN = "temp.codes c CROSS JOIN {table} e INDEXED BY {table}_code ON e.code = c.code"
+COLUMN_KINDS = {"date": "date", "str": "category", "bool": "bool", "int": "int", "float": "float"}
+# The address columns care_home_status_as_of expressions use
+CARE_HOME_COLUMNS = {
+    "IsPotentialCareHome": "int",
+    "LocationRequiresNursing": "category",
+    "LocationDoesNotRequireNursing": "category",
+}
+
+
+def day_of_year(dates):
+    # (month, day) as one comparable number
+    months = dates.astype("datetime64[M]")
+    return (months - dates.astype("datetime64[Y]")).astype(int) * 32 + (dates - months).astype(int)
+
+
+def is_last(args):
+    return bool(args.get("find_last_match_in_period") or args.get("return_last_date_in_period"))
+
+
+def round_to_nearest(values, nearest):
+    # CAST(ROUND(value / nearest) AS INTEGER) * nearest, halves away from zero
+    values = values.astype(float) / nearest
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(np.int64) * nearest
+
+
+def sql_value(value):
+    # A column value as stored in a temporary table: dates as days
+    if value is None:
+        return None
+    if isinstance(value, np.datetime64):
+        return None if np.isnat(value) else int((value - EPOCH).astype(int))
+    if isinstance(value, (np.bool_, bool)):
+        return int(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def column_values(values):
+    # A column from the scheduler as a list of SQL values
+    if isinstance(values, pa.Array):
+        if pa.types.is_dictionary(values.type):
+            values = values.dictionary_decode()
+        # Missing categories are "" in cohortextractor's expressions
+        return [value if value is not None else "" for value in values.to_pylist()]
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        present = ~np.isnat(values)
+        days_since = (values.astype("datetime64[D]") - EPOCH).astype(np.int64)
+        return nullable(days_since, ~present)
+    if values.dtype.kind == "b":
+        return values.astype(int).tolist()
+    return values.tolist()
+
+
+class SQLiteBackend:
+    """The variables of a StudyDefinition extracted from a local EHR database.
+
+    Returns columns as the dummy data backend does: dates as datetime64[D]
+    arrays (NaT where missing), categories as dictionary arrays and the rest
+    as numpy arrays, one row per patient in patient_id order.
+    """
+
+    def __init__(self, path, study):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        self.connection.execute("PRAGMA temp_store = MEMORY")
+        self.connection.execute("CREATE TEMP TABLE codes (code TEXT PRIMARY KEY, category TEXT)")
+        self.patient_ids = np.array(
+            [row[0] for row in self.connection.execute("SELECT patient_id FROM patient ORDER BY patient_id")]
+        )
+        self.rows = len(self.patient_ids)
+        # The rows the queries have read, for extract_profile.py
+        self.rows_scanned = 0
+        self.definitions = study.covariate_definitions
+        self.kinds = {column.name: column.kind for column in cohort_schema(study)}
+        self.date_columns = study.pandas_csv_args["date_col_for"]
+        self.sources = {date: value for value, date in self.date_columns.items()}
+
+    def extract(self, name, columns):
+        if name in self.sources:
+            return {name: columns[name]}
+        funcname, args = self.definitions[name]
+        return self.run(funcname, args, [name], columns)
+
+    def extract_scan(self, scan, columns):
+        funcname, args = self.definitions[scan.variables[0]]
+        names = [name for name in scan.variables if name not in self.sources]
+        return self.run(funcname, args, names, columns)
+
+    def run(self, funcname, args, names, columns):
+        fields = self.query(funcname, args, columns)
+        produced = {}
+        for name in names:
+            _, variable_args = self.definitions[name]
+            returning = variable_args.get("returning") or DEFAULT_RETURNING.get(funcname, "binary_flag")
+            field = RETURNING_FIELDS.get(returning, returning)
+            kind = self.kinds.get(name) or COLUMN_KINDS[variable_args["column_type"]]
+            positions, values = fields[field]
+            # Per variable, as variables differing only in rounding share a scan
+            if variable_args.get("round_to_nearest"):
+                values = round_to_nearest(values, variable_args["round_to_nearest"])
+            produced[name] = self.to_column(positions, values, kind)
+            if name in self.date_columns:
+                produced[self.date_columns[name]] = self.to_column(*fields["date"], "date")
+        return produced
+
+    def query(self, funcname, args, columns):
+        # {field: (positions of the patients with a value, their values)},
+        # from the query's rows unless the function gives its fields itself
+        result = getattr(self, funcname)(args, columns)
+        if isinstance(result, dict):
+            return result
+        return self.row_fields(*result)
+
+    def row_fields(self, names, rows):
+        # Event queries read the matches they count for each patient, the
+        # others a row for each row they return
+        if "number_of_matches_in_period" in names:
+            matches = names.index("number_of_matches_in_period")
+            self.rows_scanned += sum(row[matches] for row in rows)
+        else:
+            self.rows_scanned += len(rows)
+        positions = np.searchsorted(self.patient_ids, np.array([row[0] for row in rows], dtype=np.int64))
+        fields = {}
+        for i, name in enumerate(names[1:], 1):
+            values = np.array([row[i] for row in rows], dtype=object)
+            present = np.array([value is not None for value in values], dtype=bool)
+            fields[name] = (positions[present], values[present])
+        return fields
+
+    def to_column(self, positions, values, kind):
+        if kind == "date":
+            column = np.full(self.rows, np.datetime64("NaT"), dtype="datetime64[D]")
+            column[positions] = EPOCH + values.astype(np.int64)
+            return column
+        if kind == "category":
+            labels = np.full(self.rows, None, dtype=object)
+            labels[positions] = [str(value) for value in values]
+            return pa.array(labels, pa.string()).dictionary_encode()
+        if kind == "bool":
+            column = np.zeros(self.rows, dtype=bool)
+            column[positions] = values.astype(bool)
+            return column
+        column = np.zeros(self.rows, dtype=float if kind == "float" else np.int64)
+        column[positions] = values.astype(column.dtype)
+        return column
+
+    # QUERY PARTS
+    def load_codes(self, codes):
+        self.connection.execute("DELETE FROM temp.codes")
+        pairs = [item if isinstance(item, tuple) else (item, None) for item in codes]
+        self.connection.executemany("INSERT OR REPLACE INTO temp.codes VALUES (?, ?)", pairs)
+
+    def date_bounds(self, bounds, columns, patient):
+        # SQL for each bound (None, a parameter, or the patient's own date from
+        # a temporary table) with the parameters and the join they need
+        sqls, params, per_patient = [], [], {}
+        for i, value in enumerate(bounds):
+            if value is None:
+                sqls.append(None)
+            elif ISO_DATE.match(value):
+                sqls.append("?")
+                params.append(days(value))
+            else:
+                per_patient[f"bound{i}"] = evaluate_date(value, columns)
+                sqls.append(f"b.bound{i}")
+        if not per_patient:
+            return sqls, params, ""
+        names = list(per_patient)
+        self.connection.execute("DROP TABLE IF EXISTS temp.bounds")
+        self.connection.execute(
+            f"CREATE TEMP TABLE bounds (patient_id INTEGER PRIMARY KEY, {', '.join(names)})"
+        )
+        # Patients whose reference date is missing can match nothing
+        present = np.logical_and.reduce([~np.isnat(per_patient[name]) for name in names])
+        values = [column_values(per_patient[name][present]) for name in names]
+        self.connection.executemany(
+            f"INSERT INTO temp.bounds VALUES (?{', ?' * len(names)})",
+            zip(self.patient_ids[present].tolist(), *values),
+        )
+        return sqls, params, f"JOIN temp.bounds b ON b.patient_id = {patient}"
+
+    def window(self, date, between, columns, patient="e.patient_id"):
+        (lower, upper), params, join = self.date_bounds(between or (None, None), columns, patient)
+        conditions = []
+        if lower is not None:
+            conditions.append(f"{date} >= {lower}")
+        if upper is not None:
+            conditions.append(f"{date} <= {upper}")
+        return conditions, params, join
+
+    def as_of(self, table, value, columns):
+        # Rows of a table with start_date and end_date current on a date
+        (date,), params, join = self.date_bounds((value,), columns, f"{table}.patient_id")
+        conditions = [f"{table}.start_date <= {date}", f"({table}.end_date IS NULL OR {table}.end_date >= {date})"]
+        return conditions, params * 2, join
+
+    def events(self, source, date, fields, conditions, params, args, columns, ties=None):
+        # One row per patient with a matching event: the first or last date,
+        # the number of matches and the given fields of the chosen event.
+        # Events on the same day are ordered by `ties` (by default the fields),
+        # so the one chosen does not depend on the order SQLite reads them in
+        window, window_params, join = self.window(f"e.{date}", args.get("between"), columns)
+        where = " AND ".join(conditions + window) or "1"
+        keys = [f"e.{date}"] + list(ties if ties is not None else [sql for _, sql in fields])
+        order = ", ".join(f"{key} DESC" if is_last(args) else key for key in keys)
+        selected = "".join(f", {sql} AS {name}" for name, sql in fields)
+        sql = (
+            f"SELECT patient_id, date, 1, matches{''.join(f', {name}' for name, _ in fields)} FROM ("
+            f"SELECT e.patient_id, e.{date} AS date, COUNT(*) OVER patient AS matches, "
+            f"ROW_NUMBER() OVER (patient ORDER BY {order}) AS position{selected} "
+            f"FROM {source} {join} WHERE {where} WINDOW patient AS (PARTITION BY e.patient_id)"
+            f") WHERE position = 1"
+        )
+        names = ["patient_id", "date", "binary_flag", "number_of_matches_in_period"] + [name for name, _ in fields]
+        return names, self.connection.execute(sql, params + window_params).fetchall()
+
+    # PATIENTS.* FUNCTIONS
+    def with_these_clinical_events(self, args, columns):
+        self.load_codes(args["codelist"])
+        return self.events(
+            CODE_JOIN.format(table="clinical_event"),
+            "date",
+            [("category", "c.category"), ("numeric_value", "e.numeric_value")],
+            [],
+            [],
+            args,
+            columns,
+            ties=["e.code", "e.numeric_value"],
+        )
+
+    def with_these_medications(self, args, columns):
+        self.load_codes(args["codelist"])
+        return self.events(CODE_JOIN.format(table="medication"), "date", [], [], [], args, columns, ties=["e.code"])
+
+    def mean_recorded_value(self, args, columns):
+        # The mean of the values on each patient's most recent day
+        self.load_codes(args["codelist"])
+        window, params, join = self.window("e.date", args.get("between"), columns)
+        where = " AND ".join(window) or "1"
+        matching = f"{CODE_JOIN.format(table='clinical_event')} {join} WHERE {where}"
+        sql = f"""
+            WITH matching AS (SELECT e.patient_id, e.date, e.numeric_value FROM {matching}),
+            latest AS (SELECT patient_id, MAX(date) AS date, COUNT(*) AS matches FROM matching GROUP BY patient_id)
+            SELECT m.patient_id, m.date, AVG(m.numeric_value), l.matches
+            FROM matching m JOIN latest l ON l.patient_id = m.patient_id AND l.date = m.date
+            GROUP BY m.patient_id
+        """
+        names = ["patient_id", "date", "numeric_value", "number_of_matches_in_period"]
+        return names, self.connection.execute(sql, params).fetchall()
+
+    def most_recent_bmi(self, args, columns):
+        # Recorded BMIs taken at or above the minimum age
+        minimum_age = args.get("minimum_age_at_measurement") or 16
+        adult = (
+            "e.date >= julianday(date(p.date_of_birth * 86400, 'unixepoch', ?)) - 2440587.5"
+        )
+        return self.events(
+            "clinical_event e JOIN patient p ON p.patient_id = e.patient_id",
+            "date",
+            [("numeric_value", "e.numeric_value")],
+            ["e.code = ?", "e.numeric_value > 0", adult],
+            [BMI_CODE, f"+{minimum_age} years"],
+            dict(args, find_last_match_in_period=True),
+            columns,
+        )
+
+    def with_test_result_in_sgss(self, args, columns):
+        conditions, params = [], []
+        if args.get("test_result", "any") != "any":
+            conditions.append("e.result = ?")
+            params.append(args["test_result"])
+        else:
+            conditions.append("e.result IN ('positive', 'negative')")
+        return self.events(
+            "sgss_test e",
+            "specimen_date",
+            [("s_gene_target_failure", "e.s_gene_target_failure")],
+            conditions,
+            params,
+            args,
+            columns,
+        )
+
+    def died_from_any_cause(self, args, columns):
+        return self.events(
+            "ons_death e", "date_of_death", [("underlying_cause", "e.underlying_cause")], [], [], args, columns
+        )
+
+    def attended_emergency_care(self, args, columns):
+        conditions = []
+        if args.get("with_these_diagnoses"):
+            self.load_codes(args["with_these_diagnoses"])
+            conditions.append(
+                "EXISTS (SELECT 1 FROM emergency_care_diagnosis d JOIN temp.codes c ON c.code = d.code "
+                "WHERE d.attendance_id = e.attendance_id)"
+            )
+        return self.events(
+            "emergency_care e",
+            "arrival_date",
+            [("discharge_destination", "e.discharge_destination")],
+            conditions,
+            [],
+            args,
+            columns,
+        )
+
+    def with_tpp_vaccination_record(self, args, columns):
+        return self.events(
+            "vaccination e", "date", [], ["e.target_disease = ?"], [args["target_disease_matches"]], args, columns
+        )
+
+    def date_deregistered_from_all_supported_practices(self, args, columns):
+        # The end of the last registration, for patients with none current
+        window, params, join = self.window("e.end_date", args.get("between"), columns)
+        sql = f"""
+            SELECT e.patient_id, e.end_date FROM (
+                SELECT patient_id, MAX(end_date) AS end_date FROM registration
+                GROUP BY patient_id HAVING COUNT(*) = COUNT(end_date)
+            ) e {join} WHERE {" AND ".join(window) or "1"}
+        """
+        return ["patient_id", "date"], self.connection.execute(sql, params).fetchall()
+
+    def registered_with_one_practice_between(self, args, columns):
+        (start, end), params, join = self.date_bounds(
+            (args["start_date"], args["end_date"]), columns, "e.patient_id"
+        )
+        sql = (
+            f"SELECT e.patient_id, 1 FROM registration e {join} "
+            f"WHERE e.start_date <= {start} AND (e.end_date IS NULL OR e.end_date >= {end}) GROUP BY e.patient_id"
+        )
+        return ["patient_id", "binary_flag"], self.connection.execute(sql, params).fetchall()
+
+    def age_as_of(self, args, columns):
+        born = EPOCH + np.array(
+            [row[0] for row in self.connection.execute("SELECT date_of_birth FROM patient ORDER BY patient_id")],
+            dtype=np.int64,
+        )
+        reference = np.broadcast_to(evaluate_date(args["reference_date"], columns), self.rows)
+        # Whole years, less one where the birthday is still to come that year
+        years = reference.astype("datetime64[Y]").astype(int) - born.astype("datetime64[Y]").astype(int)
+        years -= day_of_year(reference) < day_of_year(born)
+        ages = [None if np.isnat(date) else int(age) for date, age in zip(reference, years)]
+        return ["patient_id", "age"], list(zip(self.patient_ids.tolist(), ages))
+
+    def sex(self, args, columns):
+        return ["patient_id", "sex"], self.connection.execute("SELECT patient_id, sex FROM patient").fetchall()
+
+    def address_as_of(self, args, columns):
+        # round_to_nearest is applied in run, to each variable of the scan
+        conditions, params, join = self.as_of("address", args["date"], columns)
+        sql = (
+            "SELECT address.patient_id, MAX(address.start_date), address.index_of_multiple_deprivation, "
+            f"address.rural_urban_classification FROM address {join} "
+            f"WHERE {' AND '.join(conditions)} GROUP BY address.patient_id"
+        )
+        names = ["patient_id", "date", "index_of_multiple_deprivation", "rural_urban_classification"]
+        return names, self.connection.execute(sql, params).fetchall()
+
+    def care_home_status_as_of(self, args, columns):
+        expressions = compiled(args["categorised_as"])
+        conditions, params, join = self.as_of("address", args["date"], columns)
+        sql = (
+            f"SELECT address.patient_id, MAX(address.start_date){''.join(', address.' + name for name in CARE_HOME_COLUMNS)} "
+            f"FROM address {join} WHERE {' AND '.join(conditions)} GROUP BY address.patient_id"
+        )
+        fields = self.row_fields(["patient_id", "date", *CARE_HOME_COLUMNS], self.connection.execute(sql, params).fetchall())
+        # Patients without a current address match nothing, so fall to the
+        # DEFAULT category
+        address = {name: self.to_column(*fields[name], kind) for name, kind in CARE_HOME_COLUMNS.items()}
+        return {"date": fields["date"], "category": self.category_field(expressions.evaluate(address, self.rows))}
+
+    def registered_practice_as_of(self, args, columns):
+        conditions, params, join = self.as_of("registration", args["date"], columns)
+        sql = (
+            "SELECT registration.patient_id, MAX(registration.start_date), p.stp_code, p.msoa_code, "
+            f"p.nuts1_region_name FROM registration {join} JOIN practice p ON p.practice_id = registration.practice_id "
+            f"WHERE {' AND '.join(conditions)} GROUP BY registration.patient_id"
+        )
+        names = ["patient_id", "date", "stp_code", "msoa_code", "nuts1_region_name"]
+        return names, self.connection.execute(sql, params).fetchall()
+
+    def household_as_of(self, args, columns):
+        # Households are a snapshot as of 2020-02-01, whatever the date asked for
+        sql = "SELECT patient_id, household_id, household_size FROM household"
+        return ["patient_id", "household_id", "household_size"], self.connection.execute(sql).fetchall()
+
+    def categorised_as(self, args, columns):
+        expressions = compiled(args["category_definitions"])
+        return {"category": self.category_field(expressions.evaluate(columns, self.rows))}
+
+    def category_field(self, categories):
+        present = np.flatnonzero(np.not_equal(categories, None))
+        return present, categories[present]
+
+
+def study_backend(path=DATABASE):
+    # For worker processes, which need to load the study definition themselves
+    from study_definition import study
+
+    return SQLiteBackend(path, study)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--events-per-patient", type=float, default=30)
+    parser.add_argument("--database", default=DATABASE)
+    options = parser.parse_args()
+
+    from study_definition import study
+
+    start = time.perf_counter()
+    make_database(options.database, study, options.patients, options.seed, events_per_patient=options.events_per_patient)
+    print(f"Wrote {options.database} in {time.perf_counter() - start:.1f}s "
+          f"({os.path.getsize(options.database) / 2**20:.0f}MB)")
+    for table, rows in table_sizes(options.database).items():
+        print(f"  {table:<26} {rows:>12,} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+# SURVIVAL TIME
+# The survival setups of cr_main.do and an_cox.do, from the cohort's dates:
+#   ae_surv_d    first of the A&E attendance, death and the EC data censor,
+#                failing on cox_ae (or cox_admit, attendances admitted)
+#   ae_surv_d1   the same plus a day, for the "FU plus 1" analysis
+#   ae_surv_d14  censored 14 days after the positive test, failing on cox_ae14
+#   stime_death  death, censored at the ONS data censor and 7 days before
+#                vaccination, failing on cox_death; stime_death28 also at 28
+#                days, failing on cox_death28
+# survival_columns derives every one of them in one pass over the dates.
+# cr_main.do has the death outcomes commented out, as the censoring dates
+# are not extracted, so they are only derived when those dates are given.
+#
+# stset gives _t0, _t, _d and _st for a setup as Stata's stset does, with
+# analysis time measured from the origin.
+SurvivalSetup = namedtuple("SurvivalSetup", "exit failure origin entry", defaults=("study_start", None))
+SurvivalTimes = namedtuple("SurvivalTimes", "t0 t d st")
+
+SETUPS = {
+    "ae": SurvivalSetup("ae_surv_d", "cox_ae"),
+    "ae_plus_1": SurvivalSetup("ae_surv_d1", "cox_ae"),
+    "ae_14": SurvivalSetup("ae_surv_d14", "cox_ae14"),
+    "admission": SurvivalSetup("ae_surv_d", "cox_admit"),
+    "death": SurvivalSetup("stime_death", "cox_death"),
+    "death_28": SurvivalSetup("stime_death28", "cox_death28"),
+}
+
+
+def survival_columns(study_start, ae_covid_date, died_date_ons, ec_data_cens, ae_admit, ons_data_cens=None, vacc_cens=None):
+    # Dates as float days, NaN for missing; min() ignores missing values as
+    # Stata's does, and a missing date is later than any other
+    out = {}
+    ae_surv_d = np.fmin(np.fmin(ae_covid_date, died_date_ons), ec_data_cens)
+    ae_surv_d14 = np.fmin(ae_surv_d, study_start + 14)
+    out["ae_surv_d"] = ae_surv_d
+    out["ae_surv_d1"] = ae_surv_d + 1
+    out["ae_surv_d14"] = ae_surv_d14
+    any_ae = ~np.isnan(ae_covid_date)
+    cox_ae = any_ae & (ae_covid_date <= ae_surv_d)
+    out["cox_ae"] = cox_ae.astype(float)
+    out["cox_ae14"] = (any_ae & (ae_covid_date <= ae_surv_d14)).astype(float)
+    out["cox_admit"] = (cox_ae & (ae_admit == 1)).astype(float)
+    out["cox_ae_time"] = ae_surv_d - study_start
+
+    if ons_data_cens is not None:
+        stime_death = np.fmin(died_date_ons, ons_data_cens)
+        if vacc_cens is not None:
+            stime_death = np.fmin(stime_death, vacc_cens)
+        stime_death28 = np.fmin(stime_death, study_start + 28)
+        died = ~np.isnan(died_date_ons)
+        cox_death = died & (died_date_ons <= stime_death)
+        out["stime_death"] = stime_death
+        out["stime_death28"] = stime_death28
+        out["cox_death"] = cox_death.astype(float)
+        out["cox_death28"] = (died & (died_date_ons <= stime_death28)).astype(float)
+        out["cox_time"] = stime_death - study_start
+        out["cox_time_d"] = np.where(cox_death, stime_death - study_start, np.nan)
+    return out
+
+
+def stset(columns, setup):
+    # Records ending on or before they start, or with a missing exit or
+    # origin, are outside the data (_st == 0) with missing times
+    origin = columns[setup.origin] if setup.origin else 0
+    t = columns[setup.exit] - origin
+    t0 = np.zeros(len(t)) if setup.entry is None else np.fmax(columns[setup.entry] - origin, 0)
+    with np.errstate(invalid="ignore"):
+        st = t > t0
+    failure = np.nan_to_num(columns[setup.failure]) != 0
+    return SurvivalTimes(np.where(st, t0, np.nan), np.where(st, t, np.nan), st & failure, st)
+
+
+# EPISODES
+# stsplit: each record cut into episodes at analysis times, a cut c
+# splitting the records with t0 < c < t. The episodes are not copies of the
+# records' columns: record i's are episodes offsets[i]:offsets[i + 1] (CSR,
+# as in event_index.py), each knowing only its record, interval, period
+# (the number of cuts at or before its start) and whether it fails, which
+# only the last episode of a failing record does. A column is expanded to
+# the episodes when something asks for it, so a model over the episodes
+# repeats only the columns it uses.
+class Episodes:
+    """Records split at analysis times, as offsets into the records."""
+
+    def __init__(self, times, cuts):
+        self.cuts = np.unique(np.asarray(cuts, dtype=float))
+        t0, t = np.nan_to_num(times.t0), np.nan_to_num(times.t)
+        first = np.searchsorted(self.cuts, t0, "right")
+        last = np.searchsorted(self.cuts, t, "left")
+        counts = np.where(times.st, last - first + 1, 0)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.rows = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+
+        # Each episode's place among its record's, and among the cuts
+        position = np.arange(len(self.rows)) - self.offsets[self.rows]
+        self.period = first[self.rows] + position
+        ends = np.append(self.cuts, np.inf)
+        starts = np.append(-np.inf, self.cuts)
+        self.t0 = np.maximum(starts[self.period], t0[self.rows])
+        self.t = np.minimum(ends[self.period], t[self.rows])
+        closing = np.zeros(len(self.rows), dtype=bool)
+        closing[self.offsets[1:][counts > 0] - 1] = True
+        self.d = closing & times.d[self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def expand(self, values):
+        # A record column's value on each of its episodes
+        return values[self.rows]
+
+
+class EpisodeColumns:
+    """A {name: column} mapping over episodes, expanding record columns when read."""
+
+    def __init__(self, columns, episodes):
+        self.columns = columns
+        self.episodes = episodes
+        self.expanded = {
+            "_t0": episodes.t0,
+            "_t": episodes.t,
+            "_d": episodes.d.astype(float),
+            "_period": episodes.period.astype(float),
+        }
+
+    def __getitem__(self, name):
+        if name not in self.expanded:
+            self.expanded[name] = self.episodes.expand(self.columns[name])
+        return self.expanded[name]
+
+    def __contains__(self, name):
+        return name in self.expanded or name in self.columns
+
@@ -13,8 +13,43 @@ from cohortextractor import (
 from dictionaries import dict_msoa
 
 # IMPORT CODELIST DEFINITIONS FROM CODELIST.PY (WHICH PULLS THEM FROM
-# CODELIST FOLDER
-from codelists import *
+# CODELIST FOLDER). Only the codelists named here are read from disk
+from codelists import (
+    snomed_covid,
+    covid_identification_in_primary_care_case_codes_clinical,
+    covid_identification_in_primary_care_case_codes_test,
+    covid_identification_in_primary_care_case_codes_seq,
+    aplastic_codes,
+    hiv_codes,
+    permanent_immune_codes,
+    temp_immune_codes,
+    stroke,
+    dementia,
+    clear_smoking_codes,
+    other_neuro,
+    ethnicity_codes,
+    ethnicity_codes_16,
+    chronic_respiratory_disease_codes,
+    asthma_codes,
+    pred_codes,
+    chronic_cardiac_disease_codes,
+    diabetes_codes,
+    lung_cancer_codes,
+    haem_cancer_codes,
+    other_cancer_codes,
+    chronic_liver_disease_codes,
+    creatinine_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    dialysis_codes,
+    organ_transplant_codes,
+    spleen_codes,
+    sickle_cell_codes,
+    ra_sle_psoriasis_codes,
+    systolic_blood_pressure_codes,
+    diastolic_blood_pressure_codes,
+    hypertension_codes,
+)
 
 
 # STUDY DEFINITION
@@ -0,0 +1,161 @@
+import argparse
+import re
+
+from date_expressions import date_anchor, parse_date
+
+
+# VARIABLE DEPENDENCY GRAPH
+# Which variables in the StudyDefinition need which others before they can be
+# extracted. A variable depends on another when it
+#   - uses it in a date expression ("vaxdate1 + 19 days", "sgss_pos_inrange"
+#     as an as-of date, "sgss_pos_inrange - 1 year" in a registration window)
+#   - uses it in a categorised_as or satisfying expression
+#     (population, smoking_status, asthma)
+#   - takes its value from it (the include_date_of_match columns)
+IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+
+# Arguments holding {category: expression} (categorised_as, satisfying and
+# care_home_status_as_of)
+EXPRESSION_ARGUMENTS = ("category_definitions", "categorised_as")
+
+
+def date_reference(value):
+    # The variable a date expression is relative to, or None for a fixed date
+    return date_anchor(value)
+
+
+def argument_dates(value):
+    # The strings of an argument that read as date expressions (which
+    # includes single words such as returning="date")
+    if isinstance(value, str):
+        try:
+            parse_date(value)
+        except ValueError:
+            return []
+        return [value]
+    if isinstance(value, tuple):
+        # between=(start, end)
+        return [date for item in value for date in argument_dates(item)]
+    return []
+
+
+def argument_references(value, names):
+    return {date_anchor(date) for date in argument_dates(value)} & names
+
+
+def expression_references(category_definitions, names):
+    identifiers = set()
+    for expression in category_definitions.values():
+        identifiers.update(IDENTIFIER.findall(expression))
+    return identifiers & names
+
+
+def variable_dependencies(covariate_definitions):
+    names = set(covariate_definitions)
+    dependencies = {}
+    for name, (funcname, args) in covariate_definitions.items():
+        references = set()
+        for key, value in args.items():
+            if key in EXPRESSION_ARGUMENTS:
+                references |= expression_references(value, names)
+            else:
+                references |= argument_references(value, names)
+        references.discard(name)
+        dependencies[name] = tuple(other for other in covariate_definitions if other in references)
+    return dependencies
+
+
+class VariableGraph:
+    """Dependencies between the variables of a StudyDefinition.
+
+    `dependencies[name]` are the variables `name` needs, and `dependents[name]`
+    the variables that need it, both in definition order.
+    """
+
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self.dependents = {name: [] for name in dependencies}
+        for name, needs in dependencies.items():
+            for other in needs:
+                self.dependents[other].append(name)
+        self._order = self._topological_order()
+
+    @classmethod
+    def from_study(cls, study):
+        return cls(variable_dependencies(study.covariate_definitions))
+
+    def _topological_order(self):
+        # Definition order, except that a variable comes after everything it
+        # depends on
+        ordered = {}
+
+        def visit(name, path):
+            if name in ordered:
+                return
+            if name in path:
+                raise ValueError(f"Circular dependency: {' -> '.join(path + (name,))}")
+            for other in self.dependencies[name]:
+                visit(other, path + (name,))
+            ordered[name] = None
+
+        for name in self.dependencies:
+            visit(name, ())
+        return list(ordered)
+
+    def topological_order(self):
+        return list(self._order)
+
+    def depths(self):
+        # Length of the longest dependency chain leading to each variable
+        depth = {}
+        for name in self._order:
+            depth[name] = max((depth[other] + 1 for other in self.dependencies[name]), default=0)
+        return depth
+
+    def levels(self):
+        # Variables that can all run at once, once the previous levels are done
+        levels = []
+        for name, depth in self.depths().items():
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(name)
+        return levels
+
+    def downstream(self, names):
+        # The given variables and everything that depends on them, in order
+        selected = set(names)
+        for name in self._order:
+            if any(other in selected for other in self.dependencies[name]):
+                selected.add(name)
+        return [name for name in self._order if name in selected]
+
+    def upstream(self, names):
+        # The given variables and everything they depend on, in order
+        selected = set(names)
+        for name in reversed(self._order):
+            if name in selected:
+                selected.update(self.dependencies[name])
+        return [name for name in self._order if name in selected]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dot", action="store_true", help="print the graph in Graphviz format")
+    options = parser.parse_args()
+
+    from study_definition import study
+
+    graph = VariableGraph.from_study(study)
+    if options.dot:
+        print("digraph study {")
+        for name in graph.topological_order():
+            for other in graph.dependencies[name]:
+                print(f'  "{other}" -> "{name}";')
+        print("}")
+        return
+    for depth, names in enumerate(graph.levels()):
+        print(f"Level {depth} ({len(names)} variables): {', '.join(names)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import tempfile
+from collections.abc import Mapping
+
+import pyarrow as pa
+
+from extract_scheduler import extract_parallel, extract_serial
+
+
+# PER-VARIABLE RESULT CACHE
+# Keeps the columns each variable (or fused scan) produced in
+# output/.variable_cache/<key>.arrow. The key is a sha1 of
+#   - the backend and the data it reads (e.g. dummy data, rows and seed)
+#   - each variable's name, function and arguments, with date expressions as
+#     written and codelists by the sha1 of their CSV (or a hash of the
+#     codes, for codelists built in codelists.py)
+#   - the keys of the variables it depends on
+# Changing a variable therefore changes its key and the keys of everything
+# downstream of it, and a rerun only extracts those; everything else is read
+# back from the cache. Cached columns are memory-mapped Arrow files.
+CACHE_DIR = os.environ.get("VARIABLE_CACHE_DIR", "output/.variable_cache")
+
+
+def canonical(value):
+    if isinstance(value, list) and hasattr(value, "system"):
+        # A Codelist
+        source = getattr(value, "source", None)
+        if source is None:
+            source = hashlib.sha1(repr(list(value)).encode()).hexdigest()
+        return ("codelist", value.system, source)
+    if isinstance(value, Mapping):
+        return ("mapping", tuple(sorted((str(key), canonical(item)) for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(map(canonical, value)))
+    return value
+
+
+def definition_digest(name, funcname, args):
+    return hashlib.sha1(repr((name, funcname, canonical(args))).encode()).hexdigest()
+
+
+def node_keys(graph, members, covariate_definitions, backend_key):
+    # members: the variables each node of the graph extracts (one per node,
+    # or several for a fused scan)
+    keys = {}
+    for node in graph.topological_order():
+        parts = [backend_key]
+        parts += [definition_digest(name, *covariate_definitions[name]) for name in members[node]]
+        parts += [keys[other] for other in graph.dependencies[node]]
+        keys[node] = hashlib.sha1("\n".join(parts).encode()).hexdigest()
+    return keys
+
+
+def cache_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"{key}.arrow")
+
+
+def write_columns(path, columns):
+    table = pa.table(
+        {
+            name: values if isinstance(values, pa.Array) else pa.array(values)
+            for name, values in columns.items()
+        }
+    )
+    # Written to a temporary file and moved into place, so that a rerun never
+    # reads a half written entry
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_columns(path):
+    # Back in the form backends produce them: dictionary arrays for
+    # categories, numpy arrays (datetime64[D] for dates) for the rest
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    columns = {}
+    for name in table.column_names:
+        array = table.column(name).combine_chunks()
+        if pa.types.is_dictionary(array.type):
+            columns[name] = array
+        else:
+            columns[name] = array.to_numpy(zero_copy_only=False)
+    return columns
+
+
+def read_cached(keys, cache_dir=CACHE_DIR):
+    cached = {}
+    for node, key in keys.items():
+        path = cache_path(key, cache_dir)
+        if not os.path.exists(path):
+            continue
+        try:
+            cached[node] = read_columns(path)
+        except (OSError, pa.ArrowInvalid):
+            # Unreadable entries are extracted again and overwritten
+            pass
+    return cached
+
+
+def prune_cache(keys, cache_dir=CACHE_DIR):
+    # Remove entries no longer used by the current study definition
+    current = {f"{key}.arrow" for key in keys.values()}
+    removed = 0
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".arrow") and filename not in current:
+            os.remove(os.path.join(cache_dir, filename))
+            removed += 1
+    return removed
+
+
+def extract_cached(
+    graph, members, covariate_definitions, make_backend, backend_key, workers=1, cache_dir=CACHE_DIR
+):
+    keys = node_keys(graph, members, covariate_definitions, backend_key)
+    cached = read_cached(keys, cache_dir)
+    if len(cached) == len(keys):
+        results = cached
+    elif workers > 1:
+        results = extract_parallel(graph, make_backend, workers, done=cached)
+    else:
+        results = extract_serial(graph, make_backend(), done=cached)
+
+    extracted = [node for node in keys if node not in cached]
+    for node in extracted:
+        write_columns(cache_path(keys[node], cache_dir), results[node])
+    return results, extracted
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# The analysis scripts import each other as top-level modules and read
+# codelists/ relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "analysis"))
+
+
+@pytest.fixture
+def in_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,124 @@
+from collections import Counter
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from an_table1 import TABLE1, Table1Counts, chunk_columns, count_file, count_files, figure_rows, histogram, kdensity, summarize, table1
+from cohort_arrays import CohortArrays, schema_from_arrow
+from cr_main import output_type
+
+nan = np.nan
+
+
+def test_summarize_by_hand():
+    # _pctile averages the two values either side of a position n p / 100
+    # that falls on a record, else takes the next record
+    summary = summarize(Counter([1.0, 2.0, 3.0, 4.0]))
+    assert (summary.n, summary.mean, summary.low, summary.high) == (4, 2.5, 1, 4)
+    assert summary.sd == pytest.approx(np.sqrt(5 / 3))
+    assert (summary.p25, summary.p50, summary.p75) == (1.5, 2.5, 3.5)
+    assert summarize(Counter([5.0, 1.0, 1.0])).p50 == 1
+    assert summarize(Counter()).n == 0
+
+
+def test_histogram_by_hand():
+    # 10 records: min(sqrt(10), 10 log10(10)) = 3 bins of width 3 over 0-9,
+    # the largest value in the last
+    bins = histogram(Counter(np.arange(10.0)))
+    assert [(start, end, frequency) for start, end, frequency, _ in bins] == [(0, 3, 3), (3, 6, 3), (6, 9, 4)]
+    assert [density for *_, density in bins] == pytest.approx([3 / 30, 3 / 30, 4 / 30])
+
+
+def test_kdensity_of_counts_matches_the_records():
+    rng = np.random.default_rng(0)
+    records = rng.integers(0, 30, 500).astype(float)
+    points = kdensity(Counter(records.tolist()))
+    grid = np.array([point for point, _ in points])
+    assert len(grid) == 50 and grid[0] == records.min() and grid[-1] == records.max()
+    # Every record's kernel, one at a time
+    summary = summarize(Counter(records.tolist()))
+    width = 0.9 * min(records.std(ddof=1), (summary.p75 - summary.p25) / 1.349) / len(records) ** 0.2
+    z = (grid[:, None] - records[None, :]) / width
+    expected = np.where(z * z < 5, 0.75 * (1 - z * z / 5) / np.sqrt(5), 0).sum(axis=1) / (len(records) * width)
+    np.testing.assert_allclose([density for _, density in points], expected)
+
+
+# MERGING
+def cohort(rows, seed):
+    # The columns an_table1 reads, as cr_main.py types them, with missing
+    # values and records an_table1.do drops
+    rng = np.random.default_rng(seed)
+
+    def levels(values, missing=0.0):
+        column = rng.choice(values, rows).astype(float)
+        column[rng.random(rows) < missing] = nan
+        return column
+
+    columns = {variable: levels(values) for variable, values in TABLE1 if values is not None}
+    columns.update(
+        {
+            "patient_id": np.arange(rows, dtype=float),
+            "sgtf": levels([0, 1, 9]),
+            "has_sgtf": levels([0, 1, 1, 1]),
+            "cox_pop": levels([0, 1, 1, 1, 1]),
+            "start_week": levels([48, 49, 50, 51, 52, 53]),
+            "hh_total_cat": levels([1, 2, 3, 4], 0.1),
+            "rural_urban5": levels([1, 2, 3, 4, 5], 0.1),
+            "age": levels(np.arange(18, 100), 0.01),
+            "ae_time": levels(np.arange(0, 28), 0.7),
+            "cox_ae_time": rng.integers(0, 28, rows) + rng.choice([0, 0.5], rows),
+            "ae_covid_date": levels(np.arange(18_960, 19_000), 0.6),
+        }
+    )
+    arrays = {}
+    for name, values in columns.items():
+        missing = np.isnan(values)
+        arrow_type = output_type(name)
+        if pa.types.is_date32(arrow_type):
+            arrays[name] = pa.array(np.where(missing, 0, values).astype(np.int32), mask=missing).cast(arrow_type)
+        elif pa.types.is_floating(arrow_type):
+            arrays[name] = pa.array(values.astype(np.float32), mask=missing)
+        else:
+            arrays[name] = pa.array(np.where(missing, 0, values).astype(arrow_type.to_pandas_dtype()), mask=missing)
+    arrays["utla_group"] = pa.array(np.where(rng.random(rows) < 0.05, None, "Leeds").tolist(), pa.string())
+    return pa.table(arrays)
+
+
+def outputs(counts):
+    return table1(counts), figure_rows(counts)
+
+
+def test_batches_merge_to_one_pass():
+    table = cohort(5000, 1)
+    arrays = CohortArrays.from_batches(schema_from_arrow(table.schema), table.to_batches())
+    whole = Table1Counts().add(chunk_columns(arrays))
+    assert 0 < whole.total() < 5000 and {row[0] for row in figure_rows(whole)} == {
+        "time_ae_hist", "date_ae_hist", "date_ae_hist1", "ae_hist", "ae_kden"
+    }
+    # Added batch by batch, or counted apart and merged, in uneven batches
+    cuts = [0, 1, 700, 2500, 4999, 5000]
+    added = Table1Counts()
+    merged = Table1Counts()
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+        batch = chunk_columns(arrays.take(np.arange(start, stop)))
+        added.add(batch)
+        merged.merge(Table1Counts().add(batch))
+    assert outputs(added) == outputs(whole)
+    assert outputs(merged) == outputs(whole)
+
+
+def test_files_merge_to_one_file(tmp_path):
+    # Shards counted on a pool and merged give the whole cohort's table and
+    # figures, whatever the batch size
+    table = cohort(6000, 2)
+    pq.write_table(table, tmp_path / "main.parquet")
+    paths = []
+    for k, start in enumerate(range(0, 6000, 1700)):
+        paths.append(str(tmp_path / f"main_{k}.parquet"))
+        pq.write_table(table.slice(start, 1700), paths[-1])
+    whole = count_file(str(tmp_path / "main.parquet"))
+    assert outputs(count_files(paths, batch_size=500, workers=2)) == outputs(whole)
+    assert outputs(count_files(paths, batch_size=500, workers=1)) == outputs(whole)
+    assert outputs(count_file(str(tmp_path / "main.parquet"), batch_size=333)) == outputs(whole)
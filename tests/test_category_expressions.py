@@ -0,0 +1,68 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from category_expressions import compiled, parse_expression
+
+nan = np.nan
+
+
+@pytest.fixture
+def columns():
+    return {
+        "code": pa.array(["N", "S", None, "E", "N"]).dictionary_encode(),
+        "ever": np.array([1, 0, 0, 1, 0]),
+        "count": np.array([0.0, 2, nan, 7, 4]),
+        "date": np.array(["2021-01-01", "NaT", "2020-06-01", "NaT", "2021-03-01"], dtype="datetime64[D]"),
+    }
+
+
+def test_smoking_status(columns):
+    # The study's own expressions: the first that holds wins, else DEFAULT
+    smoking = compiled(
+        {
+            "S": "code = 'S'",
+            "E": "code = 'E' OR code = 'N' AND ever",
+            "N": "code = 'N' AND NOT ever",
+            "M": "DEFAULT",
+        }
+    )
+    assert smoking.evaluate(columns, 5).tolist() == ["E", "S", "M", "E", "N"]
+
+
+def test_missing_values_compare_false(columns):
+    assert compiled({"low": "count > 0 AND count < 5"}).evaluate(columns, 5).tolist() == [None, "low", None, None, "low"]
+    assert compiled({"none": "count = 0", "1": "DEFAULT"}).evaluate(columns, 5).tolist() == ["none", "1", "1", "1", "1"]
+
+
+def test_bare_names_and_missing_categories(columns):
+    # A date is true where present; a missing category is ''
+    assert compiled({"dated": "date", "blank": "code = ''"}).evaluate(columns, 5).tolist() == ["dated", None, "dated", None, "dated"]
+    assert compiled({"coded": "code", "0": "DEFAULT"}).evaluate(columns, 5).tolist() == ["coded", "coded", "0", "coded", "coded"]
+
+
+def test_literals_take_the_column_type(columns):
+    # '1' against a number is 1, and 1 against a category is '1'
+    assert compiled({"1": "ever = '1'", "0": "DEFAULT"}).evaluate(columns, 5).tolist() == ["1", "0", "0", "1", "0"]
+    codes = {"n": pa.array(["1", "2"]).dictionary_encode()}
+    assert compiled({"one": "n = 1"}).evaluate(codes, 2).tolist() == ["one", None]
+
+
+def test_parse_errors():
+    with pytest.raises(ValueError):
+        parse_expression("code = 'S' AND")
+    with pytest.raises(ValueError):
+        parse_expression("(count > 0")
+
+
+def test_not_of_a_missing_value_is_not_true(columns):
+    # NOT of unknown is unknown, so neither holds where count is missing
+    assert compiled({"A": "NOT count > 0", "B": "DEFAULT"}).evaluate(columns, 5).tolist() == ["A", "B", "B", "B", "B"]
+    assert compiled({"A": "NOT NOT count > 0", "B": "NOT date"}).evaluate(columns, 5).tolist() == [None, "A", None, "A", "A"]
+
+
+def test_three_valued_and_or(columns):
+    # unknown AND false is false, unknown OR true is true, else unknown stays
+    assert compiled({"A": "NOT (count > 0 AND ever)"}).evaluate(columns, 5).tolist() == ["A", "A", "A", None, "A"]
+    assert compiled({"A": "NOT (count > 0 OR code = 'N')"}).evaluate(columns, 5).tolist() == [None, None, None, None, None]
+    assert compiled({"A": "NOT (count > 5 OR code = 'S')"}).evaluate(columns, 5).tolist() == ["A", None, None, None, "A"]
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cohortextractor")
+
+import codelist_cache  # noqa: E402
+from codelist_cache import cached_codelist_from_csv, file_sha, read_cache  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(codelist_cache, "_index", None)
+    codelist_cache._file_sha.cache_clear()
+    yield tmp_path
+    codelist_cache._file_sha.cache_clear()
+
+
+def new_process(monkeypatch):
+    # Forget what this process has hashed and read, as the next run would
+    codelist_cache._file_sha.cache_clear()
+    monkeypatch.setattr(codelist_cache, "_index", None)
+
+
+def write_csv(path, rows):
+    path.write_text("code,category\n" + "".join(f"{code},{category}\n" for code, category in rows))
+
+
+def test_warm_runs_read_no_csv(cache, monkeypatch):
+    path = cache / "ethnicity.csv"
+    write_csv(path, [("Y9930", "1"), ("XaJQy", "2"), ("Y9930", "1")])
+    cold = cached_codelist_from_csv(str(path), "ctv3", "code", "category")
+    assert list(cold) == [("Y9930", "1"), ("XaJQy", "2"), ("Y9930", "1")]
+
+    new_process(monkeypatch)
+    monkeypatch.setattr(codelist_cache, "compile_csv", None)
+    monkeypatch.setattr(codelist_cache.hashlib, "sha1", None)
+    warm = cached_codelist_from_csv(str(path), "ctv3", "code", "category")
+    assert list(warm) == list(cold) and warm.source == cold.source
+    codes, categories = read_cache(file_sha(str(path)), "code", "category")
+    assert isinstance(codes, np.memmap) and isinstance(categories, np.memmap)
+
+
+def test_a_changed_csv_is_read_again(cache, monkeypatch):
+    path = cache / "asthma.csv"
+    write_csv(path, [("H33..", "")])
+    first = cached_codelist_from_csv(str(path), "ctv3")
+    new_process(monkeypatch)
+    write_csv(path, [("H33..", ""), ("H330.", "")])
+    second = cached_codelist_from_csv(str(path), "ctv3")
+    assert list(first) == ["H33.."] and list(second) == ["H33..", "H330."]
+    assert first.source != second.source
@@ -0,0 +1,56 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+pytest.importorskip("cohortextractor")
+
+from codelist_matcher import CodelistMatcher  # noqa: E402
+
+CODELISTS = {
+    "asthma": ["H33..", "H330.", "H331."],
+    "copd": ["H3...", "H33.."],
+    "ethnicity": [("Y9930", "1"), ("XaJQy", "2"), ("9i0..", "5")],
+    "flu": ["65E..", "ZV048", "65ED."],
+}
+
+
+@pytest.fixture
+def matcher():
+    return CodelistMatcher("ctv3", CODELISTS)
+
+
+def listed(name):
+    return [code if isinstance(code, str) else code[0] for code in CODELISTS[name]]
+
+
+def test_masks_match_isin(matcher):
+    # Every list's mask is np.isin of its codes, for strings and dictionaries
+    rng = np.random.default_rng(0)
+    vocabulary = np.array(sorted({code for name in CODELISTS for code in listed(name)}) + ["X0000", "H3", "H33.1"])
+    indices = rng.integers(0, len(vocabulary), 10_000)
+    codes = vocabulary[indices]
+    dictionary = pa.DictionaryArray.from_arrays(pa.array(indices.astype(np.int32)), pa.array(vocabulary))
+    for masks in (matcher.masks(codes), matcher.masks(dictionary), matcher.masks(pa.chunked_array([dictionary[:4000], dictionary[4000:]]))):
+        for name in CODELISTS:
+            np.testing.assert_array_equal(masks[name], np.isin(codes, listed(name)), err_msg=name)
+
+
+def test_missing_codes_match_nothing(matcher):
+    codes = pa.array(["H33..", None, "65E.."]).dictionary_encode()
+    masks = matcher.masks(codes)
+    assert masks["asthma"].tolist() == [True, False, False]
+    assert masks["flu"].tolist() == [False, False, True]
+
+
+def test_prefix():
+    # As ICD-10 codes are matched: a code matches every list code it starts with
+    matcher = CodelistMatcher("icd10", {"covid": ["U071", "U072"], "respiratory": ["J", "U07"]})
+    masks = matcher.masks(np.array(["U0712", "U072", "U07", "J18", "U", "X"]), prefix=True)
+    assert masks["covid"].tolist() == [True, True, False, False, False, False]
+    assert masks["respiratory"].tolist() == [True, True, True, True, False, False]
+
+
+def test_categories(matcher):
+    ids = matcher.lookup(np.array(["XaJQy", "H33..", "9i0..", "Y9930"]))
+    labels, categories = matcher.category(ids, "ethnicity")
+    assert [labels[i] if i >= 0 else None for i in categories] == ["2", None, "5", "1"]
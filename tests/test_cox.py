@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from cox import CoxModel, fit_model, lincom, lrtest
+
+
+# REFERENCE
+# The partial log likelihood written out one failure time at a time, over
+# the records in the same stratum that entered before and left no earlier
+def partial_loglik(beta, columns, ties):
+    xb = np.column_stack([columns["x1"], columns["x2"]]) @ beta
+    t0, t, d, strata = columns["t0"], columns["t"], columns["d"] != 0, columns["s"]
+    loglik = 0.0
+    for stratum, time in sorted({(s, time) for s, time, failed in zip(strata, t, d) if failed}):
+        at_risk = (strata == stratum) & (t0 < time) & (t >= time)
+        failing = at_risk & d & (t == time)
+        risk, failed = np.exp(xb[at_risk]).sum(), np.exp(xb[failing]).sum()
+        n = failing.sum()
+        for l in range(n):
+            fraction = l / n if ties == "efron" else 0
+            loglik -= np.log(risk - fraction * failed)
+        loglik += xb[failing].sum()
+    return loglik
+
+
+def reference_fit(columns, ties):
+    from scipy.optimize import minimize
+
+    fit = minimize(lambda beta: -partial_loglik(beta, columns, ties), np.zeros(2), method="BFGS", options={"gtol": 1e-10})
+    # The variance from a central difference Hessian at the maximum
+    h = 1e-4
+    hessian = np.zeros((2, 2))
+    for i in range(2):
+        for j in range(2):
+            ei, ej = np.eye(2)[i] * h, np.eye(2)[j] * h
+            hessian[i, j] = (
+                partial_loglik(fit.x + ei + ej, columns, ties)
+                - partial_loglik(fit.x + ei - ej, columns, ties)
+                - partial_loglik(fit.x - ei + ej, columns, ties)
+                + partial_loglik(fit.x - ei - ej, columns, ties)
+            ) / (4 * h * h)
+    return fit.x, np.linalg.inv(-hessian), -fit.fun
+
+
+@pytest.fixture
+def cohort():
+    # Whole-day times so failures tie, three strata and late entry
+    rng = np.random.default_rng(3)
+    n = 300
+    x1 = rng.normal(size=n)
+    x2 = (rng.random(n) < 0.4).astype(float)
+    t = np.ceil(rng.exponential(20 * np.exp(-0.5 * x1 + 0.3 * x2)))
+    t0 = np.where(rng.random(n) < 0.3, np.floor(t * rng.random(n)), 0)
+    return {
+        "t": t,
+        "t0": t0,
+        "d": (rng.random(n) < 0.7).astype(float),
+        "s": rng.integers(0, 3, n).astype(float),
+        "x1": x1,
+        "x2": x2,
+    }
+
+
+# TESTS
+@pytest.mark.parametrize("ties, expected", [("breslow", np.log((3 + np.sqrt(33)) / 2)), ("efron", 1.676857)])
+def test_therneau_test1(ties, expected):
+    # Data set 1 of Therneau and Grambsch's validation appendix: the Breslow
+    # estimate has a closed form
+    columns = {"t": np.array([9, 1, 1, 6, 6, 8.0]), "d": np.array([1, 1, 0, 1, 1, 0.0]), "x": np.array([0, 1, 1, 1, 0, 0.0])}
+    result = fit_model(columns, CoxModel("test1", "x", exit="t", failure="d", ties=ties))
+    assert result.converged
+    assert result.coef[0] == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize("ties", ["breslow", "efron"])
+def test_strata_and_delayed_entry_match_reference(cohort, ties):
+    model = CoxModel("m", "x1 x2", exit="t", failure="d", entry="t0", strata="s", ties=ties)
+    result = fit_model(cohort, model)
+    coef, variance, loglik = reference_fit(cohort, ties)
+    assert result.names == ["x1", "x2"]
+    np.testing.assert_allclose(result.coef, coef, atol=1e-5)
+    np.testing.assert_allclose(result.variance, variance, rtol=1e-3)
+    assert result.loglik == pytest.approx(loglik, abs=1e-8)
+    assert result.events == int(cohort["d"].sum())
+
+
+def test_no_failures_is_not_estimable(cohort):
+    columns = dict(cohort, d=np.zeros(len(cohort["d"])))
+    result = fit_model(columns, CoxModel("m", "x1 x2", exit="t", failure="d"))
+    assert result.error == "no failures"
+    assert np.isnan(lincom(result, ["x1"]).estimate)
+    assert np.isnan(lrtest(result, fit_model(cohort, CoxModel("full", "x1 x2", exit="t", failure="d"))))
@@ -0,0 +1,93 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from cohort_arrays import cohort_chunks
+from cr_main import INPUT_COLUMNS, collect_statistics, output_schema, prepare, prepare_shard, prepare_sharded
+from shards import merge_sorted, split_chunks
+
+
+@pytest.fixture
+def extract(in_root, tmp_path):
+    pytest.importorskip("cohortextractor")
+    from dummy_data import write_dummy_cohort
+    from study_definition import study
+
+    path = str(tmp_path / "input.parquet")
+    write_dummy_cohort(study, path, 3000, seed=1)
+    return path
+
+
+def rewrite(path, table):
+    pq.write_table(table.replace_schema_metadata(pq.read_schema(path).metadata), path)
+
+
+def test_empty_extract_writes_an_empty_cohort(extract, tmp_path):
+    rewrite(extract, pq.read_table(extract).slice(0, 0))
+    counts = prepare(extract, str(tmp_path / "main.parquet"))
+    assert counts["output rows"] == 0
+    assert pq.read_table(tmp_path / "main.parquet").schema.equals(output_schema())
+
+
+def test_no_surviving_rows_write_an_empty_cohort(extract, tmp_path):
+    # Nobody has a positive test in the study period
+    table = pq.read_table(extract)
+    column = table.column_names.index("sgss_pos_inrange")
+    rewrite(extract, table.set_column(column, "sgss_pos_inrange", pa.nulls(table.num_rows, table.schema.field(column).type)))
+    counts = prepare(extract, str(tmp_path / "main.parquet"), chunk_size=1000)
+    assert counts["no positive test in study period"] == 3000
+    assert counts["output rows"] == 0
+    assert pq.read_table(tmp_path / "main.parquet").schema.equals(output_schema())
+
+
+def test_chunks_make_the_same_cohort(extract, tmp_path):
+    whole = prepare(extract, str(tmp_path / "whole.parquet"))
+    chunked = prepare(extract, str(tmp_path / "chunked.parquet"), chunk_size=700)
+    assert whole == chunked
+    assert pq.read_table(tmp_path / "chunked.parquet").equals(pq.read_table(tmp_path / "whole.parquet"))
+
+
+@pytest.mark.parametrize("shard_by", ["region", "stp"])
+def test_shards_merge_to_the_same_cohort(extract, tmp_path, shard_by):
+    # Each shard prepared with the whole cohort's summaries, then merged in
+    # small ranges, gives the unsharded cohort's rows in patient_id order
+    prepare(extract, str(tmp_path / "main.parquet"))
+    expected = pq.read_table(tmp_path / "main.parquet").sort_by("patient_id")
+    directory = str(tmp_path / "shards")
+    inputs = split_chunks(cohort_chunks(extract, INPUT_COLUMNS, 700), shard_by, directory)
+    assert len(inputs) > 1
+    statistics = collect_statistics(extract)
+    outputs = []
+    for name, path in inputs.items():
+        outputs.append(os.path.join(directory, f"main_{name}.parquet"))
+        prepare_shard((path, outputs[-1]), 700, statistics)
+    merge_sorted(outputs, str(tmp_path / "merged.parquet"), "patient_id", rows_per_range=300)
+    assert pq.read_table(tmp_path / "merged.parquet").equals(expected)
+
+
+def test_prepare_sharded_matches_prepare(extract, tmp_path):
+    prepare(extract, str(tmp_path / "main.parquet"))
+    counts = prepare_sharded(extract, str(tmp_path / "sharded.parquet"), "region", 1000, 2, str(tmp_path / "shards"))
+    assert counts["shards"] > 1
+    expected = pq.read_table(tmp_path / "main.parquet").sort_by("patient_id")
+    assert pq.read_table(tmp_path / "sharded.parquet").equals(expected)
+
+
+def test_empty_extract_in_shards(extract, tmp_path):
+    rewrite(extract, pq.read_table(extract).slice(0, 0))
+    counts = prepare_sharded(extract, str(tmp_path / "main.parquet"), "region", workers=2, directory=str(tmp_path / "shards"))
+    assert counts["shards"] == 0
+    table = pq.read_table(tmp_path / "main.parquet")
+    assert table.num_rows == 0 and table.schema.equals(output_schema())
+
+
+def test_no_surviving_shard(extract, tmp_path):
+    table = pq.read_table(extract)
+    column = table.column_names.index("age")
+    rewrite(extract, table.set_column(column, "age", pa.nulls(table.num_rows, table.schema.field(column).type)))
+    counts = prepare_sharded(extract, str(tmp_path / "main.parquet"), "region", workers=2, directory=str(tmp_path / "shards"))
+    assert counts["shards"] > 1 and counts["output rows"] == 0
+    table = pq.read_table(tmp_path / "main.parquet")
+    assert table.num_rows == 0 and table.schema.equals(output_schema())
@@ -0,0 +1,109 @@
+import gc
+
+import numpy as np
+import pytest
+
+import date_expressions
+from date_expressions import evaluate_date, iso_days
+
+
+def dates(*values):
+    return np.array(values, dtype="datetime64[D]")
+
+
+@pytest.mark.parametrize(
+    "expression, anchor, expected",
+    [
+        # Months keep the day, or take the last day of a shorter month
+        ("x + 1 month", "2021-01-31", "2021-02-28"),
+        ("x + 1 month", "2020-01-31", "2020-02-29"),
+        ("x - 1 month", "2021-03-31", "2021-02-28"),
+        ("x + 3 months", "2021-11-30", "2022-02-28"),
+        ("x + 13 months", "2021-01-31", "2022-02-28"),
+        ("x - 2 months", "2021-12-31", "2021-10-31"),
+        # Years from 29 February
+        ("x + 1 year", "2020-02-29", "2021-02-28"),
+        ("x + 4 years", "2020-02-29", "2024-02-29"),
+        ("x - 1 year", "2024-02-29", "2023-02-28"),
+        ("x + 100 years", "2000-02-29", "2100-02-28"),
+        # Days across the end of February
+        ("x + 1 day", "2020-02-28", "2020-02-29"),
+        ("x + 1 day", "2021-02-28", "2021-03-01"),
+        ("x - 366 days", "2021-02-28", "2020-02-28"),
+        ("x - 1 year + 1 day", "2021-03-01", "2020-03-02"),
+        # cohortextractor's functions
+        ("last_day_of_month(x)", "2020-02-10", "2020-02-29"),
+        ("last_day_of_month(x)", "2100-02-10", "2100-02-28"),
+        ("first_day_of_month(x) - 1 day", "2021-03-15", "2021-02-28"),
+        ("last_day_of_year(x)", "2021-06-01", "2021-12-31"),
+        ("first_day_of_year(x)", "2021-06-01", "2021-01-01"),
+    ],
+)
+def test_shifts(expression, anchor, expected):
+    assert evaluate_date(expression, {"x": dates(anchor)})[0] == np.datetime64(expected)
+
+
+def test_shift_matches_calendar_over_four_years():
+    # Every day of 2019-2022 a month on, against Python's calendar
+    import calendar
+    import datetime
+
+    days = np.arange(np.datetime64("2019-01-01"), np.datetime64("2023-01-01"))
+    expected = []
+    for day in days.astype(datetime.date):
+        year, month = divmod(day.year * 12 + day.month, 12)
+        month += 1
+        expected.append(datetime.date(year, month, min(day.day, calendar.monthrange(year, month)[1])))
+    np.testing.assert_array_equal(evaluate_date("x + 1 month", {"x": days}), np.array(expected, dtype="datetime64[D]"))
+
+
+def test_missing_anchors_stay_missing():
+    result = evaluate_date("x - 1 year", {"x": dates("2021-01-01", "NaT")})
+    np.testing.assert_array_equal(result, dates("2020-01-01", "NaT"))
+
+
+def test_fixed_dates():
+    assert evaluate_date("2020-02-29 + 1 year", {}) == np.datetime64("2021-02-28")
+    assert evaluate_date("2021-10-03", {}) == np.datetime64("2021-10-03")
+
+
+def test_memo_lets_anchors_go():
+    date_expressions.clear_cache()
+    anchor = dates("2020-02-29", "2021-01-31")
+    first = evaluate_date("x + 1 year", {"x": anchor})
+    assert evaluate_date("x + 1 year", {"x": anchor}) is first
+    assert not first.flags.writeable
+    assert len(date_expressions._results) == 1
+    del anchor
+    gc.collect()
+    assert len(date_expressions._results) == 0
+
+
+def test_iso_days():
+    days, missing = iso_days(["2020-02-29", "1970-01-01", "", None, "2021-02-29", "2021-13-01", "20210101", "2021-1-01"])
+    assert missing.tolist() == [False, False, True, True, True, True, True, True]
+    assert days.tolist() == [18321, 0, 0, 0, 0, 0, 0, 0]
+
+
+def test_iso_days_of_month():
+    days, missing = iso_days(["2020-02", "2021-02", "2021-00"], day=29)
+    assert missing.tolist() == [False, True, True]
+    assert days[0] == (np.datetime64("2020-02-29") - np.datetime64("1970-01-01")).astype(int)
+
+
+def test_iso_days_round_trip():
+    rng = np.random.default_rng(0)
+    values = np.datetime64("1970-01-01") + rng.integers(-30_000, 30_000, 10_000).astype("timedelta64[D]")
+    values[rng.random(len(values)) < 0.1] = np.datetime64("NaT")
+    text = np.where(np.isnat(values), "", values.astype(str)).astype(object)
+    days, missing = iso_days(text)
+    np.testing.assert_array_equal(missing, np.isnat(values))
+    np.testing.assert_array_equal(days[~missing], (values[~missing] - np.datetime64("1970-01-01")).astype(np.int64))
+
+
+def test_iso_days_of_any_text():
+    # Non-ASCII text, here and in the day of the month, is not a date either
+    days, missing = iso_days(["2020-01-01", "2020-01-0é", "２０２０-01-01", "2020-01-01é", "ü"])
+    assert missing.tolist() == [False, True, True, True, True]
+    _, missing = iso_days(["2020-01", "2020-0é"], day=15)
+    assert missing.tolist() == [False, True]
@@ -0,0 +1,29 @@
+import tracemalloc
+
+import numpy as np
+
+from extract_profile import ProfiledBackend, collect_profile, profile_report
+
+
+class Backend:
+    rows_scanned = 0
+
+    def extract(self, name, columns):
+        self.rows_scanned += 7
+        return {name: np.array([0, 1, 2, 0])}
+
+
+def test_memory_is_traced_only_when_asked(tmp_path):
+    assert not tracemalloc.is_tracing()
+    ProfiledBackend(Backend(), str(tmp_path / "timed")).extract("age", {})
+    assert not tracemalloc.is_tracing()
+    try:
+        ProfiledBackend(Backend(), str(tmp_path / "traced"), trace_memory=True).extract("age", {})
+    finally:
+        tracemalloc.stop()
+
+    [timed] = collect_profile(str(tmp_path / "timed"), str(tmp_path / "timed.json"), str(tmp_path / "timed_trace.json"))
+    [traced] = collect_profile(str(tmp_path / "traced"), str(tmp_path / "traced.json"), str(tmp_path / "traced_trace.json"))
+    assert (timed["rows_touched"], timed["rows_returned"], timed["result_bytes"]) == (7, 2, 32)
+    assert timed["peak_bytes"] is None and traced["peak_bytes"] > 0
+    assert "MB peak" not in profile_report([timed]) and "MB peak" in profile_report([traced])
@@ -0,0 +1,82 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from imputation import ImputationModel, impute_variable, rubin
+
+Result = namedtuple("Result", "names coef variance error", defaults=(None,))
+
+
+def test_rubin_by_hand():
+    # Estimates 1, 2, 3 with variance 0.5: W = 0.5, B = 1, T = W + (1 + 1/3) B
+    # and r = (4/3) B / W, so df = 2 (1 + 1/r)^2
+    results = [Result(["x"], np.array([coef]), np.array([[0.5]])) for coef in (1.0, 2.0, 3.0)]
+    pooled = rubin(results)
+    assert pooled.m == 3
+    assert pooled.coef == pytest.approx([2.0])
+    assert pooled.within[0, 0] == pytest.approx(0.5)
+    assert pooled.between[0, 0] == pytest.approx(1.0)
+    assert pooled.variance[0, 0] == pytest.approx(0.5 + 4 / 3)
+    assert pooled.df[0] == pytest.approx(2 * (1 + 0.5 / (4 / 3)) ** 2)
+
+
+def test_rubin_covariance():
+    rng = np.random.default_rng(0)
+    coefs = rng.normal(size=(5, 2))
+    variances = [np.diag(rng.random(2) + 0.1) for _ in range(5)]
+    pooled = rubin([Result(["a", "b"], coef, variance) for coef, variance in zip(coefs, variances)])
+    np.testing.assert_allclose(pooled.variance, np.mean(variances, axis=0) + 1.2 * np.cov(coefs.T))
+
+
+def test_rubin_reports_a_failed_imputation():
+    results = [Result(["x"], np.array([1.0]), np.array([[0.5]])), Result([], np.zeros(0), np.zeros((0, 0)), "no failures")]
+    with pytest.raises(ValueError, match="Imputation 2 could not be estimated: no failures"):
+        rubin(results)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(1)
+    n = 400
+    x = rng.normal(size=n)
+    y = (rng.random(n) < 1 / (1 + np.exp(-x))).astype(float)
+    missing = rng.random(n) < 0.2
+    y[missing] = np.nan
+    return {"y": y, "x": x}, missing, rng
+
+
+def test_logit_omits_predictors_constant_where_observed(data):
+    columns, missing, rng = data
+    # z only varies among the rows being imputed, and w is collinear with x
+    z = np.where(missing, rng.integers(0, 2, len(missing)), 1).astype(float)
+    columns = dict(columns, z=z, w=2 * columns["x"])
+    values, _ = impute_variable(columns, ImputationModel("y", "logit", "x i.z w"), missing, rng, {})
+    assert not np.isnan(values).any()
+    assert set(values[missing]) <= {0.0, 1.0}
+
+
+def test_logit_names_a_perfect_predictor(data):
+    columns, missing, rng = data
+    # Among the observed rows, y is 1 wherever flag is 1
+    flag = (rng.random(len(missing)) < 0.2).astype(float)
+    y = columns["y"].copy()
+    y[~missing & (flag == 1)] = 1
+    columns = dict(columns, y=y, flag=flag)
+    with pytest.raises(ValueError, match=r"mi impute logit y: perfect prediction \(1.flag == 1 predicts y == 1"):
+        impute_variable(columns, ImputationModel("y", "logit", "x i.flag"), missing, rng, {})
+
+
+def test_logit_reports_separation(data):
+    columns, missing, rng = data
+    y = np.where(missing, np.nan, (columns["x"] > 0).astype(float))
+    with pytest.raises(ValueError, match="mi impute logit y: perfect prediction: the logit model does not converge"):
+        impute_variable(dict(columns, y=y), ImputationModel("y", "logit", "x"), missing, rng, {})
+
+
+def test_nothing_missing_fits_nothing(data):
+    columns, missing, rng = data
+    # As in an empty cohort: y need not vary, as no model is fitted
+    columns = dict(columns, y=np.ones(len(missing)))
+    values, _ = impute_variable(columns, ImputationModel("y", "logit", "x"), np.zeros(len(missing), bool), rng, {})
+    assert values.tolist() == columns["y"].tolist()
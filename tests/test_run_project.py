@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+pytest.importorskip("yaml")
+
+from run_project import load_project, run_project, selected  # noqa: E402
+
+PROJECT = """
+version: '3.0'
+actions:
+  prepare:
+    run: python:latest analysis/prepare.py
+    outputs:
+      highly_sensitive:
+        data: output/prepared.txt
+  count:
+    run: python:latest analysis/count.py
+    needs: [prepare]
+    outputs:
+      moderately_sensitive:
+        table: output/count.txt
+"""
+
+# prepare copies the lookup, with its lines stripped; count counts the lines
+PREPARE = """
+import helpers
+with open("lookups/areas.csv") as f:
+    lines = [line.strip() for line in f]
+helpers.write("output/prepared.txt", lines)
+"""
+COUNT = """
+import helpers
+with open("output/prepared.txt") as f:
+    helpers.write("output/count.txt", [str(len(f.read().split()))])
+"""
+HELPERS = """
+import os
+def write(path, lines):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\\n".join(lines) + "\\n")
+"""
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write("project.yaml", PROJECT)
+    write("analysis/prepare.py", PREPARE)
+    write("analysis/count.py", COUNT)
+    write("analysis/helpers.py", HELPERS)
+    write("lookups/areas.csv", "a\nb\n")
+    actions = load_project("project.yaml")
+
+    def run(**options):
+        return run_project(actions, selected(actions, None), workers=2, state_path="metadata/state.json", log_dir="metadata", **options)
+
+    return run
+
+
+def count():
+    with open("output/count.txt") as f:
+        return f.read().strip()
+
+
+def test_unchanged_actions_are_skipped(project):
+    assert project() == {"prepare": "ran", "count": "ran"}
+    assert project() == {"prepare": "skipped", "count": "skipped"}
+    assert project(force=True) == {"prepare": "ran", "count": "ran"}
+
+
+def test_a_changed_lookup_reruns_the_actions(project):
+    project()
+    write("lookups/areas.csv", "a\nb\nc\n")
+    assert project(dry_run=True) == {"prepare": "would run", "count": "would run"}
+    assert project() == {"prepare": "ran", "count": "ran"}
+    assert count() == "3"
+
+
+def test_a_changed_import_reruns_the_action(project):
+    project()
+    with open("analysis/helpers.py", "a") as f:
+        f.write("# changed\n")
+    assert project() == {"prepare": "ran", "count": "ran"}
+
+
+def test_the_same_upstream_output_does_not_rerun_what_follows(project):
+    project()
+    # prepare reruns, as its script changed, but writes the same lines
+    with open("analysis/prepare.py", "a") as f:
+        f.write("# changed\n")
+    assert project() == {"prepare": "ran", "count": "skipped"}
+
+
+def test_missing_outputs_rerun_the_action(project):
+    project()
+    os.remove("output/count.txt")
+    assert project() == {"prepare": "skipped", "count": "ran"}
+
+
+def test_a_failed_action_blocks_what_needs_it(project):
+    project()
+    write("analysis/prepare.py", "raise SystemExit(3)\n")
+    assert project() == {"prepare": "failed", "count": "blocked"}
+    # A failure records no key, so putting the script back skips both again
+    write("analysis/prepare.py", PREPARE)
+    assert project() == {"prepare": "skipped", "count": "skipped"}
+
+
+def test_missing_declared_outputs_fail_the_action(project):
+    write("analysis/prepare.py", "pass\n")
+    assert project() == {"prepare": "failed", "count": "blocked"}
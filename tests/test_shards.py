@@ -0,0 +1,39 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from shards import merge_sorted, shard_name
+
+
+def test_shard_names():
+    assert shard_name("East Midlands") == "east_midlands"
+    assert shard_name("") == shard_name(None) == shard_name("--") == "missing"
+
+
+def test_merge_sorted(tmp_path):
+    # Files of interleaved keys merge to every row in key order, however
+    # small the ranges the merge reads
+    rng = np.random.default_rng(0)
+    ids = rng.permutation(5000)
+    shard = rng.integers(0, 4, len(ids))
+    paths = []
+    for k in range(4):
+        keys = np.sort(ids[shard == k])
+        paths.append(str(tmp_path / f"shard_{k}.parquet"))
+        pq.write_table(pa.table({"patient_id": keys, "value": keys * 2.0}), paths[-1], row_group_size=200)
+    for rows_per_range in (7, 333, 10_000):
+        output = str(tmp_path / "merged.parquet")
+        assert merge_sorted(paths, output, "patient_id", rows_per_range) == len(ids)
+        table = pq.read_table(output)
+        assert table.column("patient_id").to_pylist() == list(range(len(ids)))
+        assert table.column("value").to_pylist() == [2.0 * i for i in range(len(ids))]
+
+
+def test_merge_nothing(tmp_path):
+    schema = pa.schema([("patient_id", pa.int64()), ("value", pa.float32())])
+    output = str(tmp_path / "merged.parquet")
+    assert merge_sorted([], output, "patient_id", schema=schema) == 0
+    assert pq.read_table(output).schema.equals(schema)
+    with pytest.raises(ValueError):
+        merge_sorted([], output, "patient_id")
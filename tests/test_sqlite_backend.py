@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from query_plan import plan_scans
+from sqlite_backend import SQLiteBackend, make_database, round_to_nearest
+
+
+def test_round_to_nearest():
+    # Halves away from zero, as SQL's ROUND
+    values = np.array([149, 150, 151, 249, 250, -150, 0], dtype=object)
+    assert round_to_nearest(values, 100).tolist() == [100, 200, 200, 200, 300, -200, 0]
+
+
+@pytest.fixture(scope="module")
+def backend(tmp_path_factory):
+    pytest.importorskip("cohortextractor")
+    from study_definition import study
+
+    path = str(tmp_path_factory.mktemp("ehr") / "ehr.sqlite")
+    make_database(path, study, 500, seed=2)
+    backend = SQLiteBackend(path, study)
+    # Variables that differ from imd only in rounding, declared after a
+    # variable of the same scan without any
+    funcname, args = backend.definitions["imd"]
+    backend.definitions = dict(backend.definitions)
+    for name, rounding in [("imd_raw", None), ("imd_1000", 1000)]:
+        variable_args = {key: value for key, value in args.items() if key != "round_to_nearest"}
+        if rounding:
+            variable_args["round_to_nearest"] = rounding
+        backend.definitions[name] = (funcname, dict(variable_args, column_type="int"))
+    backend.kinds = dict(backend.kinds, imd_raw="int", imd_1000="int")
+    return backend
+
+
+def test_fused_variables_keep_their_own_rounding(backend, in_root):
+    names = ["rural_urban", "imd_raw", "imd", "imd_1000"]
+    [scan] = plan_scans({name: backend.definitions[name] for name in names})
+    assert scan.variables == names
+    fused = backend.extract_scan(scan, {"sgss_pos_inrange": backend.extract("sgss_pos_inrange", {})["sgss_pos_inrange"]})
+    # Integers are 0, and categories missing, for patients without an address
+    raw = fused["imd_raw"]
+    assert raw.max() > 1000 and len(set(raw % 100)) > 1
+    imd = [int(value) if value is not None else 0 for value in fused["imd"].to_pylist()]
+    assert imd == round_to_nearest(raw, 100).tolist()
+    np.testing.assert_array_equal(fused["imd_1000"], round_to_nearest(raw, 1000))
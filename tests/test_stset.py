@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from cox import CoxModel, fit_model
+from stset import EpisodeColumns, Episodes, SurvivalSetup, stset, survival_columns
+
+nan = np.nan
+
+
+def test_survival_columns():
+    # The first of attendance, death and the censor date; a missing date is
+    # later than any other
+    out = survival_columns(
+        study_start=np.array([0.0, 0, 0, 0]),
+        ae_covid_date=np.array([5, nan, 30, 5]),
+        died_date_ons=np.array([nan, 3, 10, nan]),
+        ec_data_cens=20.0,
+        ae_admit=np.array([1, nan, 0, 0]),
+    )
+    np.testing.assert_array_equal(out["ae_surv_d"], [5, 3, 10, 5])
+    np.testing.assert_array_equal(out["ae_surv_d14"], [5, 3, 10, 5])
+    np.testing.assert_array_equal(out["cox_ae"], [1, 0, 0, 1])
+    np.testing.assert_array_equal(out["cox_admit"], [1, 0, 0, 0])
+
+
+def test_stset_drops_records_ending_before_they_start():
+    columns = {"exit": np.array([5, 0, nan, 8.0]), "fail": np.array([1, 1, 0, nan]), "entry": np.array([-2, 0, 0, 3.0])}
+    times = stset(columns, SurvivalSetup("exit", "fail", None, "entry"))
+    assert times.st.tolist() == [True, False, False, True]
+    assert times.d.tolist() == [True, False, False, False]
+    np.testing.assert_array_equal(times.t0, [0, nan, nan, 3])
+    np.testing.assert_array_equal(times.t, [5, nan, nan, 8])
+
+
+def test_episodes():
+    columns = {"exit": np.array([3, 10, 30.0]), "fail": np.array([1, 1, 0.0]), "entry": np.array([0, 8, 0.0])}
+    episodes = Episodes(stset(columns, SurvivalSetup("exit", "fail", None, "entry")), [7, 14, 28])
+    assert episodes.rows.tolist() == [0, 1, 2, 2, 2, 2]
+    assert episodes.period.tolist() == [0, 1, 0, 1, 2, 3]
+    assert episodes.t0.tolist() == [0, 8, 0, 7, 14, 28]
+    assert episodes.t.tolist() == [3, 10, 7, 14, 28, 30]
+    assert episodes.d.tolist() == [True, True, False, False, False, False]
+
+
+def test_episodes_cover_the_records():
+    rng = np.random.default_rng(0)
+    n = 10_000
+    exit = rng.integers(-5, 90, n).astype(float)
+    exit[rng.random(n) < 0.05] = nan
+    columns = {"exit": exit, "fail": (rng.random(n) < 0.2).astype(float), "entry": rng.integers(0, 20, n).astype(float)}
+    times = stset(columns, SurvivalSetup("exit", "fail", None, "entry"))
+    episodes = Episodes(times, [7, 14, 28])
+    assert episodes.d.sum() == times.d.sum()
+    np.testing.assert_allclose(np.bincount(episodes.rows, episodes.t - episodes.t0, n), np.nan_to_num(times.t - times.t0))
+    # Each episode lies between two consecutive cuts
+    bounds = np.array([-np.inf, 7, 14, 28, np.inf])
+    assert np.all(episodes.t0 >= bounds[episodes.period]) and np.all(episodes.t <= bounds[episodes.period + 1])
+    assert np.all(episodes.t > episodes.t0)
+
+
+def test_split_records_fit_the_same_model():
+    # stsplit does not change a Cox model without time-varying terms
+    rng = np.random.default_rng(1)
+    n = 500
+    x = rng.normal(size=n)
+    columns = {
+        "start": np.zeros(n),
+        "exit": np.ceil(rng.exponential(20 * np.exp(-0.5 * x))),
+        "fail": (rng.random(n) < 0.6).astype(float),
+        "x": x,
+    }
+    whole = fit_model(columns, CoxModel("whole", "x", exit="exit", failure="fail", origin="start"))
+    split = fit_model(columns, CoxModel("split", "x", exit="exit", failure="fail", origin="start", split=[7, 14, 28]))
+    np.testing.assert_allclose(split.coef, whole.coef)
+    np.testing.assert_allclose(split.variance, whole.variance)
+    assert split.loglik == pytest.approx(whole.loglik)
+
+
+def test_episode_columns_expand_when_read():
+    columns = {"exit": np.array([10, 20.0]), "fail": np.array([1, 0.0])}
+    times = stset(columns, SurvivalSetup("exit", "fail", None))
+    columns = EpisodeColumns({"x": np.array([1.0, 2.0])}, Episodes(times, [7]))
+    assert "x" in columns and "_period" in columns
+    assert columns["x"].tolist() == [1, 1, 2, 2]
+    assert columns["_period"].tolist() == [0, 1, 0, 1]
+    assert columns["_d"].tolist() == [0, 1, 0, 0]